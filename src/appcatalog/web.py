@@ -14,9 +14,13 @@ from sentry_sdk.integrations.asgi import SentryAsgiMiddleware
 from sqlalchemy.exc import DatabaseError
 
 from libcatalog import DomainException, Context, NotFoundException
+from libcatalog.domain.autocomplete import schedule_autocomplete_refresh
+from libcatalog.domain.search import get_search_cache_stats, get_search_drop_rate_stats
 from libutil import tracer
 from libutil import util
 from libutil.query_parser import NestedQueryParams
+from libutil.solr_util import solr_pool
+from libutil.spanner_util import spanner_registry, BOILERPLATE_SPANNER_KEY
 
 logger = logging.getLogger(__name__)
 
@@ -98,6 +102,31 @@ def health_check():
     return "OK"
 
 
+@app.get("/public/spanner_pools", status_code=200, tags=['system'])
+def spanner_pools():
+    return spanner_registry.metrics()
+
+
+@app.get("/public/search_stats", status_code=200, tags=['system'])
+def search_stats():
+    return {'cache': get_search_cache_stats(), 'drop_rates': get_search_drop_rate_stats()}
+
+
+@app.on_event('startup')
+def warm_spanner_pools():
+    spanner_registry.warmup([BOILERPLATE_SPANNER_KEY])
+
+
+@app.on_event('startup')
+def warm_autocomplete_index():
+    schedule_autocomplete_refresh()
+
+
+@app.on_event('shutdown')
+async def close_solr_pool():
+    await solr_pool.close()
+
+
 logsql.init()
 
 from appcatalog.views import router
@@ -0,0 +1,71 @@
+import logging
+
+import click
+
+logger = logging.getLogger(__name__)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.group()
+def db():
+    pass
+
+
+@db.command()
+def create():
+    from libindexing import models
+
+    models.tables.create_all()
+
+
+@db.command()
+@click.argument('tables', nargs=-1)
+def ddl(tables):
+    # CREATE TABLE statements of the offer database, for the tables not created by `db create`
+    from sqlalchemy.schema import CreateIndex, CreateTable
+
+    from libindexing import engine_offer, models
+
+    for table in models.tables.Base.metadata.sorted_tables:
+        if tables and table.name not in tables:
+            continue
+        click.echo(f'{str(CreateTable(table).compile(engine_offer)).strip()};')
+        for index in table.indexes:
+            click.echo(f'{CreateIndex(index).compile(engine_offer)};')
+
+
+@cli.group()
+def spanner():
+    pass
+
+
+@spanner.command()
+@click.option('--dry-run', is_flag=True)
+def migrate(dry_run):
+    from libcatalog.models.spanner_tables import BOILERPLATE_SPANNER_MIGRATIONS
+    from libutil.spanner_util import boilerplate_spanner
+
+    db = boilerplate_spanner()
+    for table, column, ddl in BOILERPLATE_SPANNER_MIGRATIONS:
+        exists = db.execute_query(
+            '''
+            SELECT COUNT(*) as count
+            FROM information_schema.columns
+            WHERE table_schema = '' AND table_name = @table AND column_name = @column
+        ''',
+            table=table,
+            column=column,
+        ).dict()['count']
+        if exists:
+            continue
+        click.echo(f'{ddl};')
+        if not dry_run:
+            db.database.update_ddl([ddl]).result()
+
+
+if __name__ == "__main__":
+    cli()
@@ -1,9 +1,24 @@
 from eventpubsub import EventSubscriber
+from eventpubsub import FlowControl
 from noonutil.v1 import workerutil
 
+from libutil.consumer_flow import SubscriptionFlow
+
 # workers for `one` worker
 workers = workerutil.ThreadedWorkers()
 
 # workers for `consume` worker
 consume_workers = workerutil.ThreadedWorkers()
-subscriber = EventSubscriber('', consume_workers)
+# flows of the subscriptions consumed by this process
+flows = []
+
+
+def subscribe(subscription, flow: SubscriptionFlow, wrapper_fn):
+    """
+    Subscribes with the flow control settings of `flow`, processing messages under its adaptive limit.
+    """
+    subscriber = EventSubscriber(
+        '', consume_workers, flow_control=FlowControl(max_messages=flow.max_messages, max_bytes=flow.max_bytes)
+    )
+    flows.append(flow)
+    return subscriber.subscribe(subscription, wrapper_fn=flow.wrap(wrapper_fn))
@@ -1,17 +1,31 @@
+import importlib
 import logging
+import os
 
-from . import consume_workers
-from . import price_update
-from . import stock_update
-from . import nsku_product_update
-from . import zsku_product_update
-from . import reindex_zsku
+from . import consume_workers, flows
+from libindexing.domain.psku import warm_psku_code_cache
+from libindexing.domain.stock import stock_outbox_drainer
+from libutil.consumer_flow import start_stats_reporter
 
-assert price_update
-assert stock_update
-assert nsku_product_update
-assert zsku_product_update
-assert reindex_zsku
 logger = logging.getLogger(__name__)
 
+SUBSCRIPTIONS = ('price_update', 'stock_update', 'nsku_product_update', 'zsku_product_update', 'reindex_zsku')
+# pods can be deployed per subscription, e.g. CONSUMER_SUBSCRIPTIONS=stock_update
+CONSUMER_SUBSCRIPTIONS = [
+    name.strip() for name in (os.getenv('CONSUMER_SUBSCRIPTIONS') or ','.join(SUBSCRIPTIONS)).split(',') if name.strip()
+]
+
+for name in CONSUMER_SUBSCRIPTIONS:
+    assert name in SUBSCRIPTIONS, f"unknown subscription {name}"
+    importlib.import_module(f'{__package__}.{name}')
+
+try:
+    warm_psku_code_cache()
+except Exception as e:
+    # the cache fills from noon cache as messages come in
+    logger.warning(f"could not warm up the psku_code cache: {e}")
+if 'stock_update' in CONSUMER_SUBSCRIPTIONS:
+    # retries the stock sinks recorded as failed, by this process or any other
+    stock_outbox_drainer.start()
+start_stats_reporter(flows)
 consume_workers.main()
@@ -1,10 +1,13 @@
 import logging
 
-from appindexing.consumers import subscriber
+from appindexing.consumers import subscribe
 from libindexing.domain.product import update_nsku_product_details
+from libutil.consumer_flow import SubscriptionFlow
 
 logger = logging.getLogger(__name__)
 
+flow = SubscriptionFlow('nsku_product_update', max_messages=10, target_latency=30)
+
 
 def wrapper_fn(fn, message, subctx):
     ids = message.data.decode('utf8').split(',')
@@ -13,6 +16,6 @@ def wrapper_fn(fn, message, subctx):
 
 
 #TODO: Rename the subscriber after creating on pubsub
-@subscriber.subscribe('update_log.product_update~mp-boilerplate-api', wrapper_fn=wrapper_fn)
+@subscribe('update_log.product_update~mp-boilerplate-api', flow, wrapper_fn)
 def reindex_nsku_product_details(nsku_list):
     update_nsku_product_details(nsku_list)
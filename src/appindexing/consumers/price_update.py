@@ -1,21 +1,25 @@
-from appindexing.consumers import subscriber
-from libindexing.domain.price import reindex_price
+from appindexing import consumers
+from libindexing.domain.price import PRICE_BATCH_MAX_WAIT_SECONDS, price_update_batcher
 from libindexing.domain.product import *
+from libutil.consumer_flow import SubscriptionFlow
+
+# messages stay outstanding until their batch is written, latency runs from receipt to the batch's ack or nack
+flow = SubscriptionFlow(
+    'price_update', max_messages=20, target_latency=PRICE_BATCH_MAX_WAIT_SECONDS + 4, deferred_ack=True
+)
 
 
 def wrapper_fn(fn, message, subctx):
+    # the message is acked by the batcher once the batch it lands in is written
     ids = message.data.decode('utf8')
-    fn(ids)
-    message.ack()
+    price_update_batcher.add(fn(ids), ack=message.ack, nack=message.nack)
 
 
-def subscribe(*args, **kwargs):
-    kwargs['wrapper_fn'] = wrapper_fn
-    return subscriber.subscribe(*args, **kwargs)
+def subscribe(subscription):
+    return consumers.subscribe(subscription, flow, wrapper_fn)
 
 
 @subscribe('boilerplate_price_update~mp-boilerplate-api')
 def reindex_price_update(payload):
     json_payload = json.loads(payload)
-    sku_wh_code_list = [(offer['sku'], offer['wh_code']) for offer in json_payload]
-    reindex_price(sku_wh_code_list)
+    return [(offer['sku'], offer['wh_code']) for offer in json_payload]
@@ -1,7 +1,18 @@
-from appindexing.consumers import subscriber
+import json
+
+from appindexing.consumers import subscribe
 from libindexing.domain.product import update_zsku_product_details
+from libutil.consumer_flow import SubscriptionFlow
+
+flow = SubscriptionFlow('reindex_zsku', max_messages=10, target_latency=30)
+
+
+def wrapper_fn(fn, message, subctx):
+    fn(json.loads(message.data.decode('utf8')), int(message.attributes.get('catalog_fetch_attempt') or 0))
+    message.ack()
 
 
-@subscriber.subscribe('boilerplate_reindex_sku~mp-boilerplate-api')
-def reindex_sku_details(zsku_list):
-    update_zsku_product_details(zsku_list)
+@subscribe('boilerplate_reindex_sku~mp-boilerplate-api', flow, wrapper_fn)
+def reindex_sku_details(zsku_list, attempt=0):
+    # explicit reindex requests rebuild the solr documents even when the product content is unchanged
+    update_zsku_product_details(zsku_list, attempt, force=True)
@@ -1,10 +1,25 @@
-from appindexing.consumers import subscriber
+from appindexing.consumers import subscribe
 from libindexing.domain.product import *
-from libindexing.domain.stock import reindex_stock
+from libindexing.domain.stock import STOCK_BATCH_MAX_SIZE, STOCK_BATCH_MAX_WAIT_SECONDS, stock_update_batcher
+from libutil.consumer_flow import SubscriptionFlow
 
+# messages stay outstanding until their batch is written, pubsub has to hand out more than a batch.
+# Latency runs from receipt to the batch's ack or nack: the batch window plus the write of the batch
+flow = SubscriptionFlow(
+    'stock_update',
+    max_messages=2 * STOCK_BATCH_MAX_SIZE,
+    target_latency=STOCK_BATCH_MAX_WAIT_SECONDS + 4,
+    deferred_ack=True,
+)
 
-@subscriber.subscribe('scstock_darkstore_stock_net_updated~mp-boilerplate-api')
+
+def wrapper_fn(fn, message, subctx):
+    # the message is acked by the batcher once the batch it lands in is written
+    payload = json.loads(message.data.decode('utf8'))
+    stock_update_batcher.add(fn(payload), ack=message.ack, nack=message.nack)
+
+
+@subscribe('scstock_darkstore_stock_net_updated~mp-boilerplate-api', flow, wrapper_fn)
 def reindex_stock_update(payload):
     logger.info(f"stock_updated payload: {payload['data']}")
-    list_stock_update = json.loads(payload['data'])['updated_stock']
-    reindex_stock(list_stock_update)
+    return json.loads(payload['data'])['updated_stock']
@@ -1,11 +1,14 @@
 import json
 import logging
 
-from appindexing.consumers import subscriber
+from appindexing.consumers import subscribe
 from libindexing.domain.product import update_zsku_product_details
+from libutil.consumer_flow import SubscriptionFlow
 
 logger = logging.getLogger(__name__)
 
+flow = SubscriptionFlow('zsku_product_update', max_messages=10, target_latency=30)
+
 
 def get_json_loads_data(data):
     try:
@@ -22,6 +25,6 @@ def wrapper_attr_fn(fn, message, subctx):
     message.ack()
 
 
-@subscriber.subscribe('catalog.zsku_product_updates~mp-boilerplate-api', wrapper_fn=wrapper_attr_fn)
+@subscribe('catalog.zsku_product_updates~mp-boilerplate-api', flow, wrapper_attr_fn)
 def reindex_zsku_product_details(sku_list):
     update_zsku_product_details(sku_list)
@@ -1,7 +1,9 @@
+import json
 import logging
 
 import click
 
+from libindexing.domain.solr_rebuild import rebuild_solr_core
 from libindexing.domain.stock import full_stock_update_for_warehouse
 
 logger = logging.getLogger(__name__)
@@ -14,9 +16,23 @@ def cli():
 
 @cli.command()
 @click.argument("wh_code")
-def full_reindex(wh_code):
+@click.option("--restart", is_flag=True, help="start over instead of resuming an unfinished run")
+def full_reindex(wh_code, restart):
     logger.info(f"starting full reindex for warehouse code: {wh_code}")
-    full_stock_update_for_warehouse(wh_code)
+    full_stock_update_for_warehouse(wh_code, resume=not restart)
+
+
+@cli.command()
+@click.argument("country_code")
+@click.option("--schema", type=click.Path(exists=True), help="schema api commands (json) for the rebuilt core")
+@click.option("--dry-run", is_flag=True, help="build and validate the shadow core without swapping")
+def rebuild_solr(country_code, schema, dry_run):
+    logger.info(f"starting solr rebuild for country code: {country_code}")
+    schema_commands = None
+    if schema:
+        with open(schema) as f:
+            schema_commands = json.load(f)
+    logger.info(rebuild_solr_core(country_code, schema=schema_commands, dry_run=dry_run))
 
 
 if __name__ == "__main__":
@@ -18,6 +18,7 @@ from liborder import Context
 from libutil import tracer
 from libutil import translation
 from libutil import util
+from libutil.spanner_util import spanner_registry, BOILERPLATE_SPANNER_KEY
 
 METRICS_PERCENTAGE = 0.8
 
@@ -102,6 +103,16 @@ def health_check():
     return "OK"
 
 
+@app.get("/public/spanner_pools", status_code=200, tags=['system'])
+def spanner_pools():
+    return spanner_registry.metrics()
+
+
+@app.on_event('startup')
+def warm_spanner_pools():
+    spanner_registry.warmup([BOILERPLATE_SPANNER_KEY])
+
+
 if os.getenv('ENV') in ('dev', 'staging', 'prod'):
     fastapiutil.add_default_openapi_parameters(
         app,
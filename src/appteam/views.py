@@ -7,7 +7,11 @@ from jsql import sql
 
 import libaccess.models.tables
 from appteam.web import g
-from libindexing.domain.stock import full_stock_update_for_warehouse
+from libindexing.domain.stock import (
+    get_stock_reindex_status,
+    get_stock_sink_lag,
+    start_full_stock_update_for_warehouse,
+)
 from liborder import Context
 from libutil import pubsub
 
@@ -30,13 +34,20 @@ def execute_import(db, importer, table):
 
 
 @router.get('/sync_stock/{wh_code}', tags=['sync'])
-def sync_stock(wh_code):
-    try:
+def sync_stock(wh_code, restart: bool = False):
+    if start_full_stock_update_for_warehouse(wh_code, resume=not restart):
         logger.warning(f"full stock update for wh_code: {wh_code} started")
-        full_stock_update_for_warehouse(wh_code)
-    except Exception as ex:
-        return {'error': f'{ex}'}
-    return 'ok'
+    return get_stock_reindex_status(wh_code)
+
+
+@router.get('/sync_stock/{wh_code}/status', tags=['sync'])
+def sync_stock_status(wh_code):
+    return get_stock_reindex_status(wh_code)
+
+
+@router.get('/sync_stock_sinks', tags=['sync'])
+def sync_stock_sinks():
+    return get_stock_sink_lag()
 
 
 @router.get('/sync_products/{zsku_list}', tags=['sync'])
@@ -44,9 +55,9 @@ def sync_products(zsku_list):
     zsku_list = zsku_list.split(',')
     if not zsku_list:
         return
-    publisher = pubsub.get_publisher('boilerplate_reindex_sku')
-    for chunk in iterutils.chunked(zsku_list, 200):
-        publisher(json.dumps(chunk))
+    with pubsub.get_publisher('boilerplate_reindex_sku') as publisher:
+        for chunk in iterutils.chunked(zsku_list, 200):
+            publisher(json.dumps(chunk))
     return 'published to topic: boilerplate_reindex_sku'
 
 
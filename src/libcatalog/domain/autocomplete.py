@@ -0,0 +1,288 @@
+import bisect
+import collections
+import contextlib
+import datetime
+import fcntl
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import unicodedata
+from typing import Dict, List, Tuple
+
+from libcatalog.domain.category import get_category_index, CategoryIndex
+from libcatalog.domain.offer import spanner_read_threadpool
+from libutil.spanner_util import boilerplate_spanner
+
+logger = logging.getLogger(__name__)
+
+# off by default, suggestions then come from solr only
+AUTOCOMPLETE_ENABLED = os.getenv('AUTOCOMPLETE_ENABLED', '0') == '1'
+AUTOCOMPLETE_REFRESH_SECONDS = int(os.getenv('AUTOCOMPLETE_REFRESH_SECONDS') or 5 * 60)
+# matches of a prefix looked at for ranking, the rest of a very common prefix is left to solr
+AUTOCOMPLETE_SCAN_LIMIT = int(os.getenv('AUTOCOMPLETE_SCAN_LIMIT') or 2000)
+# workers of a host share the index through this file, so only the changes since the file's watermark are read
+AUTOCOMPLETE_SNAPSHOT_PATH = os.getenv('AUTOCOMPLETE_SNAPSHOT_PATH') or '/tmp/catalog_autocomplete.json'
+# one worker of a host refreshes at a time, the others wait and start from the snapshot it wrote
+AUTOCOMPLETE_LOCK_PATH = f'{AUTOCOMPLETE_SNAPSHOT_PATH}.lock'
+# rows are re-read this far behind the watermark, updated_at is not guaranteed to be committed in order
+AUTOCOMPLETE_WATERMARK_OVERLAP = datetime.timedelta(seconds=60)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+ProductEntry = collections.namedtuple('ProductEntry', ['brand_code', 'en_title', 'en_brand', 'ar_title', 'ar_brand'])
+
+_TATWEEL = 'ـ'
+_LETTER_VARIANTS = str.maketrans({'ى': 'ي', 'ة': 'ه'})
+_NON_WORD = re.compile(r'[^\w]+')
+
+
+def normalize(text: str) -> str:
+    """
+    Lowercased text without accents, arabic diacritics or punctuation, with single spaces between words.
+    """
+    text = unicodedata.normalize('NFKD', text or '').lower()
+    text = ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn' and ch != _TATWEEL)
+    text = text.translate(_LETTER_VARIANTS)
+    return ' '.join(_NON_WORD.sub(' ', text).split())
+
+
+def _word_suffixes(text: str) -> List[Tuple[str, Tuple[int, int]]]:
+    # "al rawabi milk" -> ["al rawabi milk", "rawabi milk", "milk"], so a prefix can match any word,
+    # each with its rank: matches on an earlier word and in shorter texts come first
+    words = normalize(text).split()
+    return [(' '.join(words[i:]), (i, len(words))) for i in range(len(words))]
+
+
+class _PrefixArray:
+    """
+    Sorted array of (key, ref, rank) entries, the keys starting with a prefix form one contiguous range.
+    """
+
+    def __init__(self, entries):
+        entries = sorted(set(entries))
+        self.keys = [key for key, _, _ in entries]
+        self.refs = [ref for _, ref, _ in entries]
+        self.ranks = [rank for _, _, rank in entries]
+
+    def find(self, prefix: str, limit: int) -> list:
+        """
+        The best ranked refs of the first AUTOCOMPLETE_SCAN_LIMIT keys starting with the prefix.
+        """
+        best = {}
+        idx = bisect.bisect_left(self.keys, prefix)
+        end = min(len(self.keys), idx + AUTOCOMPLETE_SCAN_LIMIT)
+        while idx < end and self.keys[idx].startswith(prefix):
+            ref, rank = self.refs[idx], self.ranks[idx]
+            if ref not in best or rank < best[ref]:
+                best[ref] = rank
+            idx += 1
+        return sorted(best, key=lambda ref: (best[ref], ref))[:limit]
+
+
+class AutocompleteIndex:
+    """
+    Immutable prefix index over product titles, brands and category names in both languages.
+
+    A refresh builds a new index from the previous products plus the rows changed since the
+    watermark and swaps the module reference, readers never see a partial index.
+    """
+
+    def __init__(self, products: Dict[str, ProductEntry], category_index: CategoryIndex, watermark: datetime.datetime):
+        self.products = products
+        self.watermark = watermark
+        self.built_at = time.monotonic()
+        # workers started together do not all expire together
+        self.expires_at = self.built_at + AUTOCOMPLETE_REFRESH_SECONDS * (1 + random.random() * 0.2)
+
+        self.brand_names: Dict[str, Dict[str, str]] = {}
+        product_pairs = []
+        brand_pairs = []
+        for sku, product in products.items():
+            for title in (product.en_title, product.ar_title):
+                product_pairs.extend((key, sku, rank) for key, rank in _word_suffixes(title))
+            if product.brand_code and product.brand_code not in self.brand_names:
+                en_brand = product.en_brand or product.brand_code
+                self.brand_names[product.brand_code] = {'en': en_brand, 'ar': product.ar_brand or en_brand}
+                for name in (product.en_brand, product.ar_brand):
+                    brand_pairs.extend((key, product.brand_code, rank) for key, rank in _word_suffixes(name))
+
+        self.category_index = category_index
+        category_pairs = []
+        for id_category, category in category_index.categories.items():
+            for name in (category.en_name, category.ar_name):
+                category_pairs.extend((key, id_category, rank) for key, rank in _word_suffixes(name))
+
+        self._products = _PrefixArray(product_pairs)
+        self._brands = _PrefixArray(brand_pairs)
+        self._categories = _PrefixArray(category_pairs)
+
+    def is_expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def lookup(
+        self, q: str, lang: str, brands: int = 5, categories: int = 5, products: int = 20
+    ) -> Tuple[list, list, list]:
+        prefix = normalize(q)
+        if not prefix:
+            return [], [], []
+        lang = lang if lang in ('en', 'ar') else 'en'
+        brand_list = [
+            {'code': code, 'name': self.brand_names[code][lang]} for code in self._brands.find(prefix, brands)
+        ]
+        category_list = [
+            {
+                'code': self.category_index.categories[id_category].code,
+                'name': self.category_index.categories[id_category].name(lang=lang),
+            }
+            for id_category in self._categories.find(prefix, categories)
+        ]
+        return brand_list, category_list, self._products.find(prefix, products)
+
+
+_autocomplete_index: AutocompleteIndex | None = None
+_refresh_lock = threading.Lock()
+_refresh_future = None
+
+
+def get_autocomplete_index() -> AutocompleteIndex | None:
+    return _autocomplete_index
+
+
+def _fetch_changed_products(since: datetime.datetime) -> List[Dict]:
+    return (
+        boilerplate_spanner()
+        .execute_query(
+            '''
+            SELECT
+                p.sku,
+                p.brand_code,
+                p.is_active,
+                pen.title as en_title,
+                pen.brand as en_brand,
+                par.title as ar_title,
+                par.brand as ar_brand,
+                GREATEST(
+                    p.updated_at,
+                    COALESCE(pen.updated_at, p.updated_at),
+                    COALESCE(par.updated_at, p.updated_at),
+                    COALESCE(os.updated_at, p.updated_at)
+                ) as updated_at,
+                COALESCE(os.in_stock, FALSE) as in_stock
+            FROM product p
+            LEFT JOIN product_en pen USING (sku)
+            LEFT JOIN product_ar par USING (sku)
+            LEFT JOIN (
+                SELECT sku, MAX(updated_at) as updated_at, LOGICAL_OR(stock_net > 0) as in_stock
+                FROM offer_stock
+                GROUP BY sku
+            ) os USING (sku)
+            WHERE p.updated_at > TIMESTAMP(@since)
+            OR pen.updated_at > TIMESTAMP(@since)
+            OR par.updated_at > TIMESTAMP(@since)
+            OR os.updated_at > TIMESTAMP(@since)
+        ''',
+            since=since.isoformat(),
+        )
+        .dicts()
+    )
+
+
+def _load_snapshot():
+    try:
+        with open(AUTOCOMPLETE_SNAPSHOT_PATH) as f:
+            data = json.load(f)
+        watermark = datetime.datetime.fromisoformat(data['watermark'])
+        products = {sku: ProductEntry(*entry) for sku, entry in data['products'].items()}
+        return products, watermark
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"ignoring unreadable autocomplete snapshot {AUTOCOMPLETE_SNAPSHOT_PATH}: {e}")
+        return None
+
+
+def _write_snapshot(products: Dict[str, ProductEntry], watermark: datetime.datetime):
+    tmp_path = f'{AUTOCOMPLETE_SNAPSHOT_PATH}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'watermark': watermark.isoformat(), 'products': products}, f, ensure_ascii=False)
+        os.replace(tmp_path, AUTOCOMPLETE_SNAPSHOT_PATH)
+    except Exception as e:
+        logger.warning(f"could not write autocomplete snapshot {AUTOCOMPLETE_SNAPSHOT_PATH}: {e}")
+
+
+@contextlib.contextmanager
+def _host_refresh_lock():
+    try:
+        lock_file = open(AUTOCOMPLETE_LOCK_PATH, 'a')
+    except OSError as e:
+        logger.warning(f"refreshing autocomplete index without the host lock {AUTOCOMPLETE_LOCK_PATH}: {e}")
+        yield
+        return
+    with lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def refresh_autocomplete_index() -> AutocompleteIndex:
+    """
+    Brings the index up to date: starts from the newest of the current index and the shared
+    snapshot, then applies the products changed since its watermark.
+
+    Only products with an offer in stock are indexed. Workers of a host refresh one at a time, so
+    only the first one scans every product, the others start from the snapshot it wrote.
+    """
+    global _autocomplete_index
+    with _refresh_lock, _host_refresh_lock():
+        current = _autocomplete_index
+        products, watermark = (dict(current.products), current.watermark) if current else ({}, EPOCH)
+        snapshot = _load_snapshot()
+        if snapshot and snapshot[1] > watermark:
+            products, watermark = snapshot
+
+        rows = _fetch_changed_products(max(watermark - AUTOCOMPLETE_WATERMARK_OVERLAP, EPOCH))
+        new_watermark = watermark
+        for row in rows:
+            if row['is_active'] and row['in_stock'] and (row['en_title'] or row['ar_title']):
+                products[row['sku']] = ProductEntry(
+                    row['brand_code'], row['en_title'], row['en_brand'], row['ar_title'], row['ar_brand']
+                )
+            else:
+                products.pop(row['sku'], None)
+            new_watermark = max(new_watermark, row['updated_at'])
+
+        index = AutocompleteIndex(products, get_category_index(), new_watermark)
+        _autocomplete_index = index
+        if new_watermark > watermark or snapshot is None:
+            _write_snapshot(products, new_watermark)
+        return index
+
+
+def _refresh_in_background():
+    try:
+        refresh_autocomplete_index()
+    except Exception as e:
+        logger.warning(f"autocomplete index refresh failed: {e}")
+
+
+def schedule_autocomplete_refresh():
+    """
+    Starts a refresh on the spanner read pool when the index is enabled and missing or expired, and
+    none is running.
+    """
+    global _refresh_future
+    if not AUTOCOMPLETE_ENABLED:
+        return
+    index = _autocomplete_index
+    if index is not None and not index.is_expired():
+        return
+    if _refresh_future is not None and not _refresh_future.done():
+        return
+    _refresh_future = spanner_read_threadpool.submit(_refresh_in_background)
@@ -1,7 +1,9 @@
-from typing import List, Dict
+import collections
+import threading
+import time
+from typing import List, Dict, Tuple
 
 from jsql import sql
-from noonutil.v1 import miscutil
 
 from libcatalog import engine
 from libcatalog.models.category import Category
@@ -18,53 +20,177 @@ def _get_category_table() -> List[Category]:
     return [Category(**row) for row in rows]
 
 
-@miscutil.cached(ttl=60 * 60)
-def _get_category_table_cached() -> List[Category]:
-    return _get_category_table()
+CATEGORY_INDEX_TTL = 60 * 60
+
+# pre-rendered category entry, the request specific count and selection flags are added on top
+_RenderedCategory = collections.namedtuple('_RenderedCategory', ['id_category', 'code', 'name'])
+
+
+class CategoryIndex:
+    """
+    Immutable snapshot of the category tree, built once per refresh.
+
+    Readers grab the current snapshot through `get_category_index()` and never see a half built tree,
+    a refresh builds a new snapshot and swaps the module reference. Nothing here should be mutated.
+    """
+
+    LANGS = ('en', 'ar')
+
+    def __init__(self, categories: List[Category]):
+        self.built_at = time.monotonic()
+        children = {category.id_category: [] for category in categories}
+        for category in categories:
+            if category.id_category_parent in children:
+                children[category.id_category_parent].append(category.id_category)
+        self.children: Dict[int, Tuple[int, ...]] = {id_cat: tuple(ids) for id_cat, ids in children.items()}
+        self.categories: Dict[int, Category] = {
+            category.id_category: category.copy(update={'children': list(self.children[category.id_category])})
+            for category in categories
+        }
+        self.category_list: Tuple[Category, ...] = tuple(self.categories.values())
+        self.code_to_id: Dict[str, int] = {category.code: category.id_category for category in categories}
+        self.roots: Tuple[int, ...] = tuple(
+            category.id_category for category in categories if not category.id_category_parent
+        )
+        # [parent, grandparent, ..., id_category], same shape the indexer always stored in category_ids
+        self.ancestors: Dict[int, Tuple[int, ...]] = {}
+        for id_category, category in self.categories.items():
+            parent_ids = []
+            parent_id = category.id_category_parent
+            while parent_id is not None and parent_id not in parent_ids:
+                parent_ids.append(parent_id)
+                parent_id = self.categories[parent_id].id_category_parent if parent_id in self.categories else None
+            self.ancestors[id_category] = tuple(parent_ids) + (id_category,)
+        self._rendered = {
+            lang: {
+                id_category: _RenderedCategory(id_category, category.code, category.name(lang=lang))
+                for id_category, category in self.categories.items()
+            }
+            for lang in self.LANGS
+        }
+
+    def is_expired(self, ttl: int = CATEGORY_INDEX_TTL) -> bool:
+        return time.monotonic() - self.built_at >= ttl
+
+    def get_category_ids_for(self, id_category_list) -> List[int]:
+        """
+        Unique ids of the given categories and all of their ancestors.
+        """
+        ids = {}
+        for id_category in id_category_list:
+            for id_parent in self.ancestors.get(id_category, ()):
+                ids[id_parent] = True
+        return list(ids)
+
+    def _rendered_for(self, lang: str) -> Dict[int, _RenderedCategory]:
+        return self._rendered.get(lang) or self._rendered['en']
+
+    def root_of(self, id_category: int) -> int | None:
+        ancestors = self.ancestors.get(id_category)
+        if not ancestors:
+            return None
+        return ancestors[-2] if len(ancestors) > 1 else id_category
+
+    def get_category_facet_data(self, lang: str, counts: Dict[int, int], selected_ids=()) -> List[dict]:
+        """
+        Category facet tree for the given solr counts.
+
+        Roots are listed when they have results or are selected, children only under the roots of the
+        selected categories.
+        """
+        rendered = self._rendered_for(lang)
+        selected_ids = set(selected_ids)
+        selected_roots = {self.root_of(id_category) for id_category in selected_ids}
+        return [
+            {
+                "name": rendered[id_cat].name,
+                "code": rendered[id_cat].code,
+                "count": counts.get(id_cat, 0),
+                "children": [
+                    {
+                        "name": rendered[id_child].name,
+                        "code": rendered[id_child].code,
+                        "count": counts.get(id_child, 0),
+                        "children": [],
+                        "isSelected": id_child in selected_ids,
+                    }
+                    for id_child in (self.children[id_cat] if id_cat in selected_roots else ())
+                    if counts.get(id_child) or id_child in selected_ids
+                ],
+                "isSelected": id_cat in selected_ids,
+            }
+            for id_cat in self.roots
+            if counts.get(id_cat) or id_cat in selected_roots
+        ]
+
+    def get_category_navpills(self, lang: str, id_root_cat: int, id_selected_child_cat: int = None) -> List[dict]:
+        rendered = self._rendered_for(lang)
+        navpills = [
+            {
+                'name': rendered[id_root_cat].name,
+                'filterName': 'Category',
+                'filter': 'facets',
+                'isSticky': True,
+                'isSingleSelection': True,
+                'code': 'category',
+                'isSelected': True,
+            }
+        ]
+        for id_child in self.children[id_root_cat]:
+            navpills.append(
+                {
+                    'name': rendered[id_child].name,
+                    'filter': 'category',
+                    'isSingleSelection': True,
+                    'parentCode': rendered[id_root_cat].code,
+                    'code': rendered[id_child].code,
+                    'isSelected': (id_child == id_selected_child_cat),
+                }
+            )
+        return navpills
+
+
+_category_index: CategoryIndex | None = None
+_category_index_lock = threading.Lock()
+
+
+def refresh_category_index() -> CategoryIndex:
+    global _category_index
+    index = CategoryIndex(_get_category_table())
+    _category_index = index
+    return index
+
+
+def get_category_index(cached: bool = True) -> CategoryIndex:
+    index = _category_index
+    if cached and index is not None and not index.is_expired():
+        return index
+    with _category_index_lock:
+        # another thread may have refreshed it while we waited
+        if cached and _category_index is not None and not _category_index.is_expired():
+            return _category_index
+        return refresh_category_index()
 
 
 def get_category_list(cached: bool = True) -> List[Category]:
-    if cached:
-        return _get_category_table_cached()
-    else:
-        return _get_category_table()
+    return list(get_category_index(cached=cached).category_list)
 
 
 def get_code_to_id_category_map(cached: bool = True) -> Dict[str, int]:
-    return {category.code: category.id_category for category in get_category_list(cached=cached)}
+    return get_category_index(cached=cached).code_to_id
 
 
-def get_id_category_to_category_map(cached: bool = True) -> Dict[id, Category]:
-    id_category_to_category_map = {category.id_category: category for category in get_category_list(cached=cached)}
-
-    for id_category, category in id_category_to_category_map.items():
-        category.children = []
-        if category.id_category_parent:
-            id_category_to_category_map[category.id_category_parent].children.append(id_category)
-
-    return id_category_to_category_map
+def get_id_category_to_category_map(cached: bool = True) -> Dict[int, Category]:
+    return get_category_index(cached=cached).categories
 
 
 def get_id_category_to_category_map_for_root_categories(cached: bool = True):
-    id_category_to_category_map = get_id_category_to_category_map(cached)
-    return {
-        id_category: category
-        for id_category, category in id_category_to_category_map.items()
-        if not category.id_category_parent
-    }
+    index = get_category_index(cached=cached)
+    return {id_category: index.categories[id_category] for id_category in index.roots}
 
 
 def get_id_category_to_parent_ids_map(cached: bool = True):
-    rows = {category.id_category: category.id_category_parent for category in get_category_list(cached=cached)}
-    id_category_to_parent_ids_map = {}
-    for id_category in rows.keys():
-        all_parent_ids = []
-        parent_id = rows.get(id_category)
-        while parent_id is not None:
-            all_parent_ids.append(parent_id)
-            parent_id = rows.get(parent_id)
-        id_category_to_parent_ids_map[id_category] = all_parent_ids + [id_category]
-    return id_category_to_parent_ids_map
+    return {id_category: list(ids) for id_category, ids in get_category_index(cached=cached).ancestors.items()}
 
 
 def get_id_categories_for(sku_list):
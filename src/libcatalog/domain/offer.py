@@ -1,9 +1,16 @@
-from typing import List
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict
 from string import Template
 from libcatalog import NotFoundException
 from libcatalog.context import ctx
 from libcatalog.models.offer import OfferPdp, Offer
-from libutil.spanner_util import boilerplate_spanner
+from libutil.async_utils import asyncify
+from libutil.spanner_util import boilerplate_spanner_reader, SPANNER_READ_STALENESS
+
+# spanner client calls are blocking, async read paths run them on this bounded pool instead of the event loop
+SPANNER_READ_THREADS = int(os.getenv('SPANNER_READ_THREADS') or 10)
+spanner_read_threadpool = ThreadPoolExecutor(max_workers=SPANNER_READ_THREADS, thread_name_prefix='spanner-read')
 
 OFFER_QUERY_TEMPLATE = Template('''
         SELECT
@@ -29,22 +36,62 @@ OFFER_QUERY_TEMPLATE = Template('''
     ''')
 
 
-async def get_pdp_offer(sku: str) -> OfferPdp:
-    query = OFFER_QUERY_TEMPLATE.substitute(product_table=f'product_{ctx.lang}')
-    data = boilerplate_spanner().execute_query(query, sku_list=[sku]).dict()
-    if not data:
-        raise NotFoundException("Product not found")
+def _get_offer_rows(sku_list: List[str], lang: str) -> List[Dict]:
+    query = OFFER_QUERY_TEMPLATE.substitute(product_table=f'product_{lang}')
+    return (
+        boilerplate_spanner_reader().execute_query(query, staleness=SPANNER_READ_STALENESS, sku_list=sku_list).dicts()
+    )
 
-    return OfferPdp(data)
 
+def _get_pdp_offer_row(sku: str, lang: str) -> Dict | None:
+    # key reads instead of the offer query, all four in one snapshot so they agree with each other
+    reader = boilerplate_spanner_reader()
+    with reader.snapshot(SPANNER_READ_STALENESS, multi_use=True) as snapshot:
+        product = reader.read('product', ['sku', 'brand_code', 'image_keys'], keys=[sku], snapshot=snapshot).dict()
+        if not product:
+            return None
+        product_lang = reader.read(f'product_{lang}', ['title', 'brand'], keys=[sku], snapshot=snapshot).dict()
+        if not product_lang:
+            return None
+        offers = reader.read(
+            'offer',
+            ['wh_code', 'id_partner', 'msrp', 'offer_price', 'stock_customer_limit'],
+            key_prefixes=[sku],
+            snapshot=snapshot,
+        )
+        stock_map = reader.read('offer_stock', ['wh_code', 'stock_net'], key_prefixes=[sku], snapshot=snapshot).kv_map()
+
+    for offer in offers:
+        stock_net = stock_map.get(offer['wh_code'])
+        if stock_net and stock_net > 0:
+            return {
+                'sku': sku,
+                'id_partner': offer['id_partner'],
+                'title': product_lang['title'],
+                'brand': product_lang['brand'],
+                'brand_code': product['brand_code'],
+                'price': offer['msrp'],
+                'sale_price': offer['offer_price'],
+                'image_keys_json': product['image_keys'],
+                'stock_customer_limit': offer['stock_customer_limit']
+                if offer['stock_customer_limit'] is not None
+                else 10,
+                'stock_net': stock_net,
+            }
+    return None
 
-def get_active_offers(sku_list: List[str], page: int = 1, rows: int = 20) -> List[Offer]:
-    if len(sku_list) == 0:
-        return []
 
-    query = OFFER_QUERY_TEMPLATE.substitute(product_table=f'product_{ctx.lang}')
-    data = boilerplate_spanner().execute_query(query, sku_list=sku_list).dicts()
-    data = sorted(data, key=lambda x: sku_list.index(x["sku"]))
+# ctx is not propagated to executor threads, so the language is resolved by the caller and passed in
+_get_offer_rows_async = asyncify(threadpool=spanner_read_threadpool)(_get_offer_rows)
+_get_pdp_offer_row_async = asyncify(threadpool=spanner_read_threadpool)(_get_pdp_offer_row)
+
+
+def rank_offers(data: List[Dict], sku_list: List[str], page: int, rows: int) -> List[Offer]:
+    # keep solr rank order, a sku appearing more than once (one doc per warehouse) ranks by its first position
+    rank = {}
+    for position, sku in enumerate(sku_list):
+        rank.setdefault(sku, position)
+    data = sorted(data, key=lambda x: rank[x["sku"]])
 
     idx = (page - 1) * rows + 1
     offers = []
@@ -53,3 +100,37 @@ def get_active_offers(sku_list: List[str], page: int = 1, rows: int = 20) -> Lis
         idx += 1
         offers.append(offer)
     return offers
+
+
+async def get_pdp_offer(sku: str) -> OfferPdp:
+    data = await _get_pdp_offer_row_async(sku, ctx.lang)
+    if not data:
+        raise NotFoundException("Product not found")
+
+    return OfferPdp(data)
+
+
+def get_active_offers(sku_list: List[str], page: int = 1, rows: int = 20) -> List[Offer]:
+    if len(sku_list) == 0:
+        return []
+
+    data = _get_offer_rows(sku_list, ctx.lang)
+    return rank_offers(data, sku_list, page, rows)
+
+
+async def get_active_offer_rows_async(sku_list: List[str]) -> List[Dict]:
+    """
+    Offer rows before ranking, for callers that pick which offers to show and then call `rank_offers`.
+    """
+    if len(sku_list) == 0:
+        return []
+
+    return await _get_offer_rows_async(sku_list, ctx.lang)
+
+
+async def get_active_offers_async(sku_list: List[str], page: int = 1, rows: int = 20) -> List[Offer]:
+    if len(sku_list) == 0:
+        return []
+
+    data = await _get_offer_rows_async(sku_list, ctx.lang)
+    return rank_offers(data, sku_list, page, rows)
@@ -1,21 +1,67 @@
+import asyncio
+import base64
+import collections
+import json
 import logging
+import math
 import os
+import random
+import time
+from urllib.parse import quote
 
 from boltons import iterutils
 
-from libcatalog.context import ctx
-from libcatalog.domain.category import get_code_to_id_category_map, get_id_category_to_category_map
-from libcatalog.domain.offer import get_active_offers
+from libcatalog import DomainException
+from libcatalog.context import ctx, Context
+from libcatalog.domain.category import get_category_index
+from libcatalog.domain.offer import get_active_offer_rows_async, rank_offers
 from libcatalog.models.search import SearchQuery, Facet, ProductCarouselResponse, SearchResponse
 from libutil import util
-from libutil.solr_util import BoilerplateSolr, Solr
+from libutil.solr_util import Solr, solr_pool
+from libutil.spanner_util import IS_TESTING
 from libutil.util import guess_language
 from libutil.util import safe_float
 
-SOLR_HOST = os.getenv('SOLR_HOST')
-
 logger = logging.getLogger(__name__)
 
+# search response cache per worker, set SEARCH_CACHE_TTL=0 to turn it off. Entries are dropped once
+# the searcher version of their solr core changes, which every commit of the indexers does, so an index
+# change shows up within SEARCH_INDEX_VERSION_CHECK_SECONDS. The ttls only bound how old the spanner
+# offer data of an entry gets: SEARCH_CACHE_TTL + SEARCH_CACHE_STALE_TTL seconds
+SEARCH_CACHE_SIZE = int(os.getenv('SEARCH_CACHE_SIZE') or 2000)
+SEARCH_CACHE_TTL = float(os.getenv('SEARCH_CACHE_TTL') or (0 if IS_TESTING else 30))
+SEARCH_CACHE_STALE_TTL = float(os.getenv('SEARCH_CACHE_STALE_TTL') or 60)
+SEARCH_INDEX_VERSION_CHECK_SECONDS = float(os.getenv('SEARCH_INDEX_VERSION_CHECK_SECONDS') or 2)
+
+BRAND_FACET_LIMIT = 50
+
+# over-fetch: weight of the latest page in the drop rate average and cap on docs fetched per page row
+SEARCH_DROP_RATE_ALPHA = float(os.getenv('SEARCH_DROP_RATE_ALPHA') or 0.1)
+SEARCH_OVERFETCH_MAX_FACTOR = float(os.getenv('SEARCH_OVERFETCH_MAX_FACTOR') or 2)
+SEARCH_METRICS_PERCENTAGE = 0.1
+
+SEARCH_CURSOR_START = '*'
+# cursorMark needs a total order, object_id is the unique key of the offer cores
+CURSOR_TIEBREAK_SORT = 'object_id asc'
+
+
+def solr_local_params(params: str) -> str:
+    # {!...} prefix of a solr parameter, quoted since params are sent as they are
+    return quote('{!' + params + '}')
+
+
+# filters are tagged so each facet can exclude its own filter and still list the other options
+facet_solr_params = [
+    'facet=true',
+    'facet.mincount=1',
+    f'facet.field={solr_local_params("ex=cat")}cat',
+    'f.cat.facet.limit=-1',
+    f'facet.field={solr_local_params("ex=brand")}brand_code',
+    f'f.brand_code.facet.limit={BRAND_FACET_LIMIT}',
+    'stats=true',
+    f'stats.field={solr_local_params("ex=price")}price',
+]
+
 qf_fields = {
     'en': [
         'sku',
@@ -68,39 +114,282 @@ qf = {
 }
 
 
+_CacheEntry = collections.namedtuple('_CacheEntry', ['value', 'created_at', 'generation'])
+
+
+class SearchCache:
+    """
+    Bounded LRU of search responses.
+
+    An entry is fresh for `ttl` seconds, after that it is still served for `stale_ttl` seconds
+    while one background refresh replaces it. Identical concurrent misses wait on a single load.
+    An entry is only served for the index generation it was loaded in.
+    """
+
+    def __init__(self, maxsize=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL, stale_ttl=SEARCH_CACHE_STALE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.stats = collections.Counter()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.maxsize > 0
+
+    async def get(self, key, load, reload, generation=None):
+        """
+        `load` computes the response for a request waiting on it, `reload` does the same for
+        a background refresh, outside of the request context.
+        """
+        entry = self.entries.get(key)
+        if entry and entry.generation != generation:
+            self.stats['outdated'] += 1
+            self.entries.pop(key, None)
+            entry = None
+        if entry:
+            age = time.monotonic() - entry.created_at
+            if age < self.ttl:
+                self.stats['hit'] += 1
+                self.entries.move_to_end(key)
+                return entry.value
+            if age < self.ttl + self.stale_ttl:
+                self.stats['stale'] += 1
+                self.entries.move_to_end(key)
+                if key not in self.inflight:
+                    asyncio.ensure_future(self._refresh(key, reload, generation))
+                return entry.value
+            self.entries.pop(key, None)
+        self.stats['miss'] += 1
+        return await self._load(key, load, generation)
+
+    async def _load(self, key, load, generation=None):
+        future = self.inflight.get(key)
+        if future is not None and future.get_loop() is asyncio.get_running_loop():
+            self.stats['coalesced'] += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        # nobody may be waiting on a failed load, retrieve the exception so it is not reported as lost
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.inflight[key] = future
+        try:
+            value = await load()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self.set(key, value, generation)
+            future.set_result(value)
+            return value
+        finally:
+            if self.inflight.get(key) is future:
+                del self.inflight[key]
+
+    async def _refresh(self, key, reload, generation=None):
+        try:
+            await self._load(key, reload, generation)
+            self.stats['refresh'] += 1
+        except Exception as e:
+            self.stats['refresh_error'] += 1
+            logger.warning(f"search cache refresh failed for {key}: {e}")
+
+    def set(self, key, value, generation=None):
+        self.entries[key] = _CacheEntry(value=value, created_at=time.monotonic(), generation=generation)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.stats['eviction'] += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.stats.clear()
+
+
+search_cache = SearchCache()
+
+
+class IndexVersions:
+    """
+    Searcher version of each solr core, read from its luke handler at most every `interval` seconds.
+
+    Solr changes the version on every commit, soft ones included, so it tells the api workers that
+    the indexers changed the core without them having to reach the workers. None when it can not be read.
+    """
+
+    def __init__(self, interval=SEARCH_INDEX_VERSION_CHECK_SECONDS):
+        self.interval = interval
+        self.versions = {}
+
+    async def get(self, solr_core):
+        version, checked_at = self.versions.get(solr_core, (None, None))
+        now = time.monotonic()
+        if checked_at is not None and now - checked_at < self.interval:
+            return version
+        if version is not None:
+            # requests arriving while the version is read keep using the current one
+            self.versions[solr_core] = (version, now)
+        try:
+            res = await solr_pool.query(solr_core, params=['numTerms=0', 'show=index'], handler='admin/luke')
+            version = res['index']['version']
+        except Exception as e:
+            logger.warning(f"could not read the index version of {solr_core}: {e}")
+            version = None
+        self.versions[solr_core] = (version, time.monotonic())
+        return version
+
+
+search_index_versions = IndexVersions()
+
+
+def encode_search_cursor(cursor_mark: str, page: int, skip: int = 0, seen: int = 0) -> str:
+    data = json.dumps({'mark': cursor_mark, 'page': page, 'skip': skip, 'seen': seen}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_search_cursor(cursor: str):
+    """
+    Returns the solr cursorMark, the page number the cursor points to, the number of docs after the
+    mark that earlier pages already showed and the number of docs earlier pages went through.
+    """
+    if cursor == SEARCH_CURSOR_START:
+        return SEARCH_CURSOR_START, 1, 0, 0
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return str(data['mark']), int(data['page']), int(data.get('skip', 0)), int(data.get('seen', 0))
+    except Exception:
+        raise DomainException("invalid search cursor")
+
+
+class DropRate:
+    """
+    Moving average of the share of solr docs that come back without a sellable offer
+    (no stock or no spanner row), used to size how many docs a page asks for.
+    """
+
+    def __init__(self, alpha=SEARCH_DROP_RATE_ALPHA, max_factor=SEARCH_OVERFETCH_MAX_FACTOR):
+        self.alpha = alpha
+        self.max_factor = max_factor
+        self.rate = 0.0
+        self.stats = collections.Counter()
+
+    def fetch_rows(self, rows: int) -> int:
+        return math.ceil(rows / max(1 - self.rate, 1 / self.max_factor))
+
+    def observe(self, solr_core: str, fetched: int, dropped: int, backfilled: bool = False):
+        if not fetched:
+            return
+        self.rate += self.alpha * (dropped / fetched - self.rate)
+        self.stats['fetched'] += fetched
+        self.stats['dropped'] += dropped
+        self.stats['backfilled'] += backfilled
+        if random.random() <= SEARCH_METRICS_PERCENTAGE:
+            logger.info(
+                "search-drop-rate",
+                extra={
+                    'solr_core': solr_core,
+                    'fetched': fetched,
+                    'dropped': dropped,
+                    'backfilled': backfilled,
+                    'drop_rate': round(self.rate, 4),
+                },
+            )
+
+
+search_drop_rates = collections.defaultdict(DropRate)
+
+
+def _take_page(docs, offer_rows, rows):
+    # offers of the leading docs until the page holds `rows` offers, a sku is never split across pages.
+    # Also returns how many of the docs the page consumed
+    offers_by_sku = collections.defaultdict(list)
+    for row in offer_rows:
+        offers_by_sku[row['sku']].append(row)
+    page = []
+    consumed = 0
+    for doc in docs:
+        if len(page) >= rows:
+            break
+        page.extend(offers_by_sku.pop(doc['sku'], []))
+        consumed += 1
+    return page, consumed
+
+
+def _next_cursor(windows, position, page_nr, seen, nb_hits):
+    """
+    Cursor of the page after the first `position` docs of the solr `windows`, (res, mark, rows) each
+    in the order they were fetched, with `seen` docs gone through by the pages so far. None when solr
+    has nothing after them.
+    """
+    if seen >= nb_hits:
+        return None
+    for res, mark, _ in windows:
+        window_size = len(res['response']['docs'])
+        if position < window_size:
+            # the page ended inside this window, the next one resumes from its mark and skips what was shown
+            return encode_search_cursor(mark, page_nr + 1, position, seen)
+        position -= window_size
+    res, mark, rows = windows[-1]
+    next_mark = res.get('nextCursorMark')
+    # solr hands back the same mark once there is nothing left
+    if next_mark in (None, mark) or len(res['response']['docs']) < rows:
+        return None
+    return encode_search_cursor(next_mark, page_nr + 1, 0, seen)
+
+
+def _get_facet_counts(facet_fields, field):
+    # solr returns facet counts as a flat [value, count, value, count, ...] list
+    values = facet_fields.get(field) or []
+    return dict(zip(values[::2], values[1::2]))
+
+
+def get_search_cache_stats():
+    return {**search_cache.stats, 'size': len(search_cache.entries)}
+
+
+def get_search_drop_rate_stats():
+    return {
+        solr_core: {**drop_rate.stats, 'drop_rate': round(drop_rate.rate, 4)}
+        for solr_core, drop_rate in search_drop_rates.items()
+    }
+
+
 class SearchReq(util.NoonBaseModel):
     sq: SearchQuery
 
     def get_cat_id_solr_param(self):
+        code_to_id = get_category_index().code_to_id
         id_categories = []
         for code in self.sq.f['category']:
-            id_category = get_code_to_id_category_map().get(code)
+            id_category = code_to_id.get(code)
             if id_category:
                 id_categories.append(id_category)
         cat_id_filter = [f"cat:{id_cat}" for id_cat in id_categories]
         if cat_id_filter:
-            return f'fq={" OR ".join(cat_id_filter)}'
+            return f'fq={solr_local_params("tag=cat")}{" OR ".join(cat_id_filter)}'
         return None
 
     def get_brand_solr_param(self):
         brand_filter = [f"brand_code:{Solr.clean(brand)}" for brand in self.sq.f['brand']]
         if brand_filter:
-            return f'fq={" OR ".join(brand_filter)}'
+            return f'fq={solr_local_params("tag=brand")}{" OR ".join(brand_filter)}'
         return None
 
-    def get_selected_categories_for_navpills(self):
+    def get_selected_categories_for_navpills(self, category_index):
         if self.sq.q:
             return None, None
         if 'category' not in self.sq.f:
             return None, None
-        id_to_category_map = get_id_category_to_category_map()
+        id_to_category_map = category_index.categories
+        code_to_id = category_index.code_to_id
         if len(self.sq.f['category']) == 1:
-            id_cat = get_code_to_id_category_map().get(self.sq.f['category'][0])
+            id_cat = code_to_id.get(self.sq.f['category'][0])
             if id_cat in id_to_category_map and not id_to_category_map[id_cat].id_category_parent:
                 return id_cat, None
         elif len(self.sq.f['category']) == 2:
-            id_cat_0 = get_code_to_id_category_map().get(self.sq.f['category'][0])
-            id_cat_1 = get_code_to_id_category_map().get(self.sq.f['category'][1])
+            id_cat_0 = code_to_id.get(self.sq.f['category'][0])
+            id_cat_1 = code_to_id.get(self.sq.f['category'][1])
             if id_cat_0 not in id_to_category_map or id_cat_1 not in id_to_category_map:
                 return None, None
             if id_to_category_map[id_cat_0].id_category_parent == id_cat_1:
@@ -112,83 +401,111 @@ class SearchReq(util.NoonBaseModel):
                 return id_cat_0, id_cat_1
         return None, None
 
-    def get_quickfilters_navpills_facets(self):
-        facets = []
-        navpills = []
-        id_to_category_map = get_id_category_to_category_map()
-        id_root_cat, id_selected_child_cat = self.get_selected_categories_for_navpills()
+    def get_quickfilters_navpills(self):
+        category_index = get_category_index()
+        id_root_cat, id_selected_child_cat = self.get_selected_categories_for_navpills(category_index)
         if not id_root_cat:
-            return navpills, facets
-        facets.append(
-            Facet(
-                code="category",
-                name="Category",
-                type="category",
-                data=[
-                    {
-                        "name": id_to_category_map[cat].name(lang=ctx.lang),
-                        "code": id_to_category_map[cat].code,
-                        "count": 1,
-                        "children": [
-                            {
-                                "name": id_to_category_map[child_cat].name(lang=ctx.lang),
-                                "code": id_to_category_map[child_cat].code,
-                                "count": 1,
-                                "children": [],
-                                "isSelected": (id_selected_child_cat == child_cat),
-                            }
-                            for child_cat in id_to_category_map
-                            if cat == id_root_cat and id_to_category_map[child_cat].id_category_parent == cat
-                        ],
-                        "isSelected": (id_root_cat == cat),
-                    }
-                    for cat in id_to_category_map
-                    if not id_to_category_map[cat].id_category_parent
-                ],
+            return []
+        return category_index.get_category_navpills(ctx.lang, id_root_cat, id_selected_child_cat)
+
+    def get_facets(self, res, offers):
+        facets = []
+        facet_fields = res.get('facet_counts', {}).get('facet_fields', {})
+
+        category_index = get_category_index()
+        cat_counts = {int(id_cat): count for id_cat, count in _get_facet_counts(facet_fields, 'cat').items()}
+        selected_ids = [
+            category_index.code_to_id[code]
+            for code in self.sq.f.get('category', [])
+            if code in category_index.code_to_id
+        ]
+        category_data = category_index.get_category_facet_data(ctx.lang, cat_counts, selected_ids)
+        if category_data:
+            facets.append(Facet(code="category", name="Category", type="category", data=category_data))
+
+        brand_counts = _get_facet_counts(facet_fields, 'brand_code')
+        selected_brands = set(self.sq.f.get('brand', []))
+        # solr only keeps brand codes, names are taken from the offers on this page when present
+        brand_names = {offer.brand_code: offer.brand for offer in offers if offer.brand}
+        brand_data = [
+            {"name": brand_names.get(code, code), "code": code, "count": count, "isSelected": code in selected_brands}
+            for code, count in brand_counts.items()
+        ]
+        if brand_data:
+            facets.append(Facet(code="brand", name="Brand", type="brand", data=brand_data))
+
+        price_stats = (res.get('stats', {}).get('stats_fields', {}).get('price')) or {}
+        if price_stats.get('count'):
+            facets.append(
+                Facet(
+                    code="price",
+                    name="Price",
+                    type="range",
+                    data={"min": round(price_stats['min'], 2), "max": round(price_stats['max'], 2)},
+                )
             )
+        return facets
+
+    def get_cache_key(self):
+        sort = (self.sq.sort.by, self.sq.sort.dir) if self.sq.sort else None
+        # value order is kept, single valued filters like price_min read the first one
+        filters = tuple(sorted((attr, tuple(map(str, values))) for attr, values in self.sq.f.items()))
+        page_nr = max(self.sq.page, 1) if self.sq.page else 1
+        return (
+            self.sq.q.strip() if self.sq.q else None,
+            sort,
+            filters,
+            page_nr,
+            self.sq.rows,
+            self.sq.cursor,
+            ctx.lang,
+            ctx.country_code.lower(),
+            bool(ctx.is_product_carousel),
         )
-        navpills.append(
-            {
-                'name': id_to_category_map[id_root_cat].name(lang=ctx.lang),
-                'filterName': 'Category',
-                'filter': 'facets',
-                'isSticky': True,
-                'isSingleSelection': True,
-                'code': 'category',
-                'isSelected': True,
-            }
-        )
-        for cat in id_to_category_map:
-            if id_to_category_map[cat].id_category_parent != id_root_cat:
-                continue
-            navpills.append(
-                {
-                    'name': id_to_category_map[cat].name(lang=ctx.lang),
-                    'filter': 'category',
-                    'isSingleSelection': True,
-                    'parentCode': id_to_category_map[id_root_cat].code,
-                    'code': id_to_category_map[cat].code,
-                    'isSelected': (cat == id_selected_child_cat),
-                }
-            )
-        return navpills, facets
 
     async def execute(self):
+        if not search_cache.enabled:
+            return await self.search()
+        generation = await search_index_versions.get(f"offer_{ctx.country_code}".lower())
+        if generation is None:
+            # without the index version a cached response could outlive an index change
+            return await self.search()
+
+        lang, country_code, is_product_carousel = ctx.lang, ctx.country_code, ctx.is_product_carousel
+
+        async def reload():
+            with Context.service(lang=lang, country_code=country_code, is_product_carousel=is_product_carousel):
+                return await SearchReq(sq=self.sq).search()
+
+        response = await search_cache.get(self.get_cache_key(), self.search, reload, generation)
+        if isinstance(response, SearchResponse):
+            # the key is normalized, echo the query as this request sent it
+            response = response.copy(update={'search': self.sq})
+        return response
+
+    async def query_window(self, solr_core, query, params, rows, start=None, cursor_mark=None):
+        params = params + [f'rows={rows}']
+        if cursor_mark is not None:
+            params.append(f'cursorMark={quote(cursor_mark)}')
+        else:
+            params.append(f'start={start}')
+        return await solr_pool.query(solr_core, query=query, params=params)
+
+    async def search(self):
         solr_query_params = []
         query = "*"
-        facets = []
-        navpills = []
         if self.sq.q:
             query = Solr.clean(self.sq.q)
             lang = guess_language(query)
             # add qf only when there is a search query string
             solr_query_params.append(f'qf={qf[lang]}')
 
+        sort = None
         if self.sq.sort and self.sq.sort.by == "price":
             sort_dir = 'asc'
             if self.sq.sort.dir and self.sq.sort.dir == "desc":
                 sort_dir = 'desc'
-            solr_query_params.append(f'sort={self.sq.sort.by} {sort_dir}')
+            sort = f'{self.sq.sort.by} {sort_dir}'
 
         if 'price_min' in self.sq.f or 'price_max' in self.sq.f:
             price_min, price_max = None, None
@@ -200,7 +517,8 @@ class SearchReq(util.NoonBaseModel):
             # if 'price_min' in self.sq.f and 'price_max' in self.sq.f:
             #     self.sq.f['price_max'] = max(self.sq.f['price_min'], self.sq.f['price_max'])
             solr_query_params.append(
-                f"fq=price:[{price_min if price_min else '*'} TO {price_max if price_max else '*'}]"
+                f"fq={solr_local_params('tag=price')}"
+                f"price:[{price_min if price_min else '*'} TO {price_max if price_max else '*'}]"
             )
 
         # category filters could be multiple
@@ -216,33 +534,66 @@ class SearchReq(util.NoonBaseModel):
             if brand_filter:
                 solr_query_params.append(brand_filter)
 
-        page_nr = max(self.sq.page, 1) if self.sq.page else 1
-        solr_query_params.append(f'rows={self.sq.rows}')
-        solr_query_params.append(f'start={(page_nr - 1) * self.sq.rows}')
+        cursor_mark = None
+        start = None
+        skip = seen = 0
+        if self.sq.cursor:
+            # cursor paging costs the same on every page, solr resumes after the last sort values it returned
+            cursor_mark, page_nr, skip, seen = decode_search_cursor(self.sq.cursor)
+            sort = f'{sort or "score desc"},{CURSOR_TIEBREAK_SORT}'
+        else:
+            page_nr = max(self.sq.page, 1) if self.sq.page else 1
+            start = (page_nr - 1) * self.sq.rows
+        if sort:
+            solr_query_params.append(f'sort={sort}')
 
         solr_core = f"offer_{ctx.country_code}".lower()
         # only get sku from the solr result
         solr_query_params.append(f"fl=sku")
-        async with BoilerplateSolr(host=SOLR_HOST, collection=solr_core, port="8983") as solr_offer_core:
-            res = await solr_offer_core.query(query=query, params=solr_query_params)
-            nbHits = int(res['response']['numFound'])
-            nbPages = max((nbHits + self.sq.rows - 1) // self.sq.rows, 1)
-        if not ctx.is_product_carousel and not self.sq.q:
-            quickfilters_navpills, quickfilters_facets = self.get_quickfilters_navpills_facets()
-            navpills.extend(quickfilters_navpills)
-            facets.extend(quickfilters_facets)
-
-        docs = res['response']['docs']
-
-        sku_list = [offer['sku'] for offer in docs]
-        offers = get_active_offers(sku_list, page_nr, self.sq.rows)
-
-        if len(offers) < len(sku_list):
-            offers_sku = {o.sku for o in offers}
-            missing_skus = set(sku_list) - offers_sku
+
+        # page requests show the docs of their own page only and are not over-fetched: page n starts
+        # at doc (n - 1) * rows whatever earlier pages dropped, so a filled page would overlap the next
+        # one and a page with docs lacking a sellable offer comes out short. Cursor requests carry the
+        # docs they consumed forward, so they ask solr for enough docs to still fill the page
+        drop_rate = search_drop_rates[solr_core]
+        fetch_rows = drop_rate.fetch_rows(self.sq.rows) if cursor_mark is not None else self.sq.rows
+        facet_params = facet_solr_params if not ctx.is_product_carousel else []
+        res = await self.query_window(
+            solr_core, query, solr_query_params + facet_params, skip + fetch_rows, start=start, cursor_mark=cursor_mark
+        )
+        nbHits = int(res['response']['numFound'])
+        nbPages = max((nbHits + self.sq.rows - 1) // self.sq.rows, 1)
+
+        # the docs after the mark that the previous cursor page showed are skipped
+        docs = res['response']['docs'][skip:]
+        offer_rows = await get_active_offer_rows_async([doc['sku'] for doc in docs])
+        windows = [(res, cursor_mark, skip + fetch_rows)]
+
+        backfilled = False
+        if cursor_mark is not None and len(offer_rows) < self.sq.rows and len(docs) == fetch_rows:
+            # one backfill round at most, sized for the offers still missing
+            backfill_rows = drop_rate.fetch_rows(self.sq.rows - len(offer_rows))
+            backfill_mark = res.get('nextCursorMark')
+            backfill_res = await self.query_window(
+                solr_core, query, solr_query_params, backfill_rows, cursor_mark=backfill_mark
+            )
+            backfill_docs = backfill_res['response']['docs']
+            docs = docs + backfill_docs
+            offer_rows = offer_rows + await get_active_offer_rows_async([doc['sku'] for doc in backfill_docs])
+            windows.append((backfill_res, backfill_mark, backfill_rows))
+            backfilled = True
+
+        sku_list = [doc['sku'] for doc in docs]
+        missing_skus = set(sku_list) - {row['sku'] for row in offer_rows}
+        if missing_skus:
             logger.warning(f"the following skus found on solr but not on spanner: {missing_skus}")
+        dropped = sum(doc['sku'] in missing_skus for doc in docs)
+        drop_rate.observe(solr_core, fetched=len(docs), dropped=dropped, backfilled=backfilled)
+
+        # the leading docs that fill the page, the offers of the docs after them are left for the next page
+        offer_rows, consumed = _take_page(docs, offer_rows, self.sq.rows)
+        offers = rank_offers(offer_rows, sku_list, page_nr, self.sq.rows)
 
-        # todo: set category facet based on search result
         numPerRow = 3
         results = [
             {
@@ -255,6 +606,11 @@ class SearchReq(util.NoonBaseModel):
         if ctx.is_product_carousel:
             return ProductCarouselResponse(hits=offers)
         else:
+            facets = self.get_facets(res, offers)
+            navpills = self.get_quickfilters_navpills() if not self.sq.q else []
+            next_cursor = None
+            if cursor_mark is not None:
+                next_cursor = _next_cursor(windows, skip + consumed, page_nr, seen + consumed, nbHits)
             return SearchResponse(
                 nbHits=nbHits,
                 nbPages=nbPages,
@@ -263,4 +619,5 @@ class SearchReq(util.NoonBaseModel):
                 navPills=navpills,
                 results=results,
                 type="catalog",
+                nextCursor=next_cursor,
             )
@@ -1,4 +1,3 @@
-import os
 from typing import Any
 from typing import List
 
@@ -6,13 +5,14 @@ from fastapi import Query
 from humps import camelize
 
 from libcatalog.context import ctx
-from libcatalog.domain.offer import get_active_offers
+from libcatalog.domain.autocomplete import get_autocomplete_index, schedule_autocomplete_refresh
+from libcatalog.domain.offer import get_active_offers_async, get_active_offer_rows_async, rank_offers
 from libcatalog.domain.search import qf
 from libutil import util
-from libutil.solr_util import BoilerplateSolr, Solr
+from libutil.solr_util import Solr, solr_pool
 from libutil.util import guess_language
 
-SOLR_HOST = os.getenv('SOLR_HOST')
+SUGGESTION_PRODUCTS = 20
 
 
 class CatalogBaseModel(util.NoonBaseModel):
@@ -42,19 +42,40 @@ class SuggestionResponse(util.NoonBaseModel):
 
 
 async def get_suggestions(sq: SuggestionQuery):
-    solr_query_params = []
     query = Solr.clean(sq.q)
     if len(query) < 3:
         return SuggestionResponse()
+
+    schedule_autocomplete_refresh()
+    index = get_autocomplete_index()
+    if index is None:
+        return await get_solr_suggestions(query)
+
+    # stock changed since the last refresh drops some candidates, a few more than shown are hydrated
+    brands, categories, sku_list = index.lookup(query, ctx.lang, products=SUGGESTION_PRODUCTS * 3)
+    offers = rank_offers(await get_active_offer_rows_async(sku_list), sku_list, 1, SUGGESTION_PRODUCTS)
+    if len(offers) < SUGGESTION_PRODUCTS and len(sku_list) == SUGGESTION_PRODUCTS * 3:
+        # the index had more matches than it returned, solr fills the page instead
+        offers = []
+    if not offers:
+        # long tail prefix, nothing in the index starts with it
+        response = await get_solr_suggestions(query)
+        return response.copy(update={'brands': brands, 'categories': categories})
+    return SuggestionResponse(
+        brands=brands, categories=categories, products=offers[:SUGGESTION_PRODUCTS], searchEngine="autocomplete"
+    )
+
+
+async def get_solr_suggestions(query: str):
+    solr_query_params = []
     lang = guess_language(query)
     solr_core = f"offer_{ctx.country_code}".lower()
     solr_query_params.append(f'qf={qf[lang]}')
-    solr_query_params.append(f'rows=20')
+    solr_query_params.append(f'rows={SUGGESTION_PRODUCTS}')
     solr_query_params.append(f'start=0')
     solr_query_params.append(f"fl=sku")
-    async with BoilerplateSolr(host=SOLR_HOST, collection=solr_core, port="8983") as solr_offer_core:
-        res = await solr_offer_core.query(query=query, params=solr_query_params)
+    res = await solr_pool.query(solr_core, query=query, params=solr_query_params)
     docs = res['response']['docs']
     sku_list = [offer['sku'] for offer in docs]
-    offers = get_active_offers(sku_list)
+    offers = await get_active_offers_async(sku_list)
     return SuggestionResponse(products=offers)
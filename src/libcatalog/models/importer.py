@@ -78,10 +78,10 @@ def import_product_group_code(rows, email=''):
         engine, tables.ProductGroupCode, rows, unique_columns=['sku'], update_columns=['group_code', 'updated_by']
     )
 
-    publisher = pubsub.get_publisher('boilerplate_reindex_sku')
     zskus = miscutil.pluck('sku', rows)
-    for chunk in iterutils.chunked(zskus, 200):
-        publisher(json.dumps(chunk))
+    with pubsub.get_publisher('boilerplate_reindex_sku') as publisher:
+        for chunk in iterutils.chunked(zskus, 200):
+            publisher(json.dumps(chunk))
     logger.info(f"published {zskus} to boilerplate_reindex_sku after group code update")
 
 
@@ -133,10 +133,10 @@ def import_update_zsku_category(rows, email):
             rows_valid,
         )
 
-    publisher = pubsub.get_publisher('boilerplate_reindex_sku')
     zskus = [r['zsku'] for r in zskus]
-    for chunk in iterutils.chunked(zskus, 500):
-        publisher(json.dumps(chunk))
+    with pubsub.get_publisher('boilerplate_reindex_sku') as publisher:
+        for chunk in iterutils.chunked(zskus, 500):
+            publisher(json.dumps(chunk))
 
 
 @register
@@ -270,6 +270,6 @@ def import_category_taxonomy(rows, email):
     )
 
     # publish skus for category sync
-    publisher = pubsub.get_publisher('boilerplate_reindex_sku')
-    for chunk in iterutils.chunked(affected_skus, 500):
-        publisher(json.dumps(chunk))
+    with pubsub.get_publisher('boilerplate_reindex_sku') as publisher:
+        for chunk in iterutils.chunked(affected_skus, 500):
+            publisher(json.dumps(chunk))
@@ -25,6 +25,8 @@ class SearchQuery(CatalogBaseModel):
     f: Dict[str, List[str]] = {}
     page: int | None = 1
     rows: int | None = 21
+    # opaque cursor for infinite scroll, "*" starts from the first page and each response returns the next one
+    cursor: str | None = None
 
     @validator("f", pre=True)
     def validate_f(cls, v):
@@ -70,6 +72,8 @@ class SearchResponse(util.NoonBaseModel):
     results: List[Any]
     # hits is not used, this is added as a request from FE to keep structure same as noon etc
     hits: List[Any] = []
+    # only set for cursor requests, missing once the last page is reached
+    nextCursor: str | None = None
 
 
 class ProductCarouselResponse(util.NoonBaseModel):
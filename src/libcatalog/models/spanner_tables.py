@@ -7,6 +7,12 @@ from libutil.spanner_util import SpannerBaseModel
 
 _Type = namedtuple('_Type', ['type', 'default', 'null'])
 
+# (table, column, ddl) of the columns added to the boilerplate database after it was created, in order.
+# `python -m appindexing.cli spanner migrate` runs the ddl of the columns the database is missing
+BOILERPLATE_SPANNER_MIGRATIONS = [
+    ('product', 'content_hash', 'ALTER TABLE product ADD COLUMN content_hash STRING(64)'),
+]
+
 
 def _datetime(dt):
     if isinstance(dt, str):
@@ -38,6 +44,7 @@ class Product(SpannerBaseModel):
     is_bulky = _Type(bool, False, False)
     is_active = _Type(bool, True, True)
     created_at = _Type(_datetime, None, None)
+    content_hash = _Type(str, None, None)
     updated_at = _Type(_datetime, spanner.COMMIT_TIMESTAMP, spanner.COMMIT_TIMESTAMP)
 
 
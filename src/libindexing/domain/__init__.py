@@ -1 +1 @@
-from . import offer, price, stock, product, solr
+from . import noon_cache, offer, price, stock, product, product_transform, psku, solr, solr_rebuild
@@ -0,0 +1,125 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+from libutil.spanner_util import noon_cache_spanner
+
+logger = logging.getLogger(__name__)
+
+NOON_CACHE_PRODUCT_KEYS_REBUILD_SECONDS = int(os.getenv('NOON_CACHE_PRODUCT_KEYS_REBUILD_SECONDS') or 60 * 60 * 6)
+# products may be added to noon cache any time, skus confirmed missing are not trusted for long
+NOON_CACHE_ABSENT_TTL_SECONDS = int(os.getenv('NOON_CACHE_ABSENT_TTL_SECONDS') or 60)
+NOON_CACHE_ABSENT_MAX_SIZE = int(os.getenv('NOON_CACHE_ABSENT_MAX_SIZE') or 100000)
+
+
+def _read_product_skus(skus=None):
+    if skus is None:
+        return set(noon_cache_spanner().execute_query('''SELECT sku FROM product''').scalars())
+    return set(
+        noon_cache_spanner()
+        .execute_query('''SELECT sku FROM product WHERE sku IN UNNEST(@sku_list)''', sku_list=list(skus))
+        .scalars()
+    )
+
+
+class ProductKeySet:
+    """
+    In-memory set of the product skus of noon cache spanner.
+
+    Skus in the set are taken as existing without a read. Skus not in it are confirmed with one
+    read, the ones found are added to the set and the missing ones are remembered for a short
+    while. The set is rebuilt from a full scan in a background thread every `rebuild_interval`,
+    which also drops deleted products. Until the first build is done every sku is confirmed.
+    """
+
+    def __init__(
+        self,
+        read=_read_product_skus,
+        rebuild_interval=NOON_CACHE_PRODUCT_KEYS_REBUILD_SECONDS,
+        absent_ttl=NOON_CACHE_ABSENT_TTL_SECONDS,
+        absent_max_size=NOON_CACHE_ABSENT_MAX_SIZE,
+    ):
+        self.read = read
+        self.rebuild_interval = rebuild_interval
+        self.absent_ttl = absent_ttl
+        self.absent_max_size = absent_max_size
+        self.lock = threading.Lock()
+        self.keys = None
+        # sku: expires_at of the skus confirmed missing
+        self.absent = {}
+        self.built_at = None
+        self.next_build_at = 0
+        self.building = None
+        self.stats = Counter()
+
+    def _maybe_rebuild(self):
+        # called with the lock held
+        if self.building is not None and self.building.is_alive():
+            return
+        if time.monotonic() < self.next_build_at:
+            return
+        self.building = threading.Thread(target=self.rebuild, name='noon-cache-product-keys', daemon=True)
+        self.building.start()
+
+    def rebuild(self):
+        started = time.monotonic()
+        try:
+            keys = self.read()
+        except Exception as e:
+            logger.exception(f"noon cache product keys rebuild failed: {e}")
+            with self.lock:
+                # lookups keep confirming meanwhile
+                self.next_build_at = time.monotonic() + self.absent_ttl
+            return
+        with self.lock:
+            self.keys, self.absent, self.built_at = keys, {}, time.monotonic()
+            self.next_build_at = self.built_at + self.rebuild_interval
+            self.stats['rebuilds'] += 1
+        logger.info(f"noon cache product keys rebuilt: {len(keys)} skus in {time.monotonic() - started:.1f}s")
+
+    def existing(self, skus):
+        """
+        The skus that are products in noon cache.
+        """
+        skus = set(skus)
+        if not skus:
+            return set()
+        now = time.monotonic()
+        with self.lock:
+            self._maybe_rebuild()
+            known = self.keys or set()
+            found = skus & known
+            to_confirm = [sku for sku in skus - found if self.absent.get(sku, 0) <= now]
+            self.stats['hits'] += len(found)
+            self.stats['absent_hits'] += len(skus) - len(found) - len(to_confirm)
+        if not to_confirm:
+            return found
+
+        confirmed = self.read(to_confirm)
+        now = time.monotonic()
+        with self.lock:
+            self.stats['reads'] += 1
+            self.stats['confirmed'] += len(to_confirm)
+            if self.keys is not None:
+                self.keys |= confirmed
+            if len(self.absent) >= self.absent_max_size:
+                self.absent = {sku: expires_at for sku, expires_at in self.absent.items() if expires_at > now}
+                if len(self.absent) >= self.absent_max_size:
+                    self.absent = {}
+            for sku in to_confirm:
+                if sku not in confirmed:
+                    self.absent[sku] = now + self.absent_ttl
+        return found | confirmed
+
+    def metrics(self):
+        return {
+            'size': len(self.keys) if self.keys is not None else None,
+            'absent': len(self.absent),
+            'built_seconds_ago': int(time.monotonic() - self.built_at) if self.built_at is not None else None,
+            **self.stats,
+        }
+
+
+noon_cache_product_keys = ProductKeySet()
@@ -1,4 +1,4 @@
-from libutil.spanner_util import boilerplate_spanner
+from libutil.spanner_util import boilerplate_spanner, boilerplate_spanner_reader
 
 
 def get_product_and_offer_details_for(sku_wh_code_list):
@@ -41,6 +41,29 @@ def get_product_and_offer_details_for(sku_wh_code_list):
                                            key_order={"sku_wh_code": ("sku", "wh_code")}).dicts()
 
 
+def get_in_stock_offer_keys(sku_wh_code_list):
+    """
+    (sku, wh_code) of the given offers that are in stock with their product rows, as indexed in solr.
+    """
+    if not sku_wh_code_list:
+        return set()
+    query = '''
+        SELECT o.sku, o.wh_code
+        FROM offer o
+        JOIN offer_stock os ON (o.sku = os.sku AND o.wh_code = os.wh_code)
+        JOIN product p ON p.sku = o.sku
+        JOIN product_en pen ON pen.sku = o.sku
+        JOIN product_ar par ON par.sku = o.sku
+        WHERE
+           STRUCT <sku STRING,wh_code STRING> (o.sku, o.wh_code) in UNNEST(@sku_wh_code)
+           AND os.stock_net > 0
+    '''
+    rows = boilerplate_spanner_reader().execute_query(
+        query, sku_wh_code=list(sku_wh_code_list), key_order={"sku_wh_code": ("sku", "wh_code")}
+    )
+    return {(row['sku'], row['wh_code']) for row in rows}
+
+
 def get_in_stock_offers(sku_list):
     in_stock_offers_query = f'''
         SELECT
@@ -78,3 +101,81 @@ def get_in_stock_offers(sku_list):
            AND os.stock_net > 0
     '''
     return boilerplate_spanner().execute_query(in_stock_offers_query, sku_list=sku_list).dicts()
+
+
+def get_offer_stock_map(sku_wh_code_list):
+    """
+    {(sku, wh_code): stock_net} of the given offers, read by primary key.
+    """
+    if not sku_wh_code_list:
+        return {}
+    rows = boilerplate_spanner_reader().read('offer_stock', ['sku', 'wh_code', 'stock_net'], keys=sku_wh_code_list)
+    return {(row['sku'], row['wh_code']): row['stock_net'] for row in rows}
+
+
+def get_in_stock_offer_page(country_code, after_sku='', after_wh_code='', limit=5000):
+    """
+    In stock offers of a country with their product details, in (sku, wh_code) order after the given key.
+    """
+    query = '''
+        SELECT
+           p.sku,
+           p.sku_config,
+           o.wh_code,
+           o.country_code,
+           o.offer_price,
+           par.title as title_ar,
+           pen.title as title_en,
+           pen.meta_keywords as meta_keywords_en,
+           par.meta_keywords as meta_keywords_ar,
+           par.brand as ar_brand,
+           pen.brand as en_brand,
+           p.category_ids,
+           p.brand_code as brand_code,
+           os.stock_net,
+           p.family_code,
+           p.is_active,
+           p.attributes,
+           p.group_code
+        FROM offer o
+        JOIN offer_stock os ON (o.sku = os.sku AND o.wh_code = os.wh_code)
+        JOIN product p ON p.sku = o.sku
+        JOIN product_en pen ON pen.sku = o.sku
+        JOIN product_ar par ON par.sku = o.sku
+        WHERE o.country_code = @country_code
+        AND os.stock_net > 0
+        AND (o.sku > @after_sku OR (o.sku = @after_sku AND o.wh_code > @after_wh_code))
+        ORDER BY o.sku, o.wh_code
+        LIMIT @limit
+    '''
+    return (
+        boilerplate_spanner_reader()
+        .execute_query(
+            query, country_code=country_code.upper(), after_sku=after_sku, after_wh_code=after_wh_code, limit=limit
+        )
+        .dicts()
+    )
+
+
+def get_offers_changed_since(country_code, since):
+    """
+    (sku, wh_code) of the offers of a country whose offer, stock or product rows changed since `since`.
+    """
+    query = '''
+        SELECT o.sku, o.wh_code
+        FROM offer o
+        LEFT JOIN offer_stock os ON (o.sku = os.sku AND o.wh_code = os.wh_code)
+        LEFT JOIN product p ON p.sku = o.sku
+        LEFT JOIN product_en pen ON pen.sku = o.sku
+        LEFT JOIN product_ar par ON par.sku = o.sku
+        WHERE o.country_code = @country_code
+        AND (
+            o.updated_at >= @since
+            OR os.updated_at >= @since
+            OR p.updated_at >= @since
+            OR pen.updated_at >= @since
+            OR par.updated_at >= @since
+        )
+    '''
+    rows = boilerplate_spanner_reader().execute_query(query, country_code=country_code.upper(), since=since)
+    return [(row['sku'], row['wh_code']) for row in rows]
@@ -1,11 +1,18 @@
+import os
+
 from jsql import sql
 
 from libcatalog.models.spanner_tables import Offer
-from libindexing import engine_offer, engine_noon_cache
+from libindexing import engine_offer
 from libindexing.domain.product import get_product_details_for, fetch_and_update_product_details
+from libindexing.domain.psku import get_zsku_nsku_list
 from libindexing.domain.solr import reindex_in_solr
+from libindexing.domain.stock import StockUpdateBatcher
 from libutil.spanner_util import boilerplate_spanner
 
+PRICE_BATCH_MAX_SIZE = int(os.getenv('PRICE_BATCH_MAX_SIZE') or 2000)
+PRICE_BATCH_MAX_WAIT_SECONDS = float(os.getenv('PRICE_BATCH_MAX_WAIT_SECONDS') or 1)
+
 
 def reindex_price(sku_wh_code_list):
     offers = sql(
@@ -36,15 +43,7 @@ def reindex_price(sku_wh_code_list):
 
     missing_skus = [sku for sku in skus if sku not in product_details]
 
-    missing_sku_nsku_list = sql(
-        engine_noon_cache,
-        '''
-        SELECT zsku_child as sku, nsku_child as nsku
-        FROM psku.psku
-        WHERE zsku_child IN :sku_list
-    ''',
-        sku_list=missing_skus,
-    ).dicts()
+    missing_sku_nsku_list = get_zsku_nsku_list(missing_skus)
 
     processed_zskus = []
     if missing_sku_nsku_list:
@@ -54,4 +53,17 @@ def reindex_price(sku_wh_code_list):
 
     if valid_rows:
         Offer.upsert(boilerplate_spanner(), 'offer', valid_rows)
+        # the whole document is rebuilt: the text fields of the offer core are neither stored nor docValues,
+        # an atomic price update would drop them from the document
         reindex_in_solr([(offer['sku'], offer['wh_code']) for offer in valid_rows])
+
+
+# price messages of a short window are reindexed together, the prices are read from mysql at reindex time,
+# so an offer updated by several messages costs one spanner join and one solr document
+price_update_batcher = StockUpdateBatcher(
+    max_size=PRICE_BATCH_MAX_SIZE,
+    max_wait=PRICE_BATCH_MAX_WAIT_SECONDS,
+    process=reindex_price,
+    key=tuple,
+    name='price update',
+)
@@ -1,239 +1,210 @@
+import collections
 import json
 import logging
+import os
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
+import requests
 from boltons import iterutils
 from noonhelpers.v1 import auth_team
 
 from libcatalog.domain.category import *
 from libcatalog.models.spanner_tables import Product, ProductLang
-from libindexing import engine_noon_cache
+from libindexing.domain.product_transform import ProductBatchTransform, get_image_keys
+from libindexing.domain.psku import get_nsku_zsku_map, get_zsku_nsku_map
 from libindexing.domain.solr import reindex_product_update_in_solr
-from libutil.spanner_util import boilerplate_spanner
+from libutil import pubsub
+from libutil.spanner_util import boilerplate_spanner, boilerplate_spanner_reader, upsert_tables
 
 
 logger = logging.getLogger(__name__)
 
 
-def fetch_zsku_details(sku_list):
-    if not sku_list:
-        return {}
-    dict_res = {}
-    for sku_list_chunk in iterutils.chunked(sku_list, 100):
-        body = {"skus": sku_list_chunk, "country": "ae", "catalog": "zsku", "marketplace": "noon"}
-        headers = {'Content-Type': 'application/json'}
-        zsku_api_url = auth_team.get_service_url('ct', 'team-zcatalog-api-marketplace')
-        url = f'{zsku_api_url}/sku/retrieve/'
+# catalog apis: chunks in flight per process, ids per request, smallest chunk a failing one is split into
+CATALOG_FETCH_CONCURRENCY = int(os.getenv('CATALOG_FETCH_CONCURRENCY') or 8)
+CATALOG_FETCH_CHUNK_SIZE = int(os.getenv('CATALOG_FETCH_CHUNK_SIZE') or 100)
+CATALOG_FETCH_MIN_CHUNK_SIZE = int(os.getenv('CATALOG_FETCH_MIN_CHUNK_SIZE') or 10)
+CATALOG_FETCH_ATTEMPTS = int(os.getenv('CATALOG_FETCH_ATTEMPTS') or 3)
+CATALOG_FETCH_BACKOFF_SECONDS = float(os.getenv('CATALOG_FETCH_BACKOFF_SECONDS') or 0.5)
+# zskus whose details could not be fetched are published for reindexing again, at most this many times
+CATALOG_FETCH_REPUBLISH_LIMIT = int(os.getenv('CATALOG_FETCH_REPUBLISH_LIMIT') or 5)
+
+catalog_fetch_threadpool = ThreadPoolExecutor(max_workers=CATALOG_FETCH_CONCURRENCY, thread_name_prefix='catalog-fetch')
+
+
+class FetchResult(dict):
+    """
+    Details by id, `failed` holds the ids that could not be fetched so the caller can retry them later.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failed = []
+
+
+def _is_payload_error(error):
+    # the request itself was rejected: sent again as is it fails again, a smaller one may not
+    if isinstance(error, requests.HTTPError):
+        status_code = error.response.status_code if error.response is not None else None
+        return status_code is not None and 400 <= status_code < 500 and status_code != 429
+    return isinstance(error, ValueError)
+
+
+def _post_with_retries(url, body, headers, timeout):
+    for attempt in range(1, CATALOG_FETCH_ATTEMPTS + 1):
+        try:
+            response = auth_team.auth_post(url, timeout=timeout, payload=body, headers=headers)
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            if attempt == CATALOG_FETCH_ATTEMPTS or _is_payload_error(e):
+                raise
+            # full jitter, so chunks failing together do not retry together
+            time.sleep(random.uniform(0, CATALOG_FETCH_BACKOFF_SECONDS * 2 ** attempt))
+
+
+def fetch_in_chunks(ids, fetch_chunk, chunk_size=None, min_chunk_size=None) -> FetchResult:
+    """
+    Runs `fetch_chunk(chunk) -> dict` over chunks of `ids` on the catalog fetch pool.
+
+    A chunk rejected for its payload (a 4xx response or a body that does not parse) is split in halves,
+    down to `min_chunk_size`, so one bad id or an oversized payload does not take its neighbours down.
+    Transport and 5xx errors fail the whole chunk at once, smaller requests would not fare better. The
+    ids of the chunks that fail are reported in `failed`.
+    """
+    chunk_size = chunk_size or CATALOG_FETCH_CHUNK_SIZE
+    min_chunk_size = min_chunk_size or CATALOG_FETCH_MIN_CHUNK_SIZE
+    result = FetchResult()
+
+    def run(chunk):
         try:
-            ret = auth_team.auth_post(url, timeout=40, payload=body, headers=headers).json()
-            dict_res.update(ret)
-        except Exception as ex:
-            logger.warning(f"error getting zsku details for: {sku_list} - {ex}")
-            continue
-    return dict_res
+            return chunk, fetch_chunk(chunk), None
+        except Exception as e:
+            return chunk, None, e
+
+    pending = {catalog_fetch_threadpool.submit(run, chunk) for chunk in iterutils.chunked(ids, chunk_size)}
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            chunk, data, error = future.result()
+            if error is None:
+                result.update(data)
+            elif len(chunk) > min_chunk_size and _is_payload_error(error):
+                half = (len(chunk) + 1) // 2
+                pending |= {catalog_fetch_threadpool.submit(run, part) for part in (chunk[:half], chunk[half:])}
+            else:
+                logger.warning(f"error fetching {chunk}: {error}")
+                result.failed.extend(chunk)
+    return result
+
+
+def _fetch_zsku_chunk(sku_list_chunk):
+    body = {"skus": sku_list_chunk, "country": "ae", "catalog": "zsku", "marketplace": "noon"}
+    headers = {'Content-Type': 'application/json'}
+    zsku_api_url = auth_team.get_service_url('ct', 'team-zcatalog-api-marketplace')
+    return _post_with_retries(f'{zsku_api_url}/sku/retrieve/', body, headers, timeout=40)
+
+
+def _fetch_nsku_chunk(nsku_list_chunk):
+    body = {'ids_product': nsku_list_chunk, 'selectable_columns': []}
+    headers = {'Content-Type': 'application/json', 'x-not-csrf': "true", 'Accept': 'application/json'}
+    wecat_api_url = auth_team.get_service_url('ct', 'wecat-api')
+    return _post_with_retries(f'{wecat_api_url}/api/get-products-info/', body, headers, timeout=50)
+
+
+def fetch_zsku_details(sku_list) -> FetchResult:
+    if not sku_list:
+        return FetchResult()
+    return fetch_in_chunks(sku_list, _fetch_zsku_chunk)
 
 
-def fetch_nsku_details(nsku_list):
+def fetch_nsku_details(nsku_list) -> FetchResult:
     if not nsku_list:
+        return FetchResult()
+    return fetch_in_chunks(nsku_list, _fetch_nsku_chunk)
+
+
+class ProcessedProducts(list):
+    """
+    Zskus whose product details were fetched and are up to date in spanner. `changed` holds the ones
+    whose rows were actually written, `failed` those whose details could not be fetched.
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.changed = []
+        self.failed = []
+
+
+# products fetched, written because their content changed, and skipped because it did not
+product_change_stats = collections.Counter()
+
+
+def get_product_content_hashes(sku_list):
+    if not sku_list:
         return {}
-    dict_res = {}
-    for nsku_list_chunk in iterutils.chunked(nsku_list, 100):
-
-        body = {'ids_product': nsku_list_chunk, 'selectable_columns': []}
-        headers = {'Content-Type': 'application/json', 'x-not-csrf': "true", 'Accept': 'application/json'}
-        wecat_api_url = auth_team.get_service_url('ct', 'wecat-api')
-        # wecat_api_url = "https://wecat-api.ct.noonstg.team"
-        url = f'{wecat_api_url}/api/get-products-info/'
-        try:
-            nsku_details = auth_team.auth_post(url, payload=body, headers=headers, timeout=50).json()
-            dict_res.update(nsku_details)
-        except Exception as e:
-            logger.warning(f"exception getting nsku_details: {e}")
-            continue
-    return dict_res
+    return boilerplate_spanner_reader().read('product', ['sku', 'content_hash'], keys=sku_list).kv_map()
 
 
-def fetch_and_update_product_details(list_products, only_zsku=False, only_nsku=False):
+def fetch_and_update_product_details(list_products, only_zsku=False, only_nsku=False) -> ProcessedProducts:
     if not list_products:
-        return
+        return ProcessedProducts()
     zsku_list = [product['sku'] for product in list_products if product['sku']]
-    sku_id_cat_list = get_id_categories_for(zsku_list)
-    sku_group_code_map = get_sku_group_code_map_for(zsku_list)
-    id_category_to_parent_ids_map = get_id_category_to_parent_ids_map(cached=False)
-    product_rows = []
-    product_en_rows = []
-    product_ar_rows = []
-    processed_zskus_list = []
+    batch = ProductBatchTransform(
+        get_id_categories_for(zsku_list), get_sku_group_code_map_for(zsku_list), get_category_index(cached=False)
+    )
+    failed_zskus = set()
     if not only_nsku:
         ret = fetch_zsku_details(zsku_list)
+        failed_zskus.update(getattr(ret, 'failed', []))
         for sku, data in ret.items():
-            if data.get("error"):
-                continue
-            product_row = {"sku": sku, "sku_config": sku}
-            product_row['family_code'] = data['attributes'].get('family', [{}])[0].get('data')
-            product_row['brand_code'] = data['attributes'].get('brand', [{}])[0].get('data')
-            model_number = data['attributes'].get('model_number', [{}])[0].get('data', '')
-            model_name = data['attributes'].get('model_name', [{}])[0].get('data', '')
-            product_row['model_name_number'] = model_name + " " + model_number
-            product_row['category_ids'] = ''
-            product_row['group_code'] = sku_group_code_map.get(sku, '')
-            id_cat_list = [row['id_category'] for row in sku_id_cat_list if row['sku'] == sku]
-            if id_cat_list:
-                parent_ids = [
-                    str(parent_id) for id_cat in id_cat_list for parent_id in id_category_to_parent_ids_map.get(id_cat)
-                ]
-                parent_ids = list(set(parent_ids))  # get unique elements
-                product_row['category_ids'] = ",".join(parent_ids)
-            images = data['attributes'].get('image_url', [])
-            image_storage_paths = list(map(lambda x: x.get('storage_path'), images))
-            image_keys = list(
-                map(lambda x: x.replace(".jpg", ""), filter(lambda x: x and x != "", image_storage_paths))
-            )
-            if image_keys:
-                product_row['image_keys'] = json.dumps(image_keys)
-            if not product_row.get('image_keys') or product_row.get('image_keys') == '':
-                logger.error(f"couldn't extract image_keys from zsku product api of zsku: {sku}")
-            product_en_row = {"sku": sku}
-            product_ar_row = {"sku": sku}
-
-            for brand in data['attributes']['brand']:
-                if brand['locale'] == 'ar':
-                    product_ar_row['brand'] = brand['option_name']
-                if brand['locale'] == 'en':
-                    product_en_row['brand'] = brand['option_name']
-
-            for title in data['attributes']['product_title']:
-                if title['locale'] == 'ar':
-                    product_ar_row['title'] = title['data']
-
-                if title['locale'] == 'en':
-                    product_en_row['title'] = title['data']
-
-            en_attributes = {}
-            ar_attributes = {}
-            long_desc = data['attributes'].get('long_description')
-            if long_desc:
-                for entry in long_desc:
-                    if entry['locale'] == 'en':
-                        en_attributes['long_desc'] = entry['data']
-                    elif entry['locale'] == 'ar':
-                        ar_attributes['long_desc'] = entry['data']
-
-            product_en_row["attributes"] = json.dumps(en_attributes)
-            product_ar_row["attributes"] = json.dumps(ar_attributes)
-
-            title_suffixes = data['attributes'].get('title_suffix', [])
-            for suffix in title_suffixes:
-                if suffix['locale'] == 'ar':
-                    product_ar_row['title_suffix'] = suffix['data']
-                if suffix['locale'] == 'en':
-                    product_en_row['title_suffix'] = suffix['data']
-            processed_zskus_list.append(sku)
-            product_rows.append(product_row)
-            product_en_rows.append(product_en_row)
-            product_ar_rows.append(product_ar_row)
+            batch.add_zsku(sku, data)
 
     if not only_zsku:
         nsku_zsku_map = {
             product['nsku']: product['sku']
             for product in list_products
-            if product['nsku'] and product['sku'] and product['sku'] not in processed_zskus_list
+            if product['nsku'] and product['sku'] and product['sku'] not in batch.sku_set
         }
         nsku_list = list(nsku_zsku_map.keys())
         if nsku_list:
             result = fetch_nsku_details(nsku_list)
-            for nsku in result:
-                zsku = nsku_zsku_map.get(nsku)
-                nsku_details = result[nsku]
-                titles = nsku_details.get("attributes", {}).get("product_full_title", [])
-                en_title, ar_title = None, None
-                for title in titles:
-                    if title.get("locale") == "en":
-                        en_title = title["value"]
-                    elif title.get("locale") == "ar":
-                        ar_title = title["value"]
-
-                brand_code, en_brand, ar_brand = None, None, None
-                brand_info = nsku_details.get("fundamental_attributes", {}).get("brand", [])
-                for brand in brand_info:
-                    brand_code = brand.get("code")
-                    if brand.get("locale") == "en":
-                        en_brand = brand["value"]
-                    elif brand.get("locale") == "ar":
-                        ar_brand = brand["value"]
-
-                family_code = None
-                family_info = nsku_details.get("fundamental_attributes", {}).get("family", [])
-                for family in family_info:
-                    family_code = family.get("code")
-                    break
-
-                id_product_fulltype = None
-                fulltype_info = nsku_details.get("fundamental_attributes", {}).get("product_fulltype", [])
-                for fulltype in fulltype_info:
-                    id_product_fulltype = fulltype.get("id")
-
-                en_title_suffix, ar_title_suffix = None, None
-                suffix_info = nsku_details.get("attributes", {}).get("product_full_title", [])
-                for suffix in suffix_info:
-                    if suffix.get("locale") == "en":
-                        en_title_suffix = suffix.get("value")
-                    if suffix.get("locale") == "ar":
-                        ar_title_suffix = suffix.get("value")
-
-                image_keys = get_image_keys(nsku_details)
-
-                if not (en_title and ar_title and id_product_fulltype and family_code and brand_code):
-                    logger.warning(f"some mandatory attributes missing for nsku, zsku: {nsku}:{zsku}")
-                    continue
-                product_row = {
-                    "sku": zsku,
-                    "sku_config": zsku,
-                    "brand_code": brand_code,
-                    "id_product_fulltype": id_product_fulltype,
-                    "family_code": family_code,
-                }
-                product_en_row = {"sku": zsku, "title": en_title, "title_suffix": en_title_suffix, "brand": en_brand}
-                product_ar_row = {"sku": zsku, "title": ar_title, "title_suffix": ar_title_suffix, "brand": ar_brand}
-                if image_keys:
-                    product_row['image_keys'] = json.dumps(image_keys)
-                if not product_row.get('image_keys') or product_row.get('image_keys') == '':
-                    logger.error(f"couldn't extract image_keys from nsku product api of zsku: {zsku}")
-                id_cat_list = [row['id_category'] for row in sku_id_cat_list if row['sku'] == zsku]
-                product_row['category_ids'] = ''
-                product_row['group_code'] = sku_group_code_map.get(zsku, '')
-                if id_cat_list:
-                    parent_ids = [
-                        str(parent_id)
-                        for id_cat in id_cat_list
-                        for parent_id in id_category_to_parent_ids_map.get(id_cat)
-                    ]
-                    parent_ids = list(set(parent_ids))  # get unique elements
-                    product_row['category_ids'] = ",".join(parent_ids)
-                product_rows.append(product_row)
-                product_en_rows.append(product_en_row)
-                product_ar_rows.append(product_ar_row)
-                processed_zskus_list.append(zsku)
-    if product_rows:
-        Product.upsert(boilerplate_spanner(), 'product', product_rows)
-    if product_en_rows:
-        ProductLang.upsert(boilerplate_spanner(), 'product_en', product_en_rows)
-    if product_ar_rows:
-        ProductLang.upsert(boilerplate_spanner(), 'product_ar', product_ar_rows)
-    return processed_zskus_list
-
-
-def get_image_keys(data):
-    keys = []
-    for key in data['attributes']:
-        if key.startswith("image_url_"):
-            image_info = data['attributes'][key]
-            for img in image_info:
-                if img["meta"]["is_visible"]:
-                    meta_data = img['meta']
-                    img_url = "v{0}/{1}".format(meta_data['version'], meta_data['public_id'])
-                    keys.append({'is_visible': True, 'storage_path': img_url, 'sort_key': meta_data['sort_key']})
-    keys = sorted(keys, key=lambda k: k['sort_key'])
-    return [key["storage_path"] for key in keys]
+            failed_zskus.update(nsku_zsku_map[nsku] for nsku in getattr(result, 'failed', []))
+            for nsku, nsku_details in result.items():
+                batch.add_nsku(nsku_zsku_map.get(nsku), nsku, nsku_details)
+
+    # rows whose content is what spanner already has are neither written nor reindexed
+    content_hashes = get_product_content_hashes(batch.skus)
+    changed = [
+        i
+        for i, product_row in enumerate(batch.product_rows)
+        if content_hashes.get(product_row['sku']) != product_row['content_hash']
+    ]
+    if changed:
+        # a product and its two language rows are written in the same commit
+        upsert_tables(
+            boilerplate_spanner(),
+            [
+                (Product, 'product', [batch.product_rows[i] for i in changed]),
+                (ProductLang, 'product_en', [batch.product_en_rows[i] for i in changed]),
+                (ProductLang, 'product_ar', [batch.product_ar_rows[i] for i in changed]),
+            ],
+        )
+    processed = ProcessedProducts(batch.skus)
+    processed.changed = [batch.skus[i] for i in changed]
+    product_change_stats.update(
+        {'fetched': len(batch.skus), 'changed': len(changed), 'skipped': len(batch.skus) - len(changed)}
+    )
+    logger.info(
+        "product-change-detection",
+        extra={'fetched': len(batch.skus), 'changed': len(changed), 'skipped': len(batch.skus) - len(changed)},
+    )
+    processed.failed = sorted(failed_zskus.difference(batch.sku_set))
+    if processed.failed:
+        logger.warning(f"could not fetch product details of {len(processed.failed)} zskus: {processed.failed[0:100]}")
+    return processed
 
 
 def get_product_details_for(sku_list):
@@ -258,19 +229,27 @@ def get_product_details_for(sku_list):
     return boilerplate_spanner().execute_query(query, sku_list=sku_list).pk_map()
 
 
-def update_zsku_product_details(sku_list):
+def _republish_failed_zskus(zsku_list, attempt):
+    if attempt >= CATALOG_FETCH_REPUBLISH_LIMIT:
+        logger.error(
+            f"giving up on product details of {len(zsku_list)} zskus after {attempt} retries: {zsku_list[0:100]}"
+        )
+        return
+    # only the failed zskus go around again, the message they came in is acked
+    with pubsub.get_publisher('boilerplate_reindex_sku') as publisher:
+        for chunk in iterutils.chunked(zsku_list, 200):
+            publisher(json.dumps(chunk), catalog_fetch_attempt=str(attempt + 1))
+
+
+def update_zsku_product_details(sku_list, attempt=0, force=False):
+    """
+    `attempt` counts the times the zskus were published again because their details could not be fetched.
+    With `force` every fetched zsku is reindexed in solr, also the ones whose content did not change.
+    """
     for i in range(len(sku_list)):
         if sku_list[i][-2:] != "-1":
             sku_list[i] += "-1"
-    zsku_nsku_map = sql(
-        engine_noon_cache,
-        '''
-        SELECT zsku_child, nsku_child
-        FROM psku.psku
-        WHERE zsku_child IN :nsku_list
-    ''',
-        nsku_list=sku_list,
-    ).kv_map()
+    zsku_nsku_map = get_zsku_nsku_map(sku_list)
 
     products = get_product_details_for(list(zsku_nsku_map.keys()))
     # consider only the product updates for which we already have entry in product table
@@ -281,24 +260,19 @@ def update_zsku_product_details(sku_list):
     processed_zskus = fetch_and_update_product_details(
         [{"sku": sku, "nsku": nsku} for sku, nsku in active_zsku_nsku_map.items()]
     )
-    if processed_zskus:
-        reindex_product_update_in_solr(processed_zskus)
+    reindex_zskus = list(processed_zskus) if force else processed_zskus.changed
+    if reindex_zskus:
+        reindex_product_update_in_solr(reindex_zskus)
     logger.warning(
-        f"active zsku of length {len(active_zsku_nsku_map)} {list(active_zsku_nsku_map.keys())} zsku product update processed of length {len(processed_zskus)} zskus {processed_zskus[0:100]}"
+        f"active zsku of length {len(active_zsku_nsku_map)} {list(active_zsku_nsku_map.keys())} "
+        f"zsku product update processed of length {len(processed_zskus)} zskus {processed_zskus[0:100]}"
     )
+    if processed_zskus.failed:
+        _republish_failed_zskus(processed_zskus.failed, attempt)
 
 
 def update_nsku_product_details(nsku_list):
-    zsku_nsku_map = sql(
-        engine_noon_cache,
-        '''
-        SELECT zsku_child, nsku_child
-        FROM psku.psku
-        WHERE 
-            nsku_child IN :nsku_list AND
-            zsku_child IS NOT NULL''',
-        nsku_list=nsku_list,
-    ).kv_map()
+    zsku_nsku_map = get_nsku_zsku_map(nsku_list)
     products = get_product_details_for(list(zsku_nsku_map.keys()))
     # consider only the product updates for which we already have entry in product table
     active_zsku_nsku_map = {zsku: zsku_nsku_map[zsku] for zsku in list(products.keys())}
@@ -307,8 +281,11 @@ def update_nsku_product_details(nsku_list):
     processed_zsku = fetch_and_update_product_details(
         [{"sku": sku, "nsku": nsku} for sku, nsku in active_zsku_nsku_map.items()]
     )
-    if processed_zsku:
-        reindex_product_update_in_solr(processed_zsku)
+    if processed_zsku.changed:
+        reindex_product_update_in_solr(processed_zsku.changed)
     logger.warning(
-        f"nsku update api: active zsku of length {len(active_zsku_nsku_map)} {list(active_zsku_nsku_map.keys())} zsku product update processed of length {len(processed_zsku)} zskus {processed_zsku[0:100]}"
+        f"nsku update api: active zsku of length {len(active_zsku_nsku_map)} {list(active_zsku_nsku_map.keys())} "
+        f"zsku product update processed of length {len(processed_zsku)} zskus {processed_zsku[0:100]}"
     )
+    if processed_zsku.failed:
+        _republish_failed_zskus(processed_zsku.failed, 0)
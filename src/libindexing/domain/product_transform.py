@@ -0,0 +1,152 @@
+import hashlib
+import json
+import logging
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+
+def _by_locale(entries, value_key):
+    """
+    {locale: value} of a localized catalog attribute, the last entry of a locale wins.
+    """
+    return {entry.get('locale'): entry.get(value_key) for entry in entries or []}
+
+
+def _first(entries, value_key, default=None):
+    return (entries or [{}])[0].get(value_key, default)
+
+
+def _last(entries, value_key):
+    return entries[-1].get(value_key) if entries else None
+
+
+def get_content_hash(product_row, product_en_row, product_ar_row):
+    """
+    Fingerprint of the rows written for a product, stored in `product.content_hash`.
+    """
+    content = [{k: v for k, v in product_row.items() if k != 'content_hash'}, product_en_row, product_ar_row]
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+
+def get_image_keys(data):
+    keys = []
+    for key in data['attributes']:
+        if key.startswith("image_url_"):
+            image_info = data['attributes'][key]
+            for img in image_info:
+                if img["meta"]["is_visible"]:
+                    meta_data = img['meta']
+                    img_url = "v{0}/{1}".format(meta_data['version'], meta_data['public_id'])
+                    keys.append({'is_visible': True, 'storage_path': img_url, 'sort_key': meta_data['sort_key']})
+    keys = sorted(keys, key=lambda k: k['sort_key'])
+    return [key["storage_path"] for key in keys]
+
+
+def _zsku_image_keys(attributes):
+    storage_paths = (image.get('storage_path') for image in attributes.get('image_url', []))
+    return [path.replace(".jpg", "") for path in storage_paths if path]
+
+
+class ProductBatchTransform:
+    """
+    Turns catalog api payloads of a batch into `product`, `product_en` and `product_ar` rows.
+
+    Category and group code lookups are grouped by sku once per batch and the category ids of each
+    distinct category combination are computed once, so a batch costs time linear in its size.
+    """
+
+    def __init__(self, sku_id_categories, sku_group_code_map, category_index):
+        self.id_categories_by_sku = defaultdict(list)
+        for row in sku_id_categories:
+            self.id_categories_by_sku[row['sku']].append(row['id_category'])
+        self.sku_group_code_map = sku_group_code_map
+        self.category_index = category_index
+        self._category_ids = {}
+
+        self.product_rows = []
+        self.product_en_rows = []
+        self.product_ar_rows = []
+        self.skus = []
+        self.sku_set = set()
+
+    def category_ids_for(self, sku):
+        id_cat_list = tuple(self.id_categories_by_sku.get(sku, ()))
+        if not id_cat_list:
+            return ''
+        category_ids = self._category_ids.get(id_cat_list)
+        if category_ids is None:
+            category_ids = ",".join(map(str, self.category_index.get_category_ids_for(list(id_cat_list))))
+            self._category_ids[id_cat_list] = category_ids
+        return category_ids
+
+    def _add(self, source, product_row, product_en_row, product_ar_row, image_keys):
+        sku = product_row['sku']
+        product_row['sku_config'] = sku
+        product_row['category_ids'] = self.category_ids_for(sku)
+        product_row['group_code'] = self.sku_group_code_map.get(sku, '')
+        if image_keys:
+            product_row['image_keys'] = json.dumps(image_keys)
+        else:
+            logger.error(f"couldn't extract image_keys from {source} product api of zsku: {sku}")
+        product_row['content_hash'] = get_content_hash(product_row, product_en_row, product_ar_row)
+        self.product_rows.append(product_row)
+        self.product_en_rows.append(product_en_row)
+        self.product_ar_rows.append(product_ar_row)
+        self.skus.append(sku)
+        self.sku_set.add(sku)
+
+    def add_zsku(self, sku, data) -> bool:
+        if data.get("error"):
+            return False
+        attributes = data['attributes']
+        model_number = _first(attributes.get('model_number'), 'data', '')
+        model_name = _first(attributes.get('model_name'), 'data', '')
+        brands = _by_locale(attributes['brand'], 'option_name')
+        titles = _by_locale(attributes['product_title'], 'data')
+        title_suffixes = _by_locale(attributes.get('title_suffix'), 'data')
+        long_descs = _by_locale(attributes.get('long_description'), 'data')
+        product_row = {
+            'sku': sku,
+            'family_code': _first(attributes.get('family'), 'data'),
+            'brand_code': _first(attributes.get('brand'), 'data'),
+            'model_name_number': model_name + " " + model_number,
+        }
+        lang_rows = {
+            lang: {
+                'sku': sku,
+                'brand': brands.get(lang),
+                'title': titles.get(lang),
+                'title_suffix': title_suffixes.get(lang),
+                'attributes': json.dumps({'long_desc': long_descs[lang]} if lang in long_descs else {}),
+            }
+            for lang in ('en', 'ar')
+        }
+        self._add('zsku', product_row, lang_rows['en'], lang_rows['ar'], _zsku_image_keys(attributes))
+        return True
+
+    def add_nsku(self, zsku, nsku, data) -> bool:
+        attributes = data.get("attributes", {})
+        fundamental_attributes = data.get("fundamental_attributes", {})
+        titles = _by_locale(attributes.get("product_full_title"), "value")
+        brand_info = fundamental_attributes.get("brand", [])
+        brands = _by_locale(brand_info, "value")
+        brand_code = _last(brand_info, "code")
+        family_code = _first(fundamental_attributes.get("family"), "code")
+        id_product_fulltype = _last(fundamental_attributes.get("product_fulltype"), "id")
+
+        if not (titles.get('en') and titles.get('ar') and id_product_fulltype and family_code and brand_code):
+            logger.warning(f"some mandatory attributes missing for nsku, zsku: {nsku}:{zsku}")
+            return False
+        product_row = {
+            "sku": zsku,
+            "brand_code": brand_code,
+            "id_product_fulltype": id_product_fulltype,
+            "family_code": family_code,
+        }
+        lang_rows = {
+            lang: {"sku": zsku, "title": titles[lang], "title_suffix": titles[lang], "brand": brands.get(lang)}
+            for lang in ('en', 'ar')
+        }
+        self._add('nsku', product_row, lang_rows['en'], lang_rows['ar'], get_image_keys(data))
+        return True
@@ -0,0 +1,281 @@
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+
+from jsql import sql
+from noonutil.v2 import sqlutil
+
+from libindexing import engine_noon_cache, engine_offer
+
+logger = logging.getLogger(__name__)
+
+PSKU_CACHE_MAX_SIZE = int(os.getenv('PSKU_CACHE_MAX_SIZE') or 500000)
+PSKU_CACHE_TTL_SECONDS = int(os.getenv('PSKU_CACHE_TTL_SECONDS') or 60 * 60 * 6)
+# pskus unknown to noon cache may be created any time, they are not cached for long
+PSKU_CACHE_NEGATIVE_TTL_SECONDS = int(os.getenv('PSKU_CACHE_NEGATIVE_TTL_SECONDS') or 60)
+# snapshot rows older than the TTL deleted per warm up, so a large backlog is pruned over a few starts
+PSKU_SNAPSHOT_PRUNE_LIMIT = int(os.getenv('PSKU_SNAPSHOT_PRUNE_LIMIT') or 50000)
+
+_MISSING = object()
+
+
+class MappingCache:
+    """
+    Bounded LRU cache of lookups loaded in bulk, with a TTL per entry.
+
+    `load(keys)` returns {key: value} for the keys it knows, the keys it does not return are cached
+    as negative entries with a shorter TTL, so unknown keys do not hit the source on every lookup.
+    """
+
+    def __init__(self, name, load, max_size, ttl, negative_ttl):
+        self.name = name
+        self.load = load
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # key: (expires_at, value), value is _MISSING for negative entries
+        self.entries = OrderedDict()
+        self.stats = Counter()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _put(self, key, value, now):
+        ttl = self.negative_ttl if value is _MISSING else self.ttl
+        self.entries[key] = (now + ttl, value)
+        self.entries.move_to_end(key)
+
+    def _evict(self):
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.stats['evictions'] += 1
+
+    def put_many(self, values, ages=None, jitter=0.0):
+        """
+        Caches known values. An entry `ages[key]` seconds old only lives for the rest of the TTL, and a
+        random part of up to `jitter` of that is taken off.
+        """
+        ages = ages or {}
+        now = time.monotonic()
+        with self.lock:
+            for key, value in values.items():
+                ttl = max(self.ttl - ages.get(key, 0), 0)
+                self.entries[key] = (now + ttl * (1 - random.random() * jitter), value)
+                self.entries.move_to_end(key)
+            self._evict()
+
+    def get_many(self, keys):
+        """
+        {key: value} of the known keys, the ones not cached or expired are loaded with one `load` call.
+        """
+        result, misses = {}, []
+        now = time.monotonic()
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                entry = self.entries.get(key)
+                if entry is None or entry[0] <= now:
+                    misses.append(key)
+                    continue
+                self.entries.move_to_end(key)
+                if entry[1] is _MISSING:
+                    self.stats['negative_hits'] += 1
+                else:
+                    self.stats['hits'] += 1
+                    result[key] = entry[1]
+            self.stats['misses'] += len(misses)
+        if not misses:
+            return result
+
+        loaded = self.load(misses)
+        now = time.monotonic()
+        with self.lock:
+            self.stats['loads'] += 1
+            for key in misses:
+                self._put(key, loaded.get(key, _MISSING), now)
+            self._evict()
+        result.update((key, loaded[key]) for key in misses if key in loaded)
+        return result
+
+    def prefetch(self, keys):
+        """
+        Loads the keys of a batch that are not cached, so the lookups of the batch are all hits.
+        """
+        self.get_many(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def metrics(self):
+        lookups = self.stats['hits'] + self.stats['negative_hits'] + self.stats['misses']
+        return {
+            'name': self.name,
+            'size': len(self.entries),
+            **self.stats,
+            'hit_ratio': round((self.stats['hits'] + self.stats['negative_hits']) / lookups, 4) if lookups else None,
+        }
+
+
+def _load_psku_codes(psku_code_list):
+    psku_code_map = sql(
+        engine_noon_cache,
+        '''
+        SELECT psku_code, zsku_child as sku, nsku_child as nsku, id_partner
+        FROM psku.psku
+        WHERE psku_code IN :psku_code_list
+        AND zsku_child IS NOT NULL
+    ''',
+        psku_code_list=psku_code_list,
+    ).pk_map()
+    if psku_code_map:
+        _save_psku_mapping_snapshot(psku_code_map)
+    return psku_code_map
+
+
+def _load_zsku_nskus(zsku_list):
+    zsku_nskus = defaultdict(list)
+    for row in sql(
+        engine_noon_cache,
+        '''
+        SELECT zsku_child as sku, nsku_child as nsku
+        FROM psku.psku
+        WHERE zsku_child IN :zsku_list
+    ''',
+        zsku_list=zsku_list,
+    ).dicts():
+        zsku_nskus[row['sku']].append(row['nsku'])
+    return zsku_nskus
+
+
+def _load_nsku_zskus(nsku_list):
+    nsku_zskus = defaultdict(list)
+    for row in sql(
+        engine_noon_cache,
+        '''
+        SELECT zsku_child as sku, nsku_child as nsku
+        FROM psku.psku
+        WHERE nsku_child IN :nsku_list
+        AND zsku_child IS NOT NULL
+    ''',
+        nsku_list=nsku_list,
+    ).dicts():
+        nsku_zskus[row['nsku']].append(row['sku'])
+    return nsku_zskus
+
+
+def _mapping_cache(name, load):
+    return MappingCache(name, load, PSKU_CACHE_MAX_SIZE, PSKU_CACHE_TTL_SECONDS, PSKU_CACHE_NEGATIVE_TTL_SECONDS)
+
+
+psku_code_cache = _mapping_cache('psku_code', _load_psku_codes)
+zsku_nskus_cache = _mapping_cache('zsku_nskus', _load_zsku_nskus)
+nsku_zskus_cache = _mapping_cache('nsku_zskus', _load_nsku_zskus)
+
+
+def get_psku_code_map(psku_code_list):
+    """
+    {psku_code: {'sku', 'nsku', 'id_partner'}} of the pskus that have a zsku.
+    """
+    if not psku_code_list:
+        return {}
+    return psku_code_cache.get_many(psku_code_list)
+
+
+def get_zsku_nsku_list(zsku_list):
+    """
+    [{'sku', 'nsku'}] of every psku of the zskus.
+    """
+    if not zsku_list:
+        return []
+    return [
+        {'sku': zsku, 'nsku': nsku} for zsku, nskus in zsku_nskus_cache.get_many(zsku_list).items() for nsku in nskus
+    ]
+
+
+def get_zsku_nsku_map(zsku_list):
+    return {row['sku']: row['nsku'] for row in get_zsku_nsku_list(zsku_list)}
+
+
+def get_nsku_zsku_map(nsku_list):
+    """
+    {zsku: nsku} of the pskus of the nskus that have a zsku.
+    """
+    if not nsku_list:
+        return {}
+    return {zsku: nsku for nsku, zskus in nsku_zskus_cache.get_many(nsku_list).items() for zsku in zskus}
+
+
+def _save_psku_mapping_snapshot(psku_code_map):
+    try:
+        # updated_at is set even when the mapping did not change, it tells when noon cache last confirmed it
+        sqlutil.sqlmany(
+            engine_offer,
+            '''
+            INSERT INTO psku_mapping (psku_code, sku, nsku, id_partner)
+            VALUES (:psku_code, :sku, :nsku, :id_partner)
+            ON DUPLICATE KEY UPDATE
+                sku = VALUES(sku),
+                nsku = VALUES(nsku),
+                id_partner = VALUES(id_partner),
+                updated_at = NOW()
+        ''',
+            [{'psku_code': psku_code, **row} for psku_code, row in psku_code_map.items()],
+        )
+    except Exception as e:
+        # the snapshot only warms up new processes, lookups do not depend on it
+        logger.warning(f"could not save psku mapping snapshot: {e}")
+
+
+def prune_psku_mapping_snapshot(limit=PSKU_SNAPSHOT_PRUNE_LIMIT):
+    """
+    Deletes up to `limit` snapshot rows that noon cache has not confirmed within the TTL.
+    """
+    sql(
+        engine_offer,
+        '''
+        DELETE FROM psku_mapping
+        WHERE updated_at < NOW() - INTERVAL :ttl SECOND
+        LIMIT :limit
+    ''',
+        ttl=PSKU_CACHE_TTL_SECONDS,
+        limit=limit,
+    )
+
+
+def warm_psku_code_cache(limit=PSKU_CACHE_MAX_SIZE):
+    """
+    Fills the psku_code cache from the `psku_mapping` snapshot in the offer db.
+
+    Every psku_code loaded from noon cache is written to the snapshot, a new process starts with
+    up to `limit` of them instead of loading them all from noon cache again. Only rows confirmed
+    within the TTL are loaded and each lives for the rest of it, minus up to half as jitter so
+    processes started together do not reload them together. Older rows are pruned.
+    """
+    try:
+        prune_psku_mapping_snapshot()
+    except Exception as e:
+        logger.warning(f"could not prune psku mapping snapshot: {e}")
+    rows = sql(
+        engine_offer,
+        '''
+        SELECT psku_code, sku, nsku, id_partner, TIMESTAMPDIFF(SECOND, updated_at, NOW()) as age_seconds
+        FROM psku_mapping
+        WHERE updated_at >= NOW() - INTERVAL :ttl SECOND
+        ORDER BY updated_at DESC
+        LIMIT :limit
+    ''',
+        ttl=PSKU_CACHE_TTL_SECONDS,
+        limit=limit,
+    ).dicts()
+    ages = {row['psku_code']: row.pop('age_seconds') for row in rows}
+    psku_code_cache.put_many({row.pop('psku_code'): row for row in rows}, ages=ages, jitter=0.5)
+    logger.info(f"psku_code cache warmed up with {len(rows)} pskus")
+    return len(rows)
+
+
+def psku_cache_metrics():
+    return [cache.metrics() for cache in (psku_code_cache, zsku_nskus_cache, nsku_zskus_cache)]
@@ -1,46 +1,136 @@
+import contextlib
+import contextvars
 import json
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pysolr
+import requests
 from noonutil.v1 import miscutil
 from noonutil.v2.sqlutil import chunker
 
 from libindexing.domain.offer import get_product_and_offer_details_for, get_in_stock_offers
 from libutil.spanner_util import *
 
-SOLR_SEMAPHORE = os.getenv('SOLR_SEMAPHORE') or 2
+SOLR_SEMAPHORE = int(os.getenv('SOLR_SEMAPHORE') or 2)
+# in bulk mode documents become searchable within this many ms instead of being committed per chunk
+SOLR_COMMIT_WITHIN_MS = int(os.getenv('SOLR_COMMIT_WITHIN_MS') or 10000)
 
 logger = logging.getLogger(__name__)
 
 SOLR_HOST = os.getenv('SOLR_HOST') or 'localhost'
 
 
+def _json_body(prefix, items, suffix):
+    # request bodies are generated piece by piece, requests sends them with chunked encoding
+    yield prefix
+    for i, item in enumerate(items):
+        yield (b',' if i else b'') + json.dumps(item).encode('utf8')
+    yield suffix
+
+
+class _BulkJob:
+    def __init__(self, commit_within):
+        self.commit_within = commit_within
+        self.executor = ThreadPoolExecutor(max_workers=SOLR_SEMAPHORE, thread_name_prefix='solr-bulk')
+        self.futures = []
+        # caps the chunks queued, so a large job does not hold all of its documents in memory
+        self.queued = threading.BoundedSemaphore(SOLR_SEMAPHORE * 2)
+
+    def submit(self, chunk_fn, chunk_data):
+        self.queued.acquire()
+        params = {'commitWithin': self.commit_within} if self.commit_within else {}
+        future = self.executor.submit(chunk_fn, chunk_data, **params)
+        future.add_done_callback(lambda _: self.queued.release())
+        self.futures.append(future)
+
+
+# bulk jobs by indexer of the current context, other threads keep indexing as usual meanwhile
+_bulk_jobs = contextvars.ContextVar('solr_bulk_jobs', default={})
+
+
 class SolrIndexer(object):
+    """
+    Sends documents to a solr core in chunks of DOC_SIZE.
+
+    By default every call is visible when it returns: its last chunk carries a soft commit. Inside
+    `bulk()` chunks are sent concurrently, at most SOLR_SEMAPHORE at a time, rely on commitWithin
+    for visibility and the job ends with a single hard commit.
+    """
     DOC_SIZE = 250
-    UPDATE_KWARGS = {'commit': True, 'softCommit': True}
+    UPDATE_KWARGS = {'commit': 'true', 'softCommit': 'true'}
 
     def __init__(self, host, index="", timeout=10):
         kwargs = {"timeout": timeout}
         self.solr = pysolr.Solr(f'http://{host}:8983/solr/{index}/', **kwargs)
+        self.host = host
+        self.index = index
+        self.update_url = f'http://{host}:8983/solr/{index}/update'
+        self.timeout = timeout
+        self.session = requests.Session()
         self.lock = threading.Semaphore(SOLR_SEMAPHORE)
 
+    @contextlib.contextmanager
+    def bulk(self, commit_within=SOLR_COMMIT_WITHIN_MS):
+        """
+        Bulk mode for the calls made in the current context only, threads the job starts get it by
+        running in a copy of the context (`contextvars.copy_context().run`).
+
+        Pass `commit_within=None` when nothing searches the core during the job, chunks are then
+        not committed at all until the final commit.
+        """
+        jobs = _bulk_jobs.get()
+        assert self not in jobs, "already in bulk mode"
+        job = _BulkJob(commit_within)
+        token = _bulk_jobs.set({**jobs, self: job})
+        try:
+            yield self
+            for future in job.futures:
+                future.result()
+        finally:
+            _bulk_jobs.reset(token)
+            job.executor.shutdown(wait=True)
+        self.commit()
+
+    def _send(self, chunk_fn, chunks):
+        job = _bulk_jobs.get().get(self)
+        if job is None:
+            for i, chunk_data in enumerate(chunks):
+                chunk_fn(chunk_data, **(self.UPDATE_KWARGS if i == len(chunks) - 1 else {}))
+            return
+        for chunk_data in chunks:
+            job.submit(chunk_fn, chunk_data)
+
+    def _post(self, body, params):
+        with self.lock:
+            response = self.session.post(
+                self.update_url,
+                params=params,
+                data=body,
+                headers={'Content-Type': 'application/json'},
+                timeout=self.timeout,
+            )
+        response.raise_for_status()
+
     def add_objects(self, data):
-        for chunk_data in chunker(self.DOC_SIZE, data):
-            self.add_chunk(chunk_data)
+        self._send(self.add_chunk, list(chunker(self.DOC_SIZE, data)))
 
     @retry(stop_max_attempt_number=3, wait_random_min=1000, wait_random_max=5000)
-    def add_chunk(self, documents):
-        with self.lock:
-            self.solr.add(documents, **self.UPDATE_KWARGS)
+    def add_chunk(self, documents, **params):
+        self._post(_json_body(b'[', documents, b']'), params)
 
     @retry(stop_max_attempt_number=3, wait_random_min=1000, wait_random_max=5000)
-    def delete_chunk(self, chunk_data):
-        with self.lock:
-            self.solr.delete(id=chunk_data, **self.UPDATE_KWARGS)
+    def delete_chunk(self, chunk_data, **params):
+        self._post(_json_body(b'{"delete":[', chunk_data, b']}'), params)
 
     def delete_objects(self, data):
-        for chunk_data in chunker(self.DOC_SIZE, data):
-            self.delete_chunk(chunk_data)
+        if isinstance(data, str):
+            data = [data]
+        self._send(self.delete_chunk, list(chunker(self.DOC_SIZE, data)))
+
+    @retry(stop_max_attempt_number=3, wait_random_min=1000, wait_random_max=5000)
+    def commit(self):
+        self._post(b'{"commit":{}}', {})
 
 
 solr_indexers = {
@@ -48,6 +138,17 @@ solr_indexers = {
 }
 
 
+@contextlib.contextmanager
+def bulk_solr_indexing():
+    """
+    Puts every solr indexer in bulk mode for a large job, see `SolrIndexer.bulk`.
+    """
+    with contextlib.ExitStack() as stack:
+        for indexer in solr_indexers.values():
+            stack.enter_context(indexer.bulk())
+        yield
+
+
 def reindex_product_update_in_solr(sku_list):
     if not sku_list:
         return
@@ -0,0 +1,198 @@
+import datetime
+import json
+import logging
+import os
+
+import requests
+from noonutil.v2.sqlutil import chunker
+
+from libindexing import DomainException
+from libindexing.domain.offer import (
+    get_in_stock_offer_keys,
+    get_in_stock_offer_page,
+    get_offers_changed_since,
+    get_product_and_offer_details_for,
+)
+from libindexing.domain.solr import SolrIndexer, get_solr_doc, solr_indexers
+
+logger = logging.getLogger(__name__)
+
+SOLR_REBUILD_PAGE_SIZE = int(os.getenv('SOLR_REBUILD_PAGE_SIZE') or 5000)
+# the rebuilt core may hold at most this fraction fewer documents than the live one
+SOLR_REBUILD_MAX_COUNT_DROP = float(os.getenv('SOLR_REBUILD_MAX_COUNT_DROP') or 0.05)
+SOLR_CONFIGSET = os.getenv('SOLR_CONFIGSET') or 'managed-base'
+# catch-up replays start this much before the step they follow, commit timestamps are not read back in order
+REPLAY_OVERLAP = datetime.timedelta(seconds=60)
+
+SHADOW_SUFFIX = '_shadow'
+
+
+class SolrCoreAdmin:
+    """
+    CoreAdmin calls against a standalone solr.
+    """
+
+    def __init__(self, host, timeout=60):
+        self.base_url = f'http://{host}:8983/solr'
+        self.timeout = timeout
+
+    def _admin(self, **params):
+        response = requests.get(f'{self.base_url}/admin/cores', params={'wt': 'json', **params}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def exists(self, core):
+        return bool(self._admin(action='STATUS', core=core)['status'].get(core))
+
+    def create(self, core, config_set=SOLR_CONFIGSET):
+        self._admin(action='CREATE', name=core, instanceDir=core, configSet=config_set)
+
+    def swap(self, core, other):
+        self._admin(action='SWAP', core=core, other=other)
+
+    def count(self, core):
+        response = requests.get(
+            f'{self.base_url}/{core}/select', params={'q': '*:*', 'rows': 0, 'wt': 'json'}, timeout=self.timeout
+        )
+        response.raise_for_status()
+        return response.json()['response']['numFound']
+
+    def schema(self, core):
+        response = requests.get(f'{self.base_url}/{core}/schema', params={'wt': 'json'}, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['schema']
+
+    def update_schema(self, core, commands):
+        response = requests.post(f'{self.base_url}/{core}/schema', data=json.dumps(commands), timeout=self.timeout)
+        response.raise_for_status()
+
+
+def _missing_schema_commands(source, target):
+    """
+    Schema api commands giving `target` the field types, fields, dynamic fields and copy fields of `source`:
+    missing definitions are added, differing ones replaced and copy fields `source` does not have deleted.
+    """
+    commands = {}
+    for key, add_command, replace_command in (
+        ('fieldTypes', 'add-field-type', 'replace-field-type'),
+        ('fields', 'add-field', 'replace-field'),
+        ('dynamicFields', 'add-dynamic-field', 'replace-dynamic-field'),
+    ):
+        existing = {entry['name']: entry for entry in target.get(key, [])}
+        missing = [entry for entry in source.get(key, []) if entry['name'] not in existing]
+        changed = [entry for entry in source.get(key, []) if existing.get(entry['name'], entry) != entry]
+        if missing:
+            commands[add_command] = missing
+        if changed:
+            commands[replace_command] = changed
+    source_copy_fields = {(entry['source'], entry['dest']) for entry in source.get('copyFields', [])}
+    existing_copy_fields = {(entry['source'], entry['dest']) for entry in target.get('copyFields', [])}
+    # copy fields have nothing to replace, they are only added or deleted
+    stale_copy_fields = [
+        {'source': entry['source'], 'dest': entry['dest']}
+        for entry in target.get('copyFields', [])
+        if (entry['source'], entry['dest']) not in source_copy_fields
+    ]
+    missing_copy_fields = [
+        {'source': entry['source'], 'dest': entry['dest']}
+        for entry in source.get('copyFields', [])
+        if (entry['source'], entry['dest']) not in existing_copy_fields
+    ]
+    if stale_copy_fields:
+        commands['delete-copy-field'] = stale_copy_fields
+    if missing_copy_fields:
+        commands['add-copy-field'] = missing_copy_fields
+    return commands
+
+
+def _replay(indexer: SolrIndexer, country_code, since, indexed):
+    """
+    Applies to `indexer` the offers changed since `since`: in stock ones are reindexed, the others deleted.
+
+    Offers whose rows were deleted from spanner never show up as changed, so every offer of `indexed`,
+    the (sku, wh_code) of the documents the rebuild wrote, is checked again and deleted when no longer in
+    stock. `indexed` is kept up to date with what the replay writes.
+    """
+    sku_wh_code_list = get_offers_changed_since(country_code, since)
+    offers = get_product_and_offer_details_for(sku_wh_code_list)
+    in_stock = [row for row in offers if row['stock_net'] > 0]
+    if in_stock:
+        indexer.add_objects([get_solr_doc(row) for row in in_stock])
+    indexed.update((row['sku'], row['wh_code']) for row in in_stock)
+
+    gone = set(sku_wh_code_list) - indexed
+    for chunk in chunker(SOLR_REBUILD_PAGE_SIZE, sorted(indexed)):
+        in_stock_keys = get_in_stock_offer_keys(chunk)
+        gone.update(key for key in chunk if key not in in_stock_keys)
+    if gone:
+        indexer.delete_objects([f'{sku}:{wh_code}' for sku, wh_code in sorted(gone)])
+        indexed.difference_update(gone)
+    return len(sku_wh_code_list) + len(gone)
+
+
+def rebuild_solr_core(country_code, schema=None, dry_run=False):
+    """
+    Rebuilds the offer core of a country next to the live one and swaps them.
+
+    The shadow core gets the live core's schema (or the given schema api commands, to ship schema
+    changes) and is bulk loaded from spanner without intermediate commits, the consumers keep
+    updating the live core meanwhile. Offers changed since the load started are replayed into the
+    shadow core and the loaded offers no longer in stock, deleted ones included, are deleted from it.
+    Its document count is checked against the live core and the cores are swapped. Offers changed
+    while replaying and swapping are replayed once more into the new live core.
+    The previous index stays in the shadow core, swapping again rolls back.
+
+    Our Solr runs standalone, not as SolrCloud, so there are no collection aliases to flip: the
+    shadow core is made with CoreAdmin CREATE and put live with CoreAdmin SWAP, which renames the
+    two cores atomically and keeps the core name the indexers and searchers use.
+    """
+    country_code = country_code.lower()
+    live_indexer = solr_indexers[country_code]
+    live_core, shadow_core = live_indexer.index, f'{live_indexer.index}{SHADOW_SUFFIX}'
+    admin = SolrCoreAdmin(live_indexer.host)
+
+    if not admin.exists(shadow_core):
+        admin.create(shadow_core)
+    shadow_indexer = SolrIndexer(live_indexer.host, shadow_core)
+    shadow_indexer.solr.delete(q='*:*', commit=True)
+    schema_commands = schema or _missing_schema_commands(admin.schema(live_core), admin.schema(shadow_core))
+    if schema_commands:
+        admin.update_schema(shadow_core, schema_commands)
+
+    load_started_at = datetime.datetime.now(datetime.timezone.utc)
+    loaded = 0
+    indexed = set()
+    with shadow_indexer.bulk(commit_within=None):
+        after_sku, after_wh_code = '', ''
+        while True:
+            page = get_in_stock_offer_page(country_code, after_sku, after_wh_code, limit=SOLR_REBUILD_PAGE_SIZE)
+            if not page:
+                break
+            shadow_indexer.add_objects([get_solr_doc(row) for row in page])
+            indexed.update((row['sku'], row['wh_code']) for row in page)
+            loaded += len(page)
+            after_sku, after_wh_code = page[-1]['sku'], page[-1]['wh_code']
+            logger.info(f"solr rebuild of {live_core}: {loaded} offers loaded")
+            if len(page) < SOLR_REBUILD_PAGE_SIZE:
+                break
+
+    replay_started_at = datetime.datetime.now(datetime.timezone.utc)
+    replayed = _replay(shadow_indexer, country_code, load_started_at - REPLAY_OVERLAP, indexed)
+    shadow_indexer.commit()
+
+    shadow_count, live_count = admin.count(shadow_core), admin.count(live_core)
+    logger.info(
+        f"solr rebuild of {live_core}: {loaded} loaded, {replayed} replayed, "
+        f"{shadow_count} documents, live has {live_count}"
+    )
+    if shadow_count == 0 or shadow_count < live_count * (1 - SOLR_REBUILD_MAX_COUNT_DROP):
+        raise DomainException(
+            f"rebuilt {shadow_core} has {shadow_count} documents against {live_count} in {live_core}, not swapping"
+        )
+    if dry_run:
+        return {'core': live_core, 'loaded': loaded, 'replayed': replayed, 'documents': shadow_count, 'swapped': False}
+
+    admin.swap(live_core, shadow_core)
+    replayed += _replay(live_indexer, country_code, replay_started_at - REPLAY_OVERLAP, indexed)
+    logger.info(f"solr rebuild of {live_core}: swapped, previous index kept in {shadow_core}")
+    return {'core': live_core, 'loaded': loaded, 'replayed': replayed, 'documents': shadow_count, 'swapped': True}
@@ -1,11 +1,24 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from boltons import iterutils
+
 from noonutil.v2 import sqlutil
 
 from libcatalog.models.spanner_tables import OfferStock as SpannerOfferStock
 from libindexing import engine_offer
 from libindexing.domain.product import *
-from libindexing.domain.solr import delete_doc_from_solr, reindex_in_solr
+from libindexing.domain.noon_cache import noon_cache_product_keys
+from libindexing.domain.offer import get_offer_stock_map
+from libindexing.domain.psku import get_psku_code_map, psku_code_cache
+from libindexing.domain.solr import bulk_solr_indexing, delete_doc_from_solr, reindex_in_solr
 from libindexing.models.noon_cache_spanner_tables import BoilerplateStock
-from libindexing.models.tables import OfferStock
+from libindexing.models.tables import OfferStock, StockReindexCheckpoint
 from liborder.domain.serviceability import get_wh_code_to_country_code_map
 from libutil.spanner_util import noon_cache_spanner
 from libutil.spanner_util import sc_spanner
@@ -14,32 +27,11 @@ from libutil.spanner_util import sc_spanner
 def update_boilerplate_stock(list_products):
     list_to_upsert = []
 
-    zskus = [product['sku'] for product in list_products]
-    if zskus:
-        existing_zskus = (
-            noon_cache_spanner()
-            .execute_query('''SELECT sku FROM product WHERE sku IN UNNEST(@list_zsku)''', list_zsku=zskus)
-            .scalars()
-        )
-    else:
-        existing_zskus = []
-
-    nskus = [product['nsku'] for product in list_products if product['nsku']]
-    if nskus:
-        existing_nskus = (
-            noon_cache_spanner()
-            .execute_query(
-                '''
-            SELECT sku
-            FROM product
-            WHERE sku IN UNNEST(@list_nsku)
-        ''',
-                list_nsku=nskus,
-            )
-            .scalars()
-        )
-    else:
-        existing_nskus = []
+    existing_zskus = noon_cache_product_keys.existing(product['sku'] for product in list_products)
+    # the nsku of a product only matters when its zsku is not in noon cache
+    existing_nskus = noon_cache_product_keys.existing(
+        product['nsku'] for product in list_products if product['sku'] not in existing_zskus and product['nsku']
+    )
 
     list_zsku_products = [product for product in list_products if product['sku'] in existing_zskus]
 
@@ -89,21 +81,132 @@ def update_boilerplate_stock(list_products):
         BoilerplateStock.upsert(noon_cache_spanner(), 'boilerplate_stock', list_to_upsert)
 
 
-def stock_update(scstock_rows, force_product_update=False):
-    if not scstock_rows:
-        return
-    psku_code_map = sql(
-        engine_noon_cache,
-        '''
-        SELECT psku_code, zsku_child as sku, nsku_child as nsku, id_partner
-        FROM psku.psku
-        WHERE psku_code IN :psku_code_list
-        AND zsku_child IS NOT NULL
+STOCK_SINK_WORKERS = int(os.getenv('STOCK_SINK_WORKERS') or 8)
+STOCK_OUTBOX_DRAIN_INTERVAL_SECONDS = float(os.getenv('STOCK_OUTBOX_DRAIN_INTERVAL_SECONDS') or 5)
+STOCK_OUTBOX_DRAIN_BATCH_SIZE = int(os.getenv('STOCK_OUTBOX_DRAIN_BATCH_SIZE') or 50)
+STOCK_OUTBOX_RETRY_SECONDS = int(os.getenv('STOCK_OUTBOX_RETRY_SECONDS') or 5)
+STOCK_OUTBOX_MAX_RETRY_SECONDS = int(os.getenv('STOCK_OUTBOX_MAX_RETRY_SECONDS') or 600)
+
+stock_sink_threadpool = ThreadPoolExecutor(max_workers=STOCK_SINK_WORKERS, thread_name_prefix='stock-sink')
+# writes, failures and write time per sink in this process
+stock_sink_stats = Counter()
+
+
+def _write_mysql_offer_stock(stock_update_rows, skus_to_add_to_solr):
+    sqlutil.upsert_batch(engine_offer, OfferStock, stock_update_rows)
+
+
+def _write_spanner_offer_stock(stock_update_rows, skus_to_add_to_solr):
+    SpannerOfferStock.upsert(boilerplate_spanner(), 'offer_stock', stock_update_rows)
+
+
+def _write_noon_cache_stock(stock_update_rows, skus_to_add_to_solr):
+    update_boilerplate_stock(stock_update_rows)
+
+
+def _write_solr_stock(stock_update_rows, skus_to_add_to_solr):
+    country_codes = ('ae', 'sa', 'eg')
+    for country_code in country_codes:
+        skus_to_delete_from_solr = [
+            f"{row['sku']}:{row['wh_code']}"
+            for row in stock_update_rows
+            if row['stock_net'] == 0 and row['country_code'].lower() == country_code
+        ]
+        if skus_to_delete_from_solr:
+            delete_doc_from_solr(skus_to_delete_from_solr, country_code)
+    if skus_to_add_to_solr:
+        reindex_in_solr(skus_to_add_to_solr)
+
+
+STOCK_SINKS = {
+    'mysql': _write_mysql_offer_stock,
+    'spanner': _write_spanner_offer_stock,
+    'noon_cache': _write_noon_cache_stock,
+    'solr': _write_solr_stock,
+}
+# chains are written concurrently, the sinks of a chain in order: solr documents are built from the
+# spanner offer_stock, so solr is written only once spanner is
+STOCK_SINK_CHAINS = (('mysql',), ('spanner', 'solr'), ('noon_cache',))
+
+
+def _write_stock_sink_chain(sinks, stock_update_rows, skus_to_add_to_solr):
+    """
+    Writes the sinks in order and stops at the first failure.
+
+    Returns the sinks left to write, starting with the failed one, and the error.
+    """
+    for i, sink in enumerate(sinks):
+        started = time.monotonic()
+        try:
+            STOCK_SINKS[sink](stock_update_rows, skus_to_add_to_solr)
+        except Exception as e:
+            logger.exception(f"stock sink {sink} failed for {len(stock_update_rows)} rows: {e}")
+            stock_sink_stats[f'{sink}_failures'] += 1
+            return list(sinks[i:]), repr(e)
+        finally:
+            stock_sink_stats[f'{sink}_ms'] += int((time.monotonic() - started) * 1000)
+        stock_sink_stats[f'{sink}_writes'] += 1
+    return [], None
+
+
+def write_stock_sinks(stock_update_rows, skus_to_add_to_solr, stock_keys):
+    """
+    Writes stock rows to mysql, spanner, noon cache and solr, the independent sinks concurrently.
+
+    Sinks that fail are recorded in the `stock_sink_outbox` table with the (psku_code, wh_code) keys
+    of the update and retried by the outbox drainer, the update itself succeeds. Only a failure to
+    record them raises, so the message is redelivered.
+    """
+    started = time.monotonic()
+    # the chains run in copies of the caller's context, so a solr bulk job of the caller covers their updates
+    futures = [
+        stock_sink_threadpool.submit(
+            contextvars.copy_context().run, _write_stock_sink_chain, chain, stock_update_rows, skus_to_add_to_solr
+        )
+        for chain in STOCK_SINK_CHAINS
+    ]
+    failed_sinks = []
+    for future in futures:
+        sinks, error = future.result()
+        if sinks:
+            _add_to_stock_outbox(sinks, stock_keys, error)
+            failed_sinks.extend(sinks)
+    logger.info(
+        "stock-sinks",
+        extra={
+            'rows': len(stock_update_rows),
+            'failed_sinks': failed_sinks,
+            'duration_ms': int((time.monotonic() - started) * 1000),
+        },
+    )
+    if failed_sinks:
+        stock_outbox_drainer.start()
+    return failed_sinks
+
+
+def _read_sc_stock(psku_code_wh_code_list, wh_code_cc_map):
+    stock_rows = (
+        sc_spanner()
+        .execute_query(
+            '''
+        SELECT psku_code, warehouse_code as wh_code, qty_net
+        FROM stock
+        WHERE
+        (psku_code, warehouse_code) in UNNEST(@psku_code_wh_code_list)
     ''',
-        psku_code_list=[row['psku_code'] for row in scstock_rows],
-    ).pk_map()
+            psku_code_wh_code_list=psku_code_wh_code_list,
+        )
+        .dicts()
+    )
+    for row in stock_rows:
+        row['country_code'] = wh_code_cc_map[row['wh_code']].upper()
+    return stock_rows
 
-    stock_update_rows = [
+
+def _get_stock_update_rows(scstock_rows):
+    psku_code_map = get_psku_code_map([row['psku_code'] for row in scstock_rows])
+
+    return [
         {
             'wh_code': row['wh_code'],
             'stock_net': (row['qty_net'] if row['qty_net'] >= 0 else 0),
@@ -115,6 +218,12 @@ def stock_update(scstock_rows, force_product_update=False):
         for row in scstock_rows
         if row['psku_code'] in psku_code_map
     ]
+
+
+def stock_update(scstock_rows, force_product_update=False):
+    if not scstock_rows:
+        return
+    stock_update_rows = _get_stock_update_rows(scstock_rows)
     if not scstock_rows:
         return
 
@@ -134,22 +243,19 @@ def stock_update(scstock_rows, force_product_update=False):
         row for row in stock_update_rows if row['sku'] in processed_zskus_list or row['sku'] in sku_to_product_map
     ]
 
-    sqlutil.upsert_batch(engine_offer, OfferStock, stock_update_rows)
-    SpannerOfferStock.upsert(boilerplate_spanner(), 'offer_stock', stock_update_rows)
-    update_boilerplate_stock(stock_update_rows)
+    previous_stock_map = get_offer_stock_map([(row['sku'], row['wh_code']) for row in stock_update_rows])
 
-    country_codes = ('ae', 'sa', 'eg')
-    for country_code in country_codes:
-        skus_to_delete_from_solr = [
-            f"{row['sku']}:{row['wh_code']}"
-            for row in stock_update_rows
-            if row['stock_net'] == 0 and row['country_code'].lower() == country_code
-        ]
-        if skus_to_delete_from_solr:
-            delete_doc_from_solr(skus_to_delete_from_solr, country_code)
-
-    skus_to_add_to_solr = [(row['sku'], row['wh_code']) for row in stock_update_rows]
-    reindex_in_solr(skus_to_add_to_solr)
+    # the solr document holds no stock, an offer that stays in stock needs no update unless its product
+    # was fetched just now, only offers coming back in stock need their document built
+    skus_to_add_to_solr = [
+        (row['sku'], row['wh_code'])
+        for row in stock_update_rows
+        if row['stock_net'] > 0
+        and (row['sku'] in processed_zskus_list or (previous_stock_map.get((row['sku'], row['wh_code'])) or 0) <= 0)
+    ]
+    write_stock_sinks(
+        stock_update_rows, skus_to_add_to_solr, [(row['psku_code'], row['wh_code']) for row in scstock_rows]
+    )
 
 
 def reindex_stock(psku_code_wh_code_list):
@@ -162,46 +268,482 @@ def reindex_stock(psku_code_wh_code_list):
         logger.warning(f"following warehouses are not part of boilerplate {wh_codes_not_serviceable}")
     if not psku_code_wh_code_list:
         return
-    stock_rows = (
-        sc_spanner()
-        .execute_query(
-            '''
-        SELECT psku_code, warehouse_code as wh_code, qty_net
-        FROM stock
-        WHERE 
-        (psku_code, warehouse_code) in UNNEST(@psku_code_wh_code_list)
-    ''',
-            psku_code_wh_code_list=[(row['psku_code'], row['warehouse_code']) for row in psku_code_wh_code_list],
-        )
-        .dicts()
+    stock_rows = _read_sc_stock(
+        [(row['psku_code'], row['warehouse_code']) for row in psku_code_wh_code_list], wh_code_cc_map
     )
     if not stock_rows:
         return
-    for row in stock_rows:
-        row['country_code'] = wh_code_cc_map[row['wh_code']].upper()
     stock_update(stock_rows)
 
 
-def full_stock_update_for_warehouse(wh_code):
+def _add_to_stock_outbox(sinks, stock_keys, error):
+    sql(
+        engine_offer,
+        '''
+        INSERT INTO stock_sink_outbox (sinks, stock_keys, last_error, next_attempt_at)
+        VALUES (:sinks, :stock_keys, :last_error, DATE_ADD(NOW(), INTERVAL :delay SECOND))
+    ''',
+        sinks=','.join(sinks),
+        stock_keys=json.dumps([list(key) for key in stock_keys]),
+        last_error=error,
+        delay=STOCK_OUTBOX_RETRY_SECONDS,
+    )
+
+
+def _claim_stock_outbox_entries(limit):
+    # entries are leased by pushing their next attempt past the time a replay may take, so the
+    # drainers of other processes skip them; an entry whose drainer died is picked up after the lease
+    with engine_offer.begin() as conn:
+        entries = sql(
+            conn,
+            '''
+            SELECT id, sinks, stock_keys, attempts
+            FROM stock_sink_outbox
+            WHERE next_attempt_at <= NOW()
+            ORDER BY id
+            LIMIT :limit
+            FOR UPDATE SKIP LOCKED
+        ''',
+            limit=limit,
+        ).dicts()
+        if entries:
+            sql(
+                conn,
+                '''
+                UPDATE stock_sink_outbox
+                SET next_attempt_at = DATE_ADD(NOW(), INTERVAL :lease SECOND)
+                WHERE id IN :ids
+            ''',
+                ids=[entry['id'] for entry in entries],
+                lease=STOCK_OUTBOX_MAX_RETRY_SECONDS,
+            )
+    return entries
+
+
+def _replay_stock_sinks(sinks, stock_keys):
+    """
+    Writes the current stock of `stock_keys` to `sinks`.
+
+    The stock is read again from sc instead of replaying the failed rows, a newer update may have
+    been written in between. The stock the offers had before is not known anymore, every in stock
+    offer gets its solr document rebuilt.
+    """
     wh_code_cc_map = get_wh_code_to_country_code_map()
-    if wh_code not in wh_code_cc_map.keys():
-        logger.warning(f"skipping full stock stock update for {wh_code} as it is not on boilerplate")
-        return
-    country_code = wh_code_cc_map[wh_code].upper()
-    stock_rows = (
+    stock_rows = _read_sc_stock([tuple(key) for key in stock_keys if key[1] in wh_code_cc_map], wh_code_cc_map)
+    stock_update_rows = _get_stock_update_rows(stock_rows) if stock_rows else []
+    sku_to_product_map = get_product_details_for([row['sku'] for row in stock_update_rows])
+    stock_update_rows = [row for row in stock_update_rows if row['sku'] in sku_to_product_map]
+    if not stock_update_rows:
+        return [], None
+    skus_to_add_to_solr = [(row['sku'], row['wh_code']) for row in stock_update_rows if row['stock_net'] > 0]
+    return _write_stock_sink_chain(sinks, stock_update_rows, skus_to_add_to_solr)
+
+
+def drain_stock_outbox(limit=STOCK_OUTBOX_DRAIN_BATCH_SIZE):
+    """
+    Retries the sink writes of the outbox entries that are due, oldest first.
+
+    An entry is deleted once all of its sinks are written, otherwise it keeps the sinks left and is
+    retried after an exponential backoff. Returns the number of entries drained.
+    """
+    drained = 0
+    for entry in _claim_stock_outbox_entries(limit):
+        sinks = entry['sinks'].split(',')
+        try:
+            sinks, error = _replay_stock_sinks(sinks, json.loads(entry['stock_keys']))
+        except Exception as e:
+            logger.exception(f"stock outbox entry {entry['id']} failed: {e}")
+            error = repr(e)
+        if not sinks:
+            sql(engine_offer, 'DELETE FROM stock_sink_outbox WHERE id = :id', id=entry['id'])
+            drained += 1
+            continue
+        sql(
+            engine_offer,
+            '''
+            UPDATE stock_sink_outbox
+            SET sinks = :sinks, attempts = attempts + 1, last_error = :last_error,
+                next_attempt_at = DATE_ADD(NOW(), INTERVAL :delay SECOND)
+            WHERE id = :id
+        ''',
+            id=entry['id'],
+            sinks=','.join(sinks),
+            last_error=error,
+            delay=min(STOCK_OUTBOX_RETRY_SECONDS * 2 ** (entry['attempts'] + 1), STOCK_OUTBOX_MAX_RETRY_SECONDS),
+        )
+    return drained
+
+
+class StockOutboxDrainer:
+    """
+    Drains the stock sink outbox in a background thread, one per process.
+    """
+
+    def __init__(self, interval=STOCK_OUTBOX_DRAIN_INTERVAL_SECONDS):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+
+    def start(self):
+        with self.lock:
+            # the thread does not survive a fork
+            if self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, name='stock-outbox-drainer', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                # keep going while full batches come back
+                while drain_stock_outbox() == STOCK_OUTBOX_DRAIN_BATCH_SIZE:
+                    pass
+            except Exception as e:
+                logger.exception(f"stock outbox drain failed: {e}")
+            time.sleep(self.interval)
+
+
+stock_outbox_drainer = StockOutboxDrainer()
+
+
+def get_stock_sink_lag():
+    """
+    Per sink: outbox entries waiting to be written, age of the oldest one and this process' write stats.
+    """
+    pending = sql(
+        engine_offer,
+        '''
+        SELECT
+            SUBSTRING_INDEX(sinks, ',', 1) as sink,
+            COUNT(*) as pending,
+            MAX(attempts) as max_attempts,
+            TIMESTAMPDIFF(SECOND, MIN(created_at), NOW()) as lag_seconds
+        FROM stock_sink_outbox
+        GROUP BY sink
+    ''',
+    ).pk_map()
+    return {
+        sink: {
+            'pending': pending.get(sink, {}).get('pending', 0),
+            'max_attempts': pending.get(sink, {}).get('max_attempts', 0),
+            'lag_seconds': pending.get(sink, {}).get('lag_seconds', 0),
+            'writes': stock_sink_stats[f'{sink}_writes'],
+            'failures': stock_sink_stats[f'{sink}_failures'],
+            'write_ms_avg': round(stock_sink_stats[f'{sink}_ms'] / max(stock_sink_stats[f'{sink}_writes'], 1), 2),
+        }
+        for sink in STOCK_SINKS
+    }
+
+
+STOCK_BATCH_MAX_SIZE = int(os.getenv('STOCK_BATCH_MAX_SIZE') or 500)
+STOCK_BATCH_MAX_WAIT_SECONDS = float(os.getenv('STOCK_BATCH_MAX_WAIT_SECONDS') or 1)
+
+
+def _stock_update_key(row):
+    return row['psku_code'], row['warehouse_code']
+
+
+class StockUpdateBatcher:
+    """
+    Collects stock update messages for a short window and reindexes them together.
+
+    Updates are deduped by (psku_code, warehouse_code), the last one wins, so a burst of messages for
+    the same pairs costs a single `reindex_stock` call. The current stock is read from sc at reindex
+    time, so dropping the older duplicates loses nothing. A message is acked only after the batch it
+    is part of has been written, a failed batch nacks all of its messages so they are redelivered.
+
+    Other updates read at reindex time batch the same way with their own `key` and `process`, like
+    the (sku, wh_code) keys of price updates.
+    """
+
+    def __init__(
+        self,
+        max_size=STOCK_BATCH_MAX_SIZE,
+        max_wait=STOCK_BATCH_MAX_WAIT_SECONDS,
+        process=None,
+        key=_stock_update_key,
+        name='stock update',
+    ):
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self.process = process or reindex_stock
+        self.key = key
+        self.name = name
+        self.cond = threading.Condition()
+        self.rows = {}
+        self.messages = []
+        self.opened_at = None
+        self.thread = None
+        self.pid = None
+
+    def add(self, rows, ack, nack=None):
+        with self.cond:
+            self._ensure_flusher()
+            for row in rows:
+                key = self.key(row)
+                self.rows.pop(key, None)
+                self.rows[key] = row
+            self.messages.append((ack, nack))
+            if self.opened_at is None:
+                self.opened_at = time.monotonic()
+            self.cond.notify()
+
+    def _ensure_flusher(self):
+        # the flusher thread does not survive a fork, start one per process
+        if self.pid != os.getpid() or not self.thread.is_alive():
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._run, name=f"{self.name.replace(' ', '-')}-batcher", daemon=True)
+            self.thread.start()
+
+    def _take_batch(self):
+        rows, messages = list(self.rows.values()), self.messages
+        self.rows, self.messages, self.opened_at = {}, [], None
+        return rows, messages
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.opened_at is not None:
+                        remaining = self.opened_at + self.max_wait - time.monotonic()
+                        if remaining <= 0 or len(self.rows) >= self.max_size:
+                            break
+                        self.cond.wait(remaining)
+                    else:
+                        self.cond.wait()
+                rows, messages = self._take_batch()
+            self._process(rows, messages)
+
+    def flush(self):
+        """
+        Processes whatever is pending right away, in the calling thread.
+        """
+        with self.cond:
+            rows, messages = self._take_batch()
+        self._process(rows, messages)
+
+    def _process(self, rows, messages):
+        if not messages:
+            return
+        try:
+            self.process(rows)
+        except Exception as e:
+            logger.exception(f"{self.name} batch of {len(rows)} rows failed: {e}")
+            for _, nack in messages:
+                if nack:
+                    nack()
+            return
+        logger.info(f"{self.name} batch: {len(messages)} messages, {len(rows)} distinct rows")
+        for ack, _ in messages:
+            ack()
+
+
+stock_update_batcher = StockUpdateBatcher()
+
+
+STOCK_REINDEX_PAGE_SIZE = int(os.getenv('STOCK_REINDEX_PAGE_SIZE') or 5000)
+STOCK_REINDEX_CHUNK_SIZE = int(os.getenv('STOCK_REINDEX_CHUNK_SIZE') or 500)
+STOCK_REINDEX_WORKERS = int(os.getenv('STOCK_REINDEX_WORKERS') or 4)
+# a running checkpoint not updated for this long belongs to a run that died, another one may take over
+STOCK_REINDEX_STALE_SECONDS = int(os.getenv('STOCK_REINDEX_STALE_SECONDS') or 15 * 60)
+
+# full reindexes started from this process, by wh_code
+_stock_reindex_threads = {}
+
+
+def get_stock_reindex_checkpoint(wh_code):
+    return sql(
+        engine_offer,
+        '''
+        SELECT wh_code, status, last_psku_code, rows_processed, started_at, updated_at, error
+        FROM stock_reindex_checkpoint
+        WHERE wh_code = :wh_code
+    ''',
+        wh_code=wh_code,
+    ).dict()
+
+
+def _save_stock_reindex_checkpoint(wh_code, status, last_psku_code, rows_processed, started_at, error=None):
+    sqlutil.upsert_batch(
+        engine_offer,
+        StockReindexCheckpoint,
+        [
+            {
+                'wh_code': wh_code,
+                'status': status,
+                'last_psku_code': last_psku_code,
+                'rows_processed': rows_processed,
+                'started_at': started_at,
+                'error': error,
+            }
+        ],
+    )
+
+
+def _claim_stock_reindex(wh_code, resume):
+    """
+    Marks the full reindex of a warehouse as running and returns its checkpoint, or None when a run
+    of any process holds it. With `resume` an unfinished run continues from its checkpoint.
+    """
+    with engine_offer.begin() as conn:
+        # the row is locked for the claim, it has to exist first
+        sql(
+            conn,
+            '''
+            INSERT IGNORE INTO stock_reindex_checkpoint (wh_code, status) VALUES (:wh_code, 'new')
+        ''',
+            wh_code=wh_code,
+        )
+        checkpoint = sql(
+            conn,
+            '''
+            SELECT status, updated_at >= NOW() - INTERVAL :stale SECOND as is_fresh
+            FROM stock_reindex_checkpoint
+            WHERE wh_code = :wh_code
+            FOR UPDATE
+        ''',
+            wh_code=wh_code,
+            stale=STOCK_REINDEX_STALE_SECONDS,
+        ).dict()
+        if checkpoint['status'] == 'running' and checkpoint['is_fresh']:
+            return None
+        if resume and checkpoint['status'] not in ('new', 'done'):
+            reset = ''
+        else:
+            # started_at is set by mysql like updated_at, so the rate derived from them uses one clock
+            reset = ", last_psku_code = '', rows_processed = 0, started_at = NOW()"
+        sql(
+            conn,
+            f'''
+            UPDATE stock_reindex_checkpoint
+            SET status = 'running', error = NULL, updated_at = NOW(){reset}
+            WHERE wh_code = :wh_code
+        ''',
+            wh_code=wh_code,
+        )
+    return get_stock_reindex_checkpoint(wh_code)
+
+
+def _read_stock_page(wh_code, country_code, after_psku_code):
+    return (
         sc_spanner()
         .execute_query(
             '''
         SELECT psku_code, warehouse_code as wh_code, qty_net, @country_code as country_code
         FROM stock
-        WHERE 
-        warehouse_code = @wh_code
+        WHERE warehouse_code = @wh_code
+        AND psku_code > @after_psku_code
+        ORDER BY psku_code
+        LIMIT @page_size
     ''',
             wh_code=wh_code,
             country_code=country_code,
+            after_psku_code=after_psku_code,
+            page_size=STOCK_REINDEX_PAGE_SIZE,
         )
         .dicts()
     )
-    if not stock_rows:
+
+
+def _get_reindex_country_code(wh_code):
+    wh_code_cc_map = get_wh_code_to_country_code_map()
+    if wh_code not in wh_code_cc_map.keys():
+        logger.warning(f"skipping full stock stock update for {wh_code} as it is not on boilerplate")
+        return None
+    return wh_code_cc_map[wh_code].upper()
+
+
+def full_stock_update_for_warehouse(wh_code, resume=True):
+    """
+    Reindexes every stock row of a warehouse, page by page in psku_code order.
+
+    The next page is read while the chunks of the current one go through `stock_update` in parallel.
+    After each page the last psku_code is checkpointed, so with `resume` a run that did not finish
+    continues after it instead of starting over. Only one run of a warehouse goes at a time across
+    processes, the checkpoint row is claimed first.
+    """
+    country_code = _get_reindex_country_code(wh_code)
+    if country_code is None:
         return
-    stock_update(stock_rows, force_product_update=True)
+    checkpoint = _claim_stock_reindex(wh_code, resume)
+    if checkpoint is None:
+        logger.warning(f"full stock update for {wh_code} is already running")
+        return
+    _run_full_stock_update(wh_code, country_code, checkpoint)
+
+
+def _run_full_stock_update(wh_code, country_code, checkpoint):
+    last_psku_code, rows_processed, started_at = (
+        checkpoint['last_psku_code'],
+        checkpoint['rows_processed'],
+        checkpoint['started_at'],
+    )
+    if last_psku_code:
+        logger.info(f"resuming full stock update for {wh_code} after {last_psku_code}, {rows_processed} rows done")
+
+    try:
+        with bulk_solr_indexing(), ThreadPoolExecutor(max_workers=1) as reader, ThreadPoolExecutor(
+            max_workers=STOCK_REINDEX_WORKERS, thread_name_prefix='stock-reindex'
+        ) as workers:
+            next_page = reader.submit(_read_stock_page, wh_code, country_code, last_psku_code)
+            while next_page is not None:
+                page = next_page.result()
+                if not page:
+                    break
+                next_page = None
+                if len(page) == STOCK_REINDEX_PAGE_SIZE:
+                    next_page = reader.submit(_read_stock_page, wh_code, country_code, page[-1]['psku_code'])
+                # one noon cache query for the page instead of one per chunk
+                psku_code_cache.prefetch([row['psku_code'] for row in page])
+                chunks = iterutils.chunked(page, STOCK_REINDEX_CHUNK_SIZE)
+                # the workers run in copies of this context, so their solr updates are part of the bulk job
+                futures = [
+                    workers.submit(contextvars.copy_context().run, stock_update, chunk, force_product_update=True)
+                    for chunk in chunks
+                ]
+                for future in futures:
+                    future.result()
+                last_psku_code, rows_processed = page[-1]['psku_code'], rows_processed + len(page)
+                _save_stock_reindex_checkpoint(wh_code, 'running', last_psku_code, rows_processed, started_at)
+    except Exception as e:
+        _save_stock_reindex_checkpoint(wh_code, 'failed', last_psku_code, rows_processed, started_at, error=str(e))
+        raise
+    _save_stock_reindex_checkpoint(wh_code, 'done', last_psku_code, rows_processed, started_at)
+    logger.info(f"full stock update for {wh_code} done, {rows_processed} rows")
+
+
+def start_full_stock_update_for_warehouse(wh_code, resume=True) -> bool:
+    """
+    Runs the full reindex of a warehouse in a background thread, unless a process already runs one.
+    """
+    country_code = _get_reindex_country_code(wh_code)
+    if country_code is None:
+        return False
+    checkpoint = _claim_stock_reindex(wh_code, resume)
+    if checkpoint is None:
+        return False
+
+    def run():
+        try:
+            _run_full_stock_update(wh_code, country_code, checkpoint)
+        except Exception as e:
+            logger.exception(f"full stock update for {wh_code} failed: {e}")
+
+    thread = threading.Thread(target=run, name=f'stock-reindex-{wh_code}', daemon=True)
+    _stock_reindex_threads[wh_code] = thread
+    thread.start()
+    return True
+
+
+def get_stock_reindex_status(wh_code):
+    checkpoint = get_stock_reindex_checkpoint(wh_code)
+    if not checkpoint:
+        return {'wh_code': wh_code, 'status': 'not_started'}
+    thread = _stock_reindex_threads.get(wh_code)
+    elapsed = (checkpoint['updated_at'] - checkpoint['started_at']).total_seconds() if checkpoint['started_at'] else 0
+    return {
+        **checkpoint,
+        'running_here': thread is not None and thread.is_alive(),
+        'rows_per_second': round(checkpoint['rows_processed'] / elapsed, 2) if elapsed > 0 else None,
+    }
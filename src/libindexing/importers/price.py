@@ -51,9 +51,9 @@ class BoilerplatePriceImport(impexutil.Importer):
             update_columns=['offer_price', 'msrp'],
         )
         to_publish = [{'sku': row['sku'], 'wh_code': row['wh_code']} for row in self.rows]
-        publisher = pubsub.get_publisher('boilerplate_price_update')
-        for chunk in iterutils.chunked(to_publish, 20):
-            publisher(json.dumps(chunk))
+        with pubsub.get_publisher('boilerplate_price_update') as publisher:
+            for chunk in iterutils.chunked(to_publish, 20):
+                publisher(json.dumps(chunk))
 
 
 def preprocess_column_types(rows, params=None):
@@ -84,3 +84,34 @@ class Offer(Model):
     __table_args__ = (
         UniqueConstraint('sku', 'wh_code', name='uq_sku_wh'),
     )
+
+
+class StockReindexCheckpoint(Model):
+    __tablename__ = 'stock_reindex_checkpoint'
+    wh_code = sa.Column(sa.String(50), primary_key=True)
+
+    status = sa.Column(sa.String(20), nullable=False)
+    last_psku_code = sa.Column(sa.String(100), nullable=False, server_default='')
+    rows_processed = sa.Column(BIGINT, nullable=False, server_default='0')
+    started_at = sa.Column(types.TIMESTAMP, nullable=True)
+    error = sa.Column(sa.Text, nullable=True)
+
+
+class StockSinkOutbox(Model):
+    __tablename__ = 'stock_sink_outbox'
+    id = sa.Column(BIGINT, primary_key=True)
+
+    sinks = sa.Column(sa.String(100), nullable=False)
+    stock_keys = sa.Column(sa.Text, nullable=False)
+    attempts = sa.Column(INT, nullable=False, server_default='0')
+    next_attempt_at = sa.Column(types.TIMESTAMP, nullable=False, index=True)
+    last_error = sa.Column(sa.Text, nullable=True)
+
+
+class PskuMapping(Model):
+    __tablename__ = 'psku_mapping'
+    psku_code = sa.Column(sa.String(100), primary_key=True)
+
+    sku = sa.Column(sa.String(50), nullable=False)
+    nsku = sa.Column(sa.String(50), nullable=True)
+    id_partner = sa.Column(INT, nullable=False)
@@ -3,10 +3,11 @@ import logging
 import os
 
 from jsql import sql
-from noonutil.v1 import spannerutil, miscutil
+from noonutil.v1 import miscutil
 
 from liborder import engine
 from liborder.context import ctx
+from libutil.spanner_util import get_spanner_reader, spanner_registry
 
 logger = logging.getLogger(__name__)
 
@@ -14,12 +15,13 @@ BOILERPLATE_SPANNER_INSTANCE_ID = os.getenv('BOILERPLATE_SPANNER_INSTANCE_ID')
 BOILERPLATE_SPANNER_DATABASE_ID = os.getenv('BOILERPLATE_SPANNER_DATABASE_ID')
 BOILERPLATE_SPANNER_PROJECT = os.getenv('BOILERPLATE_SPANNER_PROJECT')
 
+# offers priced into carts and orders are read strong unless this is raised
+ENRICH_OFFERS_STALENESS = float(os.getenv('ENRICH_OFFERS_STALENESS') or 0)
+
 
 def get_spanner_db():
-    return spannerutil.SpannerDB(
-        project=BOILERPLATE_SPANNER_PROJECT,
-        instance=BOILERPLATE_SPANNER_INSTANCE_ID,
-        db=BOILERPLATE_SPANNER_DATABASE_ID,
+    return spanner_registry.db(
+        BOILERPLATE_SPANNER_PROJECT, BOILERPLATE_SPANNER_INSTANCE_ID, BOILERPLATE_SPANNER_DATABASE_ID
     )
 
 
@@ -28,7 +30,9 @@ def enrich_offers(keys):
         return {}
     assert ctx.lang in ['ar', 'en'], "Invalid language"
     enriched_offers = (
-        get_spanner_db()
+        get_spanner_reader(
+            BOILERPLATE_SPANNER_PROJECT, BOILERPLATE_SPANNER_INSTANCE_ID, BOILERPLATE_SPANNER_DATABASE_ID
+        )
         .execute_query(
             f'''
         SELECT
@@ -55,6 +59,7 @@ def enrich_offers(keys):
         LEFT JOIN product_meta USING(sku)
         WHERE STRUCT< sku STRING, wh_code STRING> (sku, wh_code) in UNNEST(@keys)
     ''',
+            staleness=ENRICH_OFFERS_STALENESS,
             keys=keys,
             key_order={'keys': ('sku', 'wh_code')},
         )
@@ -117,11 +117,12 @@ def asql(*args, **kwargs):
     return loop.run_in_executor(SYNC_THREADPOOL, lambda: sql(*args, **kwargs))
 
 
-def asyncify(new_threadpool_size:int=None):
-    if new_threadpool_size is not None:
-        threadpool = concurrent.futures.ThreadPoolExecutor(max_workers=new_threadpool_size)
-    else:
-        threadpool = SYNC_THREADPOOL
+def asyncify(new_threadpool_size:int=None, threadpool:concurrent.futures.Executor=None):
+    if threadpool is None:
+        if new_threadpool_size is not None:
+            threadpool = concurrent.futures.ThreadPoolExecutor(max_workers=new_threadpool_size)
+        else:
+            threadpool = SYNC_THREADPOOL
 
     def decorator(func):
         @functools.wraps(func)
@@ -0,0 +1,201 @@
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+CONSUMER_STATS_INTERVAL_SECONDS = float(os.getenv('CONSUMER_STATS_INTERVAL_SECONDS') or 60)
+
+
+def _env(subscription_key, name, default, type_=int):
+    return type_(os.getenv(f'CONSUMER_{subscription_key}_{name}') or default)
+
+
+class AdaptiveLimiter:
+    """
+    Limit on the messages of a subscription processed at once, adjusted with AIMD.
+
+    After every `window` messages the limit is halved if the 90th percentile processing latency
+    went over `target_latency` or the error rate over `max_error_rate`, otherwise it grows by one
+    if the window used the whole limit. Messages over the limit wait, pubsub keeps extending their
+    lease meanwhile.
+    """
+
+    def __init__(self, initial, minimum, maximum, target_latency, max_error_rate=0.05, window=20):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.cond = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.saturated = False
+        self.latencies = []
+        self.errors = 0
+        self.last_p90 = None
+        self.last_error_rate = None
+
+    def acquire(self):
+        with self.cond:
+            self.waiting += 1
+            self.cond.wait_for(lambda: self.in_flight < self.limit)
+            self.waiting -= 1
+            self.in_flight += 1
+            if self.in_flight >= self.limit:
+                self.saturated = True
+
+    def release(self, latency, ok=True):
+        with self.cond:
+            self.in_flight -= 1
+            self.latencies.append(latency)
+            self.errors += not ok
+            if len(self.latencies) >= self.window:
+                self._adjust()
+            self.cond.notify_all()
+
+    def _adjust(self):
+        latencies = sorted(self.latencies)
+        self.last_p90 = latencies[int(0.9 * (len(latencies) - 1))]
+        self.last_error_rate = self.errors / len(latencies)
+        if self.last_p90 > self.target_latency or self.last_error_rate > self.max_error_rate:
+            self.limit = max(self.minimum, self.limit // 2)
+        elif self.saturated:
+            self.limit = min(self.maximum, self.limit + 1)
+        self.latencies, self.errors, self.saturated = [], 0, False
+
+
+class _SettledMessage:
+    """
+    Pubsub message whose first ack or nack reports the outcome of its processing to `settle(ok)`.
+    """
+
+    def __init__(self, message, settle):
+        self._message = message
+        self._settle = settle
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    def ack(self):
+        self._message.ack()
+        self._settle(True)
+
+    def nack(self):
+        self._message.nack()
+        self._settle(False)
+
+
+class SubscriptionFlow:
+    """
+    Flow control and adaptive concurrency of one subscription, with its processing stats.
+
+    Settings come from `CONSUMER_<KEY>_*` env vars, falling back to the given defaults:
+    MAX_MESSAGES and MAX_BYTES bound the messages pubsub hands out at once, MIN_CONCURRENCY and
+    INITIAL_CONCURRENCY bound the adaptive limit, TARGET_LATENCY_SECONDS and MAX_ERROR_RATE drive it.
+
+    With `deferred_ack` the `wrapper_fn` only hands the message off and something else acks it later,
+    a message then counts as in flight until it is acked or nacked and a nack counts as a failure.
+    """
+
+    def __init__(
+        self, key, max_messages, target_latency, max_bytes=20 * 1024 * 1024, min_concurrency=1, deferred_ack=False
+    ):
+        self.key = key.upper()
+        self.deferred_ack = deferred_ack
+        self.max_messages = _env(self.key, 'MAX_MESSAGES', max_messages)
+        self.max_bytes = _env(self.key, 'MAX_BYTES', max_bytes)
+        self.limiter = AdaptiveLimiter(
+            initial=_env(self.key, 'INITIAL_CONCURRENCY', self.max_messages),
+            minimum=_env(self.key, 'MIN_CONCURRENCY', min_concurrency),
+            maximum=self.max_messages,
+            target_latency=_env(self.key, 'TARGET_LATENCY_SECONDS', target_latency, float),
+            max_error_rate=_env(self.key, 'MAX_ERROR_RATE', 0.05, float),
+        )
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.reported = Counter()
+        self.reported_at = time.monotonic()
+
+    def wrap(self, wrapper_fn):
+        """
+        Runs a subscriber `wrapper_fn` under the adaptive limit and records its outcome.
+        """
+
+        def wrapped(fn, message, subctx):
+            self.limiter.acquire()
+            started = time.monotonic()
+            if self.deferred_ack:
+                return self._run_deferred(wrapper_fn, fn, message, subctx, started)
+            ok = False
+            try:
+                result = wrapper_fn(fn, message, subctx)
+                ok = True
+                return result
+            finally:
+                self._record(time.monotonic() - started, ok)
+
+        return wrapped
+
+    def _run_deferred(self, wrapper_fn, fn, message, subctx, started):
+        settled = threading.Lock()
+
+        def settle(ok):
+            if settled.acquire(blocking=False):
+                self._record(time.monotonic() - started, ok)
+
+        try:
+            return wrapper_fn(fn, _SettledMessage(message, settle), subctx)
+        except Exception:
+            settle(False)
+            raise
+
+    def _record(self, latency, ok):
+        self.limiter.release(latency, ok)
+        with self.lock:
+            self.stats['processed' if ok else 'failed'] += 1
+            self.stats['latency_ms'] += int(latency * 1000)
+
+    def report(self):
+        now = time.monotonic()
+        with self.lock:
+            stats = Counter(self.stats)
+        elapsed = now - self.reported_at
+        done = stats['processed'] + stats['failed'] - self.reported['processed'] - self.reported['failed']
+        report = {
+            'subscription': self.key.lower(),
+            'limit': self.limiter.limit,
+            'in_flight': self.limiter.in_flight,
+            # received by this process and waiting for the limit, the subscription backlog is in pubsub's monitoring
+            'waiting': self.limiter.waiting,
+            'processed': stats['processed'] - self.reported['processed'],
+            'failed': stats['failed'] - self.reported['failed'],
+            'messages_per_second': round(done / elapsed, 2) if elapsed > 0 else None,
+            'latency_ms_avg': round((stats['latency_ms'] - self.reported['latency_ms']) / done, 1) if done else None,
+            'latency_p90_seconds': self.limiter.last_p90,
+            'error_rate': self.limiter.last_error_rate,
+        }
+        self.reported, self.reported_at = stats, now
+        return report
+
+
+def start_stats_reporter(flows, interval=CONSUMER_STATS_INTERVAL_SECONDS):
+    """
+    Logs the stats of every subscription flow each `interval`, as `consumer-stats` records.
+    """
+
+    def run():
+        while True:
+            time.sleep(interval)
+            for flow in flows:
+                try:
+                    logger.info("consumer-stats", extra=flow.report())
+                except Exception as e:
+                    logger.warning(f"could not report stats of {flow.key}: {e}")
+
+    thread = threading.Thread(target=run, name='consumer-stats', daemon=True)
+    thread.start()
+    return thread
@@ -1,30 +1,136 @@
+import atexit
+import logging
 import os
+import threading
+import time
 
 from google.cloud import pubsub
 from google.cloud import pubsub_v1
 from noonutil.v1 import miscutil
 
+logger = logging.getLogger(__name__)
+
 ENV = os.environ['ENV']
 
+MB = 1024 * 1024
+
+PUBSUB_BATCH_MAX_MESSAGES = int(os.getenv('PUBSUB_BATCH_MAX_MESSAGES') or 1000)
+PUBSUB_BATCH_MAX_BYTES = int(os.getenv('PUBSUB_BATCH_MAX_BYTES') or 5 * MB)
+PUBSUB_BATCH_MAX_LATENCY_SECONDS = float(os.getenv('PUBSUB_BATCH_MAX_LATENCY_SECONDS') or 0.05)
+# publishing blocks while this many messages of the process are waiting to be sent
+PUBSUB_MAX_IN_FLIGHT_MESSAGES = int(os.getenv('PUBSUB_MAX_IN_FLIGHT_MESSAGES') or 20000)
+PUBSUB_FLUSH_TIMEOUT_SECONDS = float(os.getenv('PUBSUB_FLUSH_TIMEOUT_SECONDS') or 60)
+PUBSUB_SHUTDOWN_TIMEOUT_SECONDS = float(os.getenv('PUBSUB_SHUTDOWN_TIMEOUT_SECONDS') or 10)
+
+BATCH_SETTINGS = pubsub.types.BatchSettings(
+    max_bytes=PUBSUB_BATCH_MAX_BYTES,
+    max_latency=PUBSUB_BATCH_MAX_LATENCY_SECONDS,
+    max_messages=PUBSUB_BATCH_MAX_MESSAGES,
+)
+
+# process-wide publisher clients by message ordering, with the pid they were created in
+_pub_clients = {}
+_pub_clients_lock = threading.Lock()
+# the client of the pinned google-cloud-pubsub has no publish flow control, a slot is taken before
+# each publish and given back when the message is sent or failed
+_in_flight_slots = threading.BoundedSemaphore(PUBSUB_MAX_IN_FLIGHT_MESSAGES)
+# messages published by this process and not sent yet
+_in_flight = 0
+_in_flight_cond = threading.Condition()
+
+
+def _publish(client, topic, data, **kwargs):
+    global _in_flight
+    _in_flight_slots.acquire()
+    try:
+        future = client.publish(topic, data, **kwargs)
+    except Exception:
+        _in_flight_slots.release()
+        raise
+    with _in_flight_cond:
+        _in_flight += 1
+
+    def done(_):
+        global _in_flight
+        with _in_flight_cond:
+            _in_flight -= 1
+            _in_flight_cond.notify_all()
+        _in_flight_slots.release()
+
+    future.add_done_callback(done)
+    return future
+
 
 def pub(topic, message, project=None):
     client = get_pub_client()
-    return client.publish(get_topic_key(topic, project), str_to_bytes(message))
+    return _publish(client, get_topic_key(topic, project), str_to_bytes(message))
 
 
-def get_publisher(topic, project=None):
-    client = get_pub_client()
-    topic = get_topic_key(topic, project)
-    return lambda msg: client.publish(topic, str_to_bytes(msg)).result()
+class Publisher:
+    """
+    Publishes to a topic through the process-wide client, without waiting for each message.
 
+    Messages are batched by the client and publishing only blocks while too many are in flight.
+    `flush` waits for the messages published through this object and raises if any failed, use the
+    publisher as a context manager to flush on exit.
+    """
 
-MB = 1024 * 1024
-DEFAULT_FLOW = pubsub.types.FlowControl(max_bytes=20 * MB, max_messages=10)
+    def __init__(self, topic, ordering=False):
+        self.topic = topic
+        self.client = get_pub_client(ordering=ordering)
+        self.futures = []
+
+    def __call__(self, message, ordering_key='', **attrs):
+        future = _publish(self.client, self.topic, str_to_bytes(message), ordering_key=ordering_key, **attrs)
+        self.futures.append((future, ordering_key))
+        return future
+
+    def flush(self, timeout=PUBSUB_FLUSH_TIMEOUT_SECONDS):
+        deadline = time.monotonic() + timeout
+        futures, self.futures = self.futures, []
+        errors = []
+        for future, ordering_key in futures:
+            try:
+                future.result(timeout=max(deadline - time.monotonic(), 0))
+            except Exception as e:
+                errors.append(e)
+                if ordering_key:
+                    # an ordering key stops publishing after a failure until it is resumed
+                    self.client.resume_publish(self.topic, ordering_key)
+        if errors:
+            logger.error(f"{len(errors)} of {len(futures)} messages to {self.topic} were not published: {errors[0]}")
+            raise errors[0]
+        return len(futures)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.flush()
+
+
+def get_publisher(topic, project=None, ordering=False):
+    return Publisher(get_topic_key(topic, project), ordering=ordering)
+
+
+def _flush_on_shutdown():
+    # batches are sent by the client's threads after at most PUBSUB_BATCH_MAX_LATENCY_SECONDS
+    with _in_flight_cond:
+        if not _in_flight_cond.wait_for(lambda: _in_flight == 0, timeout=PUBSUB_SHUTDOWN_TIMEOUT_SECONDS):
+            logger.error(f"exiting with {_in_flight} pubsub messages not published")
+
+
+atexit.register(_flush_on_shutdown)
+
+DEFAULT_FLOW = pubsub.types.FlowControl(
+    max_bytes=int(os.getenv('PUBSUB_FLOW_MAX_BYTES') or 20 * MB),
+    max_messages=int(os.getenv('PUBSUB_FLOW_MAX_MESSAGES') or 10),
+)
 
 
-def sub(subscription, callback, project=None):
+def sub(subscription, callback, project=None, flow_control=DEFAULT_FLOW):
     client = get_sub_client()
-    return client.subscribe(get_subscription_key(subscription, project), callback=callback, flow_control=DEFAULT_FLOW)
+    return client.subscribe(get_subscription_key(subscription, project), callback=callback, flow_control=flow_control)
 
 
 def subpull(subscription, project=None, max_pull_messages=10):
@@ -44,8 +150,17 @@ def acknowlegde(subscription, ids, project=None):
     )
 
 
-def get_pub_client():
-    return pubsub.PublisherClient()
+def get_pub_client(ordering=False):
+    with _pub_clients_lock:
+        client, pid = _pub_clients.get(ordering, (None, None))
+        # the client's batching threads do not survive a fork
+        if client is None or pid != os.getpid():
+            client = pubsub.PublisherClient(
+                batch_settings=BATCH_SETTINGS,
+                publisher_options=pubsub.types.PublisherOptions(enable_message_ordering=ordering),
+            )
+            _pub_clients[ordering] = (client, os.getpid())
+        return client
 
 
 def get_sub_client():
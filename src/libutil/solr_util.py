@@ -1,9 +1,15 @@
+import asyncio
+
 import aiosolr
+import async_timeout
 import requests
 
 from libutil.spanner_util import *
 
-SOLR_SEMAPHORE = os.getenv('SOLR_SEMAPHORE') or 2
+SOLR_SEMAPHORE = int(os.getenv('SOLR_SEMAPHORE') or 2)
+# read path pool: max concurrent queries per worker and per query timeout (seconds)
+SOLR_MAX_CONNECTIONS = int(os.getenv('SOLR_MAX_CONNECTIONS') or 20)
+SOLR_QUERY_TIMEOUT = float(os.getenv('SOLR_QUERY_TIMEOUT') or 5)
 
 logger = logging.getLogger(__name__)
 
@@ -101,3 +107,57 @@ class BoilerplateSolr(Solr):
             kwargs['params'] = []
         return await super().query(handler=handler, query=query,
                                    spellcheck=spellcheck, spellcheck_dicts=spellcheck_dicts, **kwargs)
+
+
+class SolrPool:
+    """
+    Process wide solr clients, one per core, reused by every request of a worker.
+
+    Reusing the client keeps its http session (and the keep-alive connections in it) open
+    between requests. Concurrent queries are capped at `max_connections` and each query runs
+    under its own timeout. Sessions are bound to the event loop and must not cross a fork,
+    so the clients are recreated when either changes.
+    """
+
+    def __init__(self, host=SOLR_HOST, port="8983", max_connections=SOLR_MAX_CONNECTIONS, timeout=SOLR_QUERY_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.clients = {}
+        self.loop = None
+        self.pid = None
+        self.semaphore = None
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.pid != os.getpid():
+            self.clients = {}
+            self.loop = loop
+            self.pid = os.getpid()
+            self.semaphore = asyncio.Semaphore(self.max_connections)
+
+    def get(self, collection) -> BoilerplateSolr:
+        self._bind()
+        client = self.clients.get(collection)
+        if client is None:
+            client = BoilerplateSolr(host=self.host, collection=collection, port=self.port)
+            self.clients[collection] = client
+        return client
+
+    async def query(self, collection, query="*", params=None, timeout=None, handler="select"):
+        client = self.get(collection)
+        async with self.semaphore:
+            async with async_timeout.timeout(timeout or self.timeout):
+                return await client.query(handler=handler, query=query, params=params or [])
+
+    async def close(self):
+        clients, self.clients = self.clients, {}
+        for client in clients.values():
+            try:
+                await client.close()
+            except Exception as e:
+                logger.warning(f"error closing solr client: {e}")
+
+
+solr_pool = SolrPool()
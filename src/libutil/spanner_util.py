@@ -1,9 +1,15 @@
+import collections
+import datetime
 import logging
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 from boltons import iterutils
-from noonutil.v1 import spannerutil
+from google.cloud import spanner
+from google.cloud.spanner_v1 import param_types
 from retrying import retry
 
 IS_PRODUCTION = os.getenv('ENV') not in ('dev', 'staging')
@@ -18,35 +24,107 @@ NOON_SPANNER_PROJECT = os.getenv('NOON_SPANNER_PROJECT')
 
 IS_TESTING = os.getenv('TESTING') == 'pytest'
 
+SPANNER_POOL_SIZE = int(os.getenv('SPANNER_POOL_SIZE') or 20)
+SPANNER_POOL_TIMEOUT = int(os.getenv('SPANNER_POOL_TIMEOUT') or 10)
+
+# staleness (seconds) of reads that opt into bounded staleness, tests load data and read it right away
+SPANNER_READ_STALENESS = float(os.getenv('SPANNER_READ_STALENESS') or (0 if IS_TESTING else 10))
+
 logger = logging.getLogger(__name__)
 
 
+class RowEncoder:
+    """
+    Encodes rows of a SpannerBaseModel into value lists in the model's field order.
+
+    The field tuple and one converter per field are built once per model, rows are then converted
+    column by column without looking at the model again.
+    """
+
+    def __init__(self, model):
+        fields, converters = [], []
+        for attr, member in model.__members__.items():
+            # Ignore Private variables
+            if attr[0] == '_':
+                continue
+            fields.append(attr)
+            converters.append(self._converter(model, attr, member.value))
+        self.model = model
+        self.fields = tuple(fields)
+        self.converters = tuple(converters)
+
+    @staticmethod
+    def _converter(model, attr, _type):
+        to_type, default, null = _type.type, _type.default, _type.null
+
+        def convert(val):
+            if val is None:
+                return null
+            if val.__class__ is to_type:
+                return val
+            try:
+                return to_type(val)
+            except Exception as e:
+                logger.warning("SpannerBaseModel type error {0} {1} {2} {3}".format(model, e, attr, val))
+                return default
+
+        if to_type in (str, int, float, bool):
+            return convert
+
+        def convert_any(val):
+            # custom converters (dates) always run, they normalize values of their own type too
+            if val is None:
+                return null
+            try:
+                return to_type(val)
+            except Exception as e:
+                logger.warning("SpannerBaseModel type error {0} {1} {2} {3}".format(model, e, attr, val))
+                return default
+
+        return convert_any
+
+    def encode(self, rows) -> list:
+        """
+        Value lists of `rows`, a list of dicts.
+        """
+        rows = rows if isinstance(rows, list) else list(rows)
+        return self.encode_columns({field: [row.get(field) for row in rows] for field in self.fields}, len(rows))
+
+    def encode_columns(self, columns: dict, size: int = None) -> list:
+        """
+        Value lists of column oriented rows, `{field: [value, ...]}`. Missing fields are null.
+        """
+        if size is None:
+            size = len(next(iter(columns.values()), []))
+        missing = [None] * size
+        encoded = [
+            list(map(convert, columns.get(field, missing))) for field, convert in zip(self.fields, self.converters)
+        ]
+        return [list(row) for row in zip(*encoded)]
+
+
+_row_encoders = {}
+
+
 class SpannerBaseModel(Enum):
+    @classmethod
+    def encoder(cls) -> RowEncoder:
+        encoder = _row_encoders.get(cls)
+        if encoder is None:
+            encoder = _row_encoders[cls] = RowEncoder(cls)
+        return encoder
 
     @classmethod
     def get_fields(cls):
-        for attr in cls.__members__.keys():
-            # Ignore Private variables
-            if attr[0] != '_':
-                yield attr
+        return iter(cls.encoder().fields)
 
     @classmethod
     def get_values(cls, values_list):
-        for values in values_list:
-            row = []
-            for attr, _type in cls.__members__.items():
-                # Ignore Private variables
-                if attr[0] == '_':
-                    continue
-                val = values.get(attr)
-                try:
-                    val = _type.value.type(val) if val is not None else _type.value.null
-                except Exception as e:
-                    logger.warning("SpannerBaseModel type error {0} {1} {2} {3}".format(
-                        cls, e, attr, val))
-                    val = _type.value.default
-                row.append(val)
-            yield row
+        return iter(cls.encoder().encode(values_list))
+
+    @classmethod
+    def get_column_count(cls):
+        return len(cls.encoder().fields)
 
     @classmethod
     @retry(stop_max_attempt_number=3, wait_fixed=50)
@@ -55,17 +133,119 @@ class SpannerBaseModel(Enum):
 
     @classmethod
     def upsert(cls, connection, table_name, values_list):
-        for chunk in iterutils.chunked(values_list, 500):
-            cls._upsert(connection, table_name, chunk)
+        upsert_tables(connection, [(cls, table_name, values_list)])
 
 
-def get_spanner_db(spanner_project_name, spanner_instance_id, spanner_database_id):
-    return spannerutil.SpannerDB(
-        spanner_project_name, spanner_instance_id, spanner_database_id,
-        pool_size=20, default_timeout=10, custom_pool_ping=False
+# spanner rejects commits of more mutations than this, an upserted row costs one mutation per column
+# plus one per secondary index it writes to
+SPANNER_MAX_MUTATIONS_PER_COMMIT = int(os.getenv('SPANNER_MAX_MUTATIONS_PER_COMMIT') or 20000)
+# share of the limit kept free for index mutations not counted in SPANNER_INDEX_MUTATIONS
+SPANNER_MUTATION_HEADROOM = float(os.getenv('SPANNER_MUTATION_HEADROOM') or 0.2)
+# index mutations per upserted row by table, "table:count,table:count"
+SPANNER_INDEX_MUTATIONS = {
+    table_name: int(count)
+    for table_name, count in (
+        item.split(':') for item in (os.getenv('SPANNER_INDEX_MUTATIONS') or '').split(',') if item
+    )
+}
+SPANNER_UPSERT_PARALLELISM = int(os.getenv('SPANNER_UPSERT_PARALLELISM') or 4)
+
+spanner_write_threadpool = ThreadPoolExecutor(
+    max_workers=SPANNER_UPSERT_PARALLELISM, thread_name_prefix='spanner-write'
+)
+# commits, rows, mutations and commit latency (ms) by table, or tables joined by '+' for combined commits
+spanner_write_stats = collections.defaultdict(collections.Counter)
+_spanner_write_stats_lock = threading.Lock()
+
+
+def _mutation_budget():
+    return int(SPANNER_MAX_MUTATIONS_PER_COMMIT * (1 - SPANNER_MUTATION_HEADROOM))
+
+
+def _mutation_batches(tables):
+    """
+    Splits aligned row lists of one or more tables into index ranges whose rows, across all the
+    tables, fit in a commit.
+    """
+    size = len(tables[0][2])
+    assert all(len(rows) == size for _, _, rows in tables), "tables committed together need aligned rows"
+    mutations_per_index = sum(
+        model.get_column_count() + SPANNER_INDEX_MUTATIONS.get(table_name, 0) for model, table_name, _ in tables
+    )
+    rows_per_batch = max(1, _mutation_budget() // mutations_per_index)
+    return [(start, min(start + rows_per_batch, size)) for start in range(0, size, rows_per_batch)], mutations_per_index
+
+
+@retry(stop_max_attempt_number=3, wait_fixed=50)
+def _commit_batch(database, tables, start, end):
+    with database.batch() as batch:
+        for model, table_name, rows in tables:
+            encoder = model.encoder()
+            batch.insert_or_update(table_name, encoder.fields, encoder.encode(rows[start:end]))
+
+
+def upsert_tables(connection, tables):
+    """
+    Upserts `[(model, table_name, rows), ...]`. Several tables are written in the same commits, which
+    needs their rows aligned (row i of each table belongs together, like product / product_en / product_ar).
+
+    Rows are batched by spanner's mutation limit, less SPANNER_MUTATION_HEADROOM, using the tables'
+    column counts and SPANNER_INDEX_MUTATIONS, and the batches are committed in parallel, up to
+    SPANNER_UPSERT_PARALLELISM.
+    """
+    tables = [(model, table_name, list(rows)) for model, table_name, rows in tables]
+    if not tables[0][2]:
+        return
+    key = '+'.join(table_name for _, table_name, _ in tables)
+    batches, mutations_per_index = _mutation_batches(tables)
+    database = spanner_registry.database_for(connection)
+    if database is None:
+        # a connection from outside the registry, write each table through it
+        for model, table_name, rows in tables:
+            mutations_per_row = model.get_column_count() + SPANNER_INDEX_MUTATIONS.get(table_name, 0)
+            rows_per_batch = max(1, _mutation_budget() // mutations_per_row)
+            for chunk in iterutils.chunked(rows, rows_per_batch):
+                model._upsert(connection, table_name, chunk)
+        return
+
+    def commit(start, end):
+        started = time.monotonic()
+        _commit_batch(database, tables, start, end)
+        return (time.monotonic() - started) * 1000
+
+    if len(batches) == 1:
+        latencies = [commit(*batches[0])]
+    else:
+        latencies = list(spanner_write_threadpool.map(lambda batch: commit(*batch), batches))
+    rows = len(tables[0][2])
+    # upserts run on several threads at once
+    with _spanner_write_stats_lock:
+        stats = spanner_write_stats[key]
+        stats.update(
+            {
+                'commits': len(batches),
+                'rows': rows,
+                'mutations': rows * mutations_per_index,
+                'commit_ms_total': sum(latencies),
+            }
+        )
+        stats['commit_ms_max'] = max(stats['commit_ms_max'], *latencies)
+    logger.info(
+        "spanner-upsert",
+        extra={
+            'tables': key,
+            'rows': rows,
+            'commits': len(batches),
+            'mutations': rows * mutations_per_index,
+            'time_ms': max(latencies),
+        },
     )
 
 
+def get_spanner_db(spanner_project_name, spanner_instance_id, spanner_database_id):
+    return spanner_registry.db(spanner_project_name, spanner_instance_id, spanner_database_id)
+
+
 def boilerplate_spanner():
     return get_spanner_db(BOILERPLATE_SPANNER_PROJECT, BOILERPLATE_SPANNER_INSTANCE_ID, BOILERPLATE_SPANNER_DATABASE_ID)
 
@@ -76,3 +256,263 @@ def sc_spanner():
 
 def noon_cache_spanner():
     return get_spanner_db(NOON_SPANNER_PROJECT, NOON_SPANNER_INSTANCE_ID, "cache")
+
+
+class ReadResult(list):
+    """
+    Rows of a read only query or key read as dicts, with the accessors of spannerutil results.
+    """
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        super().__init__(dict(zip(columns, row)) for row in rows)
+
+    def dicts(self):
+        return list(self)
+
+    def dict(self):
+        return self[0] if self else None
+
+    def pk_map(self):
+        return {row[self.columns[0]]: row for row in self}
+
+    def kv_map(self):
+        return {row[self.columns[0]]: row[self.columns[1]] for row in self}
+
+    def scalars(self):
+        return [row[self.columns[0]] for row in self]
+
+
+def _param_type(value):
+    if isinstance(value, bool):
+        return param_types.BOOL
+    if isinstance(value, int):
+        return param_types.INT64
+    if isinstance(value, float):
+        return param_types.FLOAT64
+    if isinstance(value, bytes):
+        return param_types.BYTES
+    if isinstance(value, datetime.datetime):
+        return param_types.TIMESTAMP
+    if isinstance(value, datetime.date):
+        return param_types.DATE
+    return param_types.STRING
+
+
+def _to_param_types(params, key_order):
+    types = {}
+    for name, value in params.items():
+        if not isinstance(value, (list, tuple)):
+            types[name] = _param_type(value)
+            continue
+        first = value[0] if value else None
+        if isinstance(first, (list, tuple)):
+            # array of structs, field names come from key_order like spannerutil. Without it the fields
+            # are anonymous, enough for `(a, b) IN UNNEST(@param)` which compares them by position
+            fields = key_order.get(name) or [''] * len(first)
+            types[name] = param_types.Array(
+                param_types.Struct(
+                    [
+                        param_types.StructField(field, _param_type(field_value))
+                        for field, field_value in zip(fields, first)
+                    ]
+                )
+            )
+        else:
+            types[name] = param_types.Array(_param_type(first))
+    return types
+
+
+class InstrumentedFixedSizePool(spanner.FixedSizePool):
+    """
+    FixedSizePool that keeps track of sessions in use and of how long checkouts wait for one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_use = 0
+        self.stats = collections.Counter()
+        self._stats_lock = threading.Lock()
+
+    def get(self, *args, **kwargs):
+        started = time.monotonic()
+        session = super().get(*args, **kwargs)
+        wait_ms = (time.monotonic() - started) * 1000
+        with self._stats_lock:
+            self.in_use += 1
+            self.stats['checkouts'] += 1
+            self.stats['wait_ms_total'] += wait_ms
+            self.stats['wait_ms_max'] = max(self.stats['wait_ms_max'], wait_ms)
+        return session
+
+    def put(self, session):
+        super().put(session)
+        with self._stats_lock:
+            self.in_use -= 1
+
+    def metrics(self):
+        with self._stats_lock:
+            checkouts = self.stats['checkouts']
+            return {
+                'size': self.size,
+                'in_use': self.in_use,
+                'checkouts': checkouts,
+                'wait_ms_avg': round(self.stats['wait_ms_total'] / checkouts, 3) if checkouts else 0,
+                'wait_ms_max': round(self.stats['wait_ms_max'], 3),
+            }
+
+
+class SpannerReader:
+    """
+    Read only access to a spanner database.
+
+    Reads run in single use snapshots, strong by default or bounded by `staleness` seconds when the
+    call site opts in, stale reads are served by the nearest replica without going to the leader.
+    `read()` looks rows up by primary key instead of running sql.
+    """
+
+    def __init__(
+        self, project, instance_id, database_id, pool_size=SPANNER_POOL_SIZE, default_timeout=SPANNER_POOL_TIMEOUT
+    ):
+        client = spanner.Client(project=project)
+        # a fixed size pool creates all its sessions when the database binds it
+        self.pool = InstrumentedFixedSizePool(size=pool_size, default_timeout=default_timeout)
+        self.database = client.instance(instance_id).database(database_id, pool=self.pool)
+
+    def snapshot(self, staleness: float = 0, multi_use: bool = False):
+        """
+        Several reads in one snapshot see the same data, they need multi_use and then an exact staleness.
+        """
+        if not staleness:
+            return self.database.snapshot(multi_use=multi_use)
+        if multi_use:
+            return self.database.snapshot(exact_staleness=datetime.timedelta(seconds=staleness), multi_use=True)
+        return self.database.snapshot(max_staleness=datetime.timedelta(seconds=staleness))
+
+    def execute_query(self, query, staleness: float = 0, key_order=None, **params) -> ReadResult:
+        with self.snapshot(staleness) as snapshot:
+            results = snapshot.execute_sql(query, params=params, param_types=_to_param_types(params, key_order or {}))
+            rows = list(results)
+            return ReadResult([field.name for field in results.fields], rows)
+
+    def read(
+        self, table, columns, keys=(), key_prefixes=(), index='', staleness: float = 0, snapshot=None
+    ) -> ReadResult:
+        """
+        Rows of `table` by full primary key (`keys`) or by leading key parts (`key_prefixes`).
+        Pass `snapshot` to read in an already open multi use snapshot.
+        """
+        keyset = spanner.KeySet(
+            keys=[list(key) if isinstance(key, (list, tuple)) else [key] for key in keys],
+            ranges=[
+                spanner.KeyRange(start_closed=prefix, end_closed=prefix)
+                for prefix in (list(p) if isinstance(p, (list, tuple)) else [p] for p in key_prefixes)
+            ],
+        )
+        if snapshot is not None:
+            return ReadResult(list(columns), snapshot.read(table, columns, keyset, index=index))
+        with self.snapshot(staleness) as single_use:
+            return ReadResult(list(columns), single_use.read(table, columns, keyset, index=index))
+
+
+class SpannerDatabase(SpannerReader):
+    """
+    Read and write access to a spanner database, through the same session pool as its reads.
+
+    Offers the calls the code base makes on spannerutil databases: `execute_query` / `execute_sql`
+    return a ReadResult, `execute_update` runs DML in a transaction and `insert_or_update` commits rows.
+    """
+
+    def execute_sql(self, query, key_order=None, **params) -> ReadResult:
+        return self.execute_query(query, key_order=key_order, **params)
+
+    def execute_update(self, query, key_order=None, **params) -> int:
+        types = _to_param_types(params, key_order or {})
+        return self.database.run_in_transaction(
+            lambda transaction: transaction.execute_update(query, params=params, param_types=types)
+        )
+
+    def insert_or_update(self, table, columns, values):
+        with self.database.batch() as batch:
+            batch.insert_or_update(table, list(columns), list(values))
+
+    def batch(self):
+        return self.database.batch()
+
+
+class SpannerRegistry:
+    """
+    One SpannerDatabase per (project, instance, database) in each process, reads and writes share
+    its session pool, so a database holds SPANNER_POOL_SIZE sessions against the quota.
+
+    Creating a database client opens its whole session pool, so it happens once per worker (or at
+    `warmup()`, before the worker takes traffic) instead of on every call. Clients hold grpc channels
+    that must not be shared across a fork, a forked child starts with an empty registry.
+    """
+
+    def __init__(self):
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.databases = {}
+
+    def db(self, project, instance_id, database_id) -> SpannerDatabase:
+        if self.pid != os.getpid():
+            self._reset()
+        key = (project, instance_id, database_id)
+        database = self.databases.get(key)
+        if database is None:
+            with self.lock:
+                database = self.databases.get(key)
+                if database is None:
+                    database = self.databases[key] = SpannerDatabase(*key)
+        return database
+
+    # reads go through the same database, the name tells read only call sites apart
+    reader = db
+
+    def warmup(self, keys):
+        """
+        Opens the session pools of the given (project, instance, database) keys.
+        """
+        for key in keys:
+            try:
+                self.db(*key)
+            except Exception as e:
+                logger.warning(f"spanner warmup failed for {key}: {e}")
+
+    def database_for(self, db):
+        """
+        The google client database of a SpannerDatabase handed out by this registry, None for any other.
+        """
+        for registered in list(self.databases.values()):
+            if registered is db:
+                return registered.database
+        return None
+
+    def metrics(self):
+        return {'/'.join(map(str, key)): database.pool.metrics() for key, database in list(self.databases.items())}
+
+
+spanner_registry = SpannerRegistry()
+
+BOILERPLATE_SPANNER_KEY = (
+    BOILERPLATE_SPANNER_PROJECT,
+    BOILERPLATE_SPANNER_INSTANCE_ID,
+    BOILERPLATE_SPANNER_DATABASE_ID,
+)
+SC_SPANNER_KEY = (NOON_SPANNER_PROJECT, NOON_SPANNER_INSTANCE_ID, NOON_SPANNER_DATABASE_ID)
+NOON_CACHE_SPANNER_KEY = (NOON_SPANNER_PROJECT, NOON_SPANNER_INSTANCE_ID, "cache")
+
+
+def get_spanner_reader(spanner_project_name, spanner_instance_id, spanner_database_id) -> SpannerReader:
+    return spanner_registry.reader(spanner_project_name, spanner_instance_id, spanner_database_id)
+
+
+def boilerplate_spanner_reader() -> SpannerReader:
+    return get_spanner_reader(
+        BOILERPLATE_SPANNER_PROJECT, BOILERPLATE_SPANNER_INSTANCE_ID, BOILERPLATE_SPANNER_DATABASE_ID
+    )
@@ -1,5 +1,6 @@
 import pydantic
 import pytest
+import requests
 from noonutil.v1 import storageutil
 
 from tests.order.mocks.helpers import mock_read_from_cloud
@@ -62,6 +63,27 @@ def test_search_suggestions_short_query(app_catalog):
     }
 
 
+def test_autocomplete_index():
+    from libcatalog.domain.autocomplete import AutocompleteIndex, ProductEntry, EPOCH
+    from libcatalog.domain.category import get_category_index
+
+    index = AutocompleteIndex(
+        {
+            'SKU-1': ProductEntry('al_rawabi', 'Al Rawabi Milk 1L', 'Al Rawabi', 'حليب الروابي', 'الروابي'),
+            'SKU-2': ProductEntry(None, 'Milk Powder', None, None, None),
+        },
+        get_category_index(),
+        EPOCH,
+    )
+    # titles starting with the prefix rank first
+    assert index.lookup('milk', 'en') == ([], [], ['SKU-2', 'SKU-1'])
+    assert index.lookup('milk', 'en', products=1) == ([], [], ['SKU-2'])
+    assert index.lookup('RAWA', 'en') == ([{'code': 'al_rawabi', 'name': 'Al Rawabi'}], [], ['SKU-1'])
+    assert index.lookup('الروابي', 'ar')[0] == [{'code': 'al_rawabi', 'name': 'الروابي'}]
+    assert index.lookup('cat3', 'en')[1] == [{'code': 'milk', 'name': 'cat3'}]
+    assert index.lookup('yoghurt', 'en') == ([], [], [])
+
+
 def test_search_english(app_catalog, setup_spanner):
     response = app_catalog.get('/search?q=Milk')
     assert response.status_code == 200, f"Expected 200 status code: got {response.status_code}"
@@ -241,6 +263,74 @@ def test_search_with_sort(app_catalog, setup_spanner):
     }
 
 
+def test_search_with_cursor(app_catalog, setup_spanner):
+    from libcatalog.domain.search import search_drop_rates
+
+    # no over-fetch, so the first page is exactly two docs
+    search_drop_rates.clear()
+    response = app_catalog.get('/search?f[category]=dairy&rows=2&cursor=*')
+    assert response.status_code == 200, f"Expected 200 status code: got {response.status_code}"
+    data = response.json()
+    assert data['nbHits'] == 3
+    assert data['nextCursor']
+    response = app_catalog.get(f"/search?f[category]=dairy&rows=2&cursor={data['nextCursor']}")
+    assert response.status_code == 200, f"Expected 200 status code: got {response.status_code}"
+    assert response.json()['nextCursor'] is None
+    response = app_catalog.get('/search?f[category]=dairy&rows=2&cursor=not-a-cursor')
+    assert response.status_code == 400
+
+
+def test_search_pages_do_not_backfill_dropped_docs(app_catalog, setup_spanner, monkeypatch):
+    from libcatalog.domain import search
+
+    dropped_sku = 'ZG19FDA9EAE0889BA47A9Z-1'
+    get_active_offer_rows_async = search.get_active_offer_rows_async
+
+    async def without_dropped_sku(sku_list):
+        return [row for row in await get_active_offer_rows_async(sku_list) if row['sku'] != dropped_sku]
+
+    monkeypatch.setattr(search, 'get_active_offer_rows_async', without_dropped_sku)
+    search.search_drop_rates.clear()
+    pages = []
+    for page_nr in (1, 2):
+        response = app_catalog.get(f'/search?f[category]=dairy&rows=2&page={page_nr}')
+        assert response.status_code == 200, f"Expected 200 status code: got {response.status_code}"
+        modules = response.json()['results'][0]['modules']
+        pages.append([product['sku'] for module in modules for product in module['products']])
+    # the page holding the dropped doc stays short rather than taking docs of the next page
+    assert min(len(page) for page in pages) < 2
+    assert sorted(pages[0] + pages[1]) == ['ZT19FDA9EAE0889BA47A9Z-1', 'ZU19FDA9EAE0889BA47A9Z-1']
+    drop_rates = app_catalog.get('/public/search_stats').json()['drop_rates']
+    assert (drop_rates['offer_ae']['fetched'], drop_rates['offer_ae']['dropped']) == (3, 1)
+
+
+def test_search_cursor_resumes_after_the_docs_shown():
+    from libcatalog.domain.search import _next_cursor, _take_page, decode_search_cursor
+
+    docs = [{'sku': sku} for sku in 'abcde']
+    # b has no sellable offer
+    page, consumed = _take_page(docs, [{'sku': sku} for sku in 'acde'], 2)
+    assert ([row['sku'] for row in page], consumed) == (['a', 'c'], 3)
+
+    windows = [({'response': {'docs': docs}, 'nextCursorMark': 'm2'}, 'm1', 5)]
+    assert decode_search_cursor(_next_cursor(windows, consumed, 1, consumed, 10)) == ('m1', 2, 3, 3)
+    assert decode_search_cursor(_next_cursor(windows, 5, 1, 5, 10)) == ('m2', 2, 0, 5)
+    assert _next_cursor(windows, 5, 1, 5, 5) is None
+
+
+def test_search_drop_rate_overfetch():
+    from libcatalog.domain.search import DropRate
+
+    drop_rate = DropRate(alpha=0.5, max_factor=2)
+    assert drop_rate.fetch_rows(20) == 20
+    drop_rate.observe('offer_ae', fetched=20, dropped=10)
+    assert drop_rate.fetch_rows(20) == 27
+    for _ in range(10):
+        drop_rate.observe('offer_ae', fetched=20, dropped=20)
+    assert drop_rate.fetch_rows(20) == 40
+    assert drop_rate.stats['dropped'] == 210
+
+
 def test_search_multiple_filters(app_catalog, setup_spanner):
     response = app_catalog.get('/search?q=Rawabi&f[price_min]=100&f[price_max]=200&sort[by]=price&sort[dir]=desc')
     assert response.status_code == 200, f"Expected 200 status code: got {response.status_code}"
@@ -402,7 +492,33 @@ def test_empty_search_return_homepage_post(app_catalog):
 def test_navpills_search(app_catalog):
     response = app_catalog.get('/search?f[category]=oil', json={})
     assert response.json()['navPills'] == []
-    assert response.json()['facets'] == []
+    assert response.json()['facets'] == [
+        {
+            'code': 'category',
+            'name': 'Category',
+            'type': 'category',
+            'data': [
+                {'name': 'cat2', 'code': 'breakfast', 'count': 2, 'children': [], 'isSelected': False},
+                {
+                    'name': 'cat2',
+                    'code': 'dairy',
+                    'count': 3,
+                    'children': [
+                        {'name': 'cat3', 'code': 'milk', 'count': 1, 'children': [], 'isSelected': False},
+                        {'name': 'cat4', 'code': 'oil', 'count': 2, 'children': [], 'isSelected': True},
+                    ],
+                    'isSelected': False,
+                },
+            ],
+        },
+        {
+            'code': 'brand',
+            'name': 'Brand',
+            'type': 'brand',
+            'data': [{'name': 'my_brand_test_2', 'code': 'my_brand_test_2', 'count': 2, 'isSelected': False}],
+        },
+        {'code': 'price', 'name': 'Price', 'type': 'range', 'data': {'min': 150.0, 'max': 230.0}},
+    ]
     response = app_catalog.get('/search?f[category]=oil&f[category]=dairy', json={})
     assert response.json()['navPills'] == [
         {
@@ -437,19 +553,26 @@ def test_navpills_search(app_catalog):
             'name': 'Category',
             'type': 'category',
             'data': [
-                {'name': 'cat2', 'code': 'breakfast', 'count': 1, 'children': [], 'isSelected': False},
+                {'name': 'cat2', 'code': 'breakfast', 'count': 2, 'children': [], 'isSelected': False},
                 {
                     'name': 'cat2',
                     'code': 'dairy',
-                    'count': 1,
+                    'count': 3,
                     'children': [
                         {'name': 'cat3', 'code': 'milk', 'count': 1, 'children': [], 'isSelected': False},
-                        {'name': 'cat4', 'code': 'oil', 'count': 1, 'children': [], 'isSelected': True},
+                        {'name': 'cat4', 'code': 'oil', 'count': 2, 'children': [], 'isSelected': True},
                     ],
                     'isSelected': True,
                 },
             ],
-        }
+        },
+        {
+            'code': 'brand',
+            'name': 'Brand',
+            'type': 'brand',
+            'data': [{'name': 'my_brand_test_2', 'code': 'my_brand_test_2', 'count': 3, 'isSelected': False}],
+        },
+        {'code': 'price', 'name': 'Price', 'type': 'range', 'data': {'min': 120.0, 'max': 230.0}},
     ]
     response = app_catalog.get('/search?f[category]=dairy', json={})
     assert response.json()['navPills'] == [
@@ -485,20 +608,76 @@ def test_navpills_search(app_catalog):
             'name': 'Category',
             'type': 'category',
             'data': [
-                {'name': 'cat2', 'code': 'breakfast', 'count': 1, 'children': [], 'isSelected': False},
+                {'name': 'cat2', 'code': 'breakfast', 'count': 2, 'children': [], 'isSelected': False},
                 {
                     'name': 'cat2',
                     'code': 'dairy',
-                    'count': 1,
+                    'count': 3,
                     'children': [
                         {'name': 'cat3', 'code': 'milk', 'count': 1, 'children': [], 'isSelected': False},
-                        {'name': 'cat4', 'code': 'oil', 'count': 1, 'children': [], 'isSelected': False},
+                        {'name': 'cat4', 'code': 'oil', 'count': 2, 'children': [], 'isSelected': False},
                     ],
                     'isSelected': True,
                 },
             ],
-        }
+        },
+        {
+            'code': 'brand',
+            'name': 'Brand',
+            'type': 'brand',
+            'data': [{'name': 'my_brand_test_2', 'code': 'my_brand_test_2', 'count': 3, 'isSelected': False}],
+        },
+        {'code': 'price', 'name': 'Price', 'type': 'range', 'data': {'min': 120.0, 'max': 230.0}},
     ]
     response = app_catalog.get('/search?q=Rawabi&f[category]=dairy', json={})
     assert response.json()['navPills'] == []
-    assert response.json()['facets'] == []
+    assert response.json()['facets'] == [
+        {
+            'code': 'category',
+            'name': 'Category',
+            'type': 'category',
+            'data': [
+                {'name': 'cat2', 'code': 'breakfast', 'count': 1, 'children': [], 'isSelected': False},
+                {
+                    'name': 'cat2',
+                    'code': 'dairy',
+                    'count': 3,
+                    'children': [
+                        {'name': 'cat3', 'code': 'milk', 'count': 1, 'children': [], 'isSelected': False},
+                        {'name': 'cat4', 'code': 'oil', 'count': 2, 'children': [], 'isSelected': False},
+                    ],
+                    'isSelected': True,
+                },
+            ],
+        },
+        {
+            'code': 'brand',
+            'name': 'Brand',
+            'type': 'brand',
+            'data': [{'name': 'my_brand_test_2', 'code': 'my_brand_test_2', 'count': 3, 'isSelected': False}],
+        },
+        {'code': 'price', 'name': 'Price', 'type': 'range', 'data': {'min': 120.0, 'max': 230.0}},
+    ]
+
+
+def test_search_response_cache(app_catalog, setup_spanner, monkeypatch):
+    from libcatalog.domain.search import search_cache, search_index_versions
+
+    monkeypatch.setattr(search_cache, 'ttl', 30)
+    monkeypatch.setattr(search_index_versions, 'interval', 0)
+    search_cache.clear()
+    first = app_catalog.get('/search?f[category]=breakfast&productsOnly=1').json()
+    hits = search_cache.stats['hit']
+    second = app_catalog.get('/search?f[category]=breakfast&productsOnly=1').json()
+    assert second == first
+    assert search_cache.stats['hit'] == hits + 1
+
+    # a commit of the indexers changes the core's version, the cached response is not served anymore
+    update_url = "http://solr:8983/solr/offer_ae/update?commit=true"
+    requests.post(update_url, json=[{'object_id': 'ZCACHETEST0001Z-1:WH2', 'sku': 'ZCACHETEST0001Z-1'}])
+    requests.post(update_url, json={'delete': ['ZCACHETEST0001Z-1:WH2']})
+    misses = search_cache.stats['miss']
+    third = app_catalog.get('/search?f[category]=breakfast&productsOnly=1').json()
+    assert third == first
+    assert search_cache.stats['outdated'] == 1
+    assert search_cache.stats['miss'] == misses + 1
@@ -3,13 +3,29 @@ from libcatalog.domain.category import *
 
 def test_get_parent_categories():
     sku_list = ['Z7BE12221F4AE467439A0Z-1', 'Z7BE12221F4AE467439A1Z-1']
-    id_category_list = [row['id_category'] for row in get_id_categories_for(sku_list) if row['sku'] == 'Z7BE12221F4AE467439A0Z-1']
+    id_category_list = [
+        row['id_category'] for row in get_id_categories_for(sku_list) if row['sku'] == 'Z7BE12221F4AE467439A0Z-1'
+    ]
     assert len(id_category_list) == 1
     id_category = id_category_list[0]
     assert id_category == 3
     assert set(get_id_category_to_parent_ids_map().get(id_category)) == {3, 2}
-    id_category_list = [row['id_category'] for row in get_id_categories_for(sku_list) if row['sku'] == 'Z7BE12221F4AE467439A1Z-1']
+    id_category_list = [
+        row['id_category'] for row in get_id_categories_for(sku_list) if row['sku'] == 'Z7BE12221F4AE467439A1Z-1'
+    ]
     assert len(id_category_list) == 1
     id_category = id_category_list[0]
     assert id_category == 4
     assert set(get_id_category_to_parent_ids_map().get(id_category)) == {4, 2}
+
+
+def test_category_index():
+    index = get_category_index()
+    assert index is get_category_index()
+    assert index.code_to_id['milk'] == 3
+    assert set(index.roots) == {1, 2}
+    assert set(index.children[2]) == {3, 4}
+    assert set(index.get_category_ids_for([3, 4])) == {2, 3, 4}
+    navpills = index.get_category_navpills('en', 2, 4)
+    assert [pill['code'] for pill in navpills if pill['isSelected']] == ['category', 'oil']
+    assert get_category_index(cached=False) is not index
@@ -0,0 +1,90 @@
+from libutil.consumer_flow import AdaptiveLimiter, SubscriptionFlow
+
+
+def _run_window(limiter, latency, ok=True, concurrent=None):
+    concurrent = concurrent or limiter.limit
+    for _ in range(limiter.window // concurrent):
+        for _ in range(concurrent):
+            limiter.acquire()
+        for _ in range(concurrent):
+            limiter.release(latency, ok)
+
+
+def test_adaptive_limiter_grows_while_fast_and_saturated():
+    limiter = AdaptiveLimiter(initial=4, minimum=1, maximum=6, target_latency=1, window=20)
+    _run_window(limiter, 0.1)
+    assert limiter.limit == 5
+    # a window that never used the whole limit leaves it as is
+    _run_window(limiter, 0.1, concurrent=2)
+    assert limiter.limit == 5
+    for _ in range(5):
+        _run_window(limiter, 0.1)
+    assert limiter.limit == 6
+
+
+def test_adaptive_limiter_halves_on_latency_or_errors():
+    limiter = AdaptiveLimiter(initial=8, minimum=2, maximum=8, target_latency=1, window=16)
+    _run_window(limiter, 5)
+    assert limiter.limit == 4
+    _run_window(limiter, 0.1, ok=False)
+    assert (limiter.limit, limiter.last_error_rate) == (2, 1)
+    _run_window(limiter, 5)
+    assert limiter.limit == 2
+
+
+def test_subscription_flow_reports_processed_messages(monkeypatch):
+    monkeypatch.setenv('CONSUMER_TEST_MAX_MESSAGES', '3')
+    flow = SubscriptionFlow('test', max_messages=10, target_latency=1)
+    assert flow.max_messages == flow.limiter.limit == 3
+    acked = []
+
+    def wrapper_fn(fn, message, subctx):
+        fn(message)
+        acked.append(message)
+
+    def fail(message):
+        raise ValueError(message)
+
+    wrapped = flow.wrap(wrapper_fn)
+    wrapped(lambda message: None, 'm1', {})
+    try:
+        wrapped(fail, 'm2', {})
+    except ValueError:
+        pass
+    report = flow.report()
+    assert (report['processed'], report['failed'], report['in_flight']) == (1, 1, 0)
+    assert acked == ['m1']
+    assert flow.report()['processed'] == 0
+
+
+class _Message:
+    def __init__(self):
+        self.settled = []
+
+    def ack(self):
+        self.settled.append('ack')
+
+    def nack(self):
+        self.settled.append('nack')
+
+
+def test_deferred_ack_flow_counts_messages_until_acked():
+    flow = SubscriptionFlow('test', max_messages=10, target_latency=1, deferred_ack=True)
+    handed_off = []
+
+    def wrapper_fn(fn, message, subctx):
+        handed_off.append(message)
+
+    wrapped = flow.wrap(wrapper_fn)
+    first, second = _Message(), _Message()
+    wrapped(None, first, {})
+    wrapped(None, second, {})
+    assert flow.limiter.in_flight == 2
+
+    handed_off[0].ack()
+    handed_off[1].nack()
+    # only the first ack or nack of a message counts
+    handed_off[1].nack()
+    report = flow.report()
+    assert (report['processed'], report['failed'], report['in_flight']) == (1, 1, 0)
+    assert (first.settled, second.settled) == (['ack'], ['nack', 'nack'])
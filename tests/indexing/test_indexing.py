@@ -1,12 +1,18 @@
+import threading
 from datetime import datetime
 
 import pytz
+import requests
 from dateutil.relativedelta import relativedelta
 from jsql import sql
 
-from libindexing.domain import product
+from libindexing.domain import price, product, psku, solr_rebuild, stock
 from libindexing.domain.price import reindex_price
-from libindexing.domain.stock import reindex_stock
+from libindexing.domain.solr import SOLR_COMMIT_WITHIN_MS, bulk_solr_indexing, solr_indexers
+from libindexing.domain.solr_rebuild import _missing_schema_commands, _replay
+from libindexing.domain.stock import reindex_stock, StockUpdateBatcher
+from libcatalog.models.spanner_tables import Product, ProductLang
+from libutil import spanner_util
 from libutil.spanner_util import boilerplate_spanner, noon_cache_spanner
 from tests.indexing.mocks import product as mocked_product
 
@@ -23,6 +29,9 @@ def test_price_update(data_indexing, setup_spanner):
     assert spanner_offer_row['offer_price'] == 105
     # this is just to make sure that the price was updated recently because of reindexing
     assert spanner_offer_row['updated_at'] >= datetime.now(tz=pytz.UTC) - relativedelta(seconds=10)
+    # the offer is in stock, its solr document gets the new price and keeps its text fields
+    solr_docs = solr_indexers['ae'].solr.search('object_id:"Z008431D8F223B31EF128Z-1:WH2" AND en_title:truffles')
+    assert [(doc['sku'], doc['price']) for doc in solr_docs] == [('Z008431D8F223B31EF128Z-1', 105)]
 
 
 def test_stock_update_product_data_exist(engine_offer, monkeypatch):
@@ -179,3 +188,251 @@ def test_boilerplate_stock_logic():
             WHERE sku = 'N22222' AND wh_code = 'WH2'
         ''').dict()
     assert not row, "the row should not have been inserted"
+
+
+def test_stock_update_batcher_dedupes_and_acks_after_commit():
+    processed, acked = [], []
+    batcher = StockUpdateBatcher(max_size=100, max_wait=60, process=processed.append)
+    batcher.add([{"psku_code": "abcde", "warehouse_code": "WH2", "qty": 1}], ack=lambda: acked.append(1))
+    batcher.add([
+        {"psku_code": "abcde", "warehouse_code": "WH2", "qty": 2},
+        {"psku_code": "lemon", "warehouse_code": "WH2", "qty": 3},
+    ], ack=lambda: acked.append(2))
+    assert acked == []
+    batcher.flush()
+    assert len(processed) == 1
+    assert sorted((row['psku_code'], row['qty']) for row in processed[0]) == [('abcde', 2), ('lemon', 3)]
+    assert acked == [1, 2]
+
+
+def test_price_update_batcher_reindexes_each_offer_once(monkeypatch):
+    processed, acked = [], []
+    monkeypatch.setattr(price.price_update_batcher, 'process', processed.append)
+    price.price_update_batcher.add([('SKU-1', 'WH2'), ('SKU-2', 'WH2')], ack=lambda: acked.append(1))
+    price.price_update_batcher.add([('SKU-1', 'WH2')], ack=lambda: acked.append(2))
+    price.price_update_batcher.flush()
+    assert processed == [[('SKU-2', 'WH2'), ('SKU-1', 'WH2')]]
+    assert acked == [1, 2]
+
+
+def test_stock_update_batcher_nacks_failed_batch():
+    nacked = []
+
+    def fail(rows):
+        raise ValueError('spanner unavailable')
+
+    batcher = StockUpdateBatcher(max_size=100, max_wait=60, process=fail)
+    batcher.add([{"psku_code": "abcde", "warehouse_code": "WH2"}], ack=lambda: None, nack=lambda: nacked.append(1))
+    batcher.flush()
+    assert nacked == [1]
+
+
+def test_solr_bulk_indexing():
+    indexer = solr_indexers['ae']
+    doc = {'object_id': 'ZBULKTEST0001Z-1:WH2', 'sku': 'ZBULKTEST0001Z-1', 'wh_code': 'WH2', 'en_title': 'bulk test'}
+    with bulk_solr_indexing():
+        indexer.add_objects([doc])
+        # other threads are not part of the bulk job, their updates are visible right away
+        other_doc = {**doc, 'object_id': 'ZBULKTEST0002Z-1:WH2', 'sku': 'ZBULKTEST0002Z-1'}
+        thread = threading.Thread(target=indexer.add_objects, args=([other_doc],))
+        thread.start()
+        thread.join()
+        assert len(indexer.solr.search('object_id:"ZBULKTEST0002Z-1:WH2"')) == 1
+    assert len(indexer.solr.search('object_id:"ZBULKTEST0001Z-1:WH2"')) == 1
+    indexer.delete_objects(other_doc['object_id'])
+    indexer.delete_objects(doc['object_id'])
+    assert len(indexer.solr.search('object_id:"ZBULKTEST0001Z-1:WH2"')) == 0
+
+
+def test_stock_update_solr_writes_join_the_bulk_job(monkeypatch):
+    indexer = solr_indexers['ae']
+    chunks, commits = [], []
+
+    def add_chunk(documents, **params):
+        chunks.append(([doc['object_id'] for doc in documents], params))
+
+    monkeypatch.setattr(indexer, 'add_chunk', add_chunk)
+    monkeypatch.setattr(indexer, 'commit', lambda: commits.append(1))
+    monkeypatch.setattr(stock, 'STOCK_SINK_CHAINS', (('solr',),))
+    # the offer comes back in stock, so its document is built
+    monkeypatch.setattr(stock, 'get_offer_stock_map', lambda sku_wh_code_list: {})
+    with bulk_solr_indexing():
+        stock.stock_update([{'psku_code': 'abcde', 'wh_code': 'WH2', 'qty_net': 26, 'country_code': 'AE'}])
+    # the sink ran in the job's context: no per call commit, one commit when the job ends
+    assert chunks == [(['Z008431D8F223B31EF128Z-1:WH2'], {'commitWithin': SOLR_COMMIT_WITHIN_MS})]
+    assert commits == [1]
+
+
+def test_fetch_in_chunks_splits_failing_chunks():
+    def fetch_chunk(ids):
+        if 'bad' in ids:
+            raise ValueError('upstream error')
+        return {id_: {'id': id_} for id_ in ids}
+
+    ids = [f'id{i}' for i in range(15)] + ['bad']
+    result = product.fetch_in_chunks(ids, fetch_chunk, chunk_size=8, min_chunk_size=2)
+    assert sorted(result.failed) == ['bad', 'id14']
+    assert set(result) == set(ids) - {'bad', 'id14'}
+
+
+def test_fetch_in_chunks_fails_whole_chunk_on_transport_errors():
+    calls = []
+
+    def fetch_chunk(ids):
+        calls.append(ids)
+        if 'down' in ids:
+            raise requests.ConnectionError('catalog api unreachable')
+        return {id_: {'id': id_} for id_ in ids}
+
+    ids = [f'id{i}' for i in range(7)] + ['down']
+    result = product.fetch_in_chunks(ids, fetch_chunk, chunk_size=4, min_chunk_size=1)
+    assert sorted(result.failed) == ['down', 'id4', 'id5', 'id6']
+    assert set(result) == {'id0', 'id1', 'id2', 'id3'}
+    assert len(calls) == 2
+
+
+def test_unchanged_product_details_are_not_rewritten(monkeypatch):
+    monkeypatch.setattr(product, 'fetch_nsku_details', mocked_product.mock_fetch_nsku_details)
+    monkeypatch.setattr(product, 'fetch_zsku_details', mocked_product.mock_fetch_zsku_details)
+    products = [{'sku': 'Z111111111112Z-1', 'nsku': None}]
+    product.fetch_and_update_product_details(products)
+    processed = product.fetch_and_update_product_details(products)
+    assert list(processed) == ['Z111111111112Z-1']
+    assert processed.changed == []
+    content_hash = boilerplate_spanner().execute_sql('''
+        SELECT content_hash FROM product WHERE sku = 'Z111111111112Z-1'
+    ''').dict()['content_hash']
+    assert content_hash
+
+
+def test_full_stock_update_resumes_from_checkpoint(monkeypatch):
+    updated = []
+    monkeypatch.setattr(stock, 'STOCK_REINDEX_PAGE_SIZE', 2)
+    monkeypatch.setattr(stock, 'stock_update', lambda rows, force_product_update=False: updated.extend(
+        row['psku_code'] for row in rows
+    ))
+    stock.full_stock_update_for_warehouse('WH2', resume=False)
+    assert updated == ['aaaa', 'abcde', 'gg', 'hh', 'lemon', 'tt']
+    status = stock.get_stock_reindex_status('WH2')
+    assert (status['status'], status['last_psku_code'], status['rows_processed']) == ('done', 'tt', 6)
+
+    # a run that stopped after 'gg' continues with the rows after it
+    stock._save_stock_reindex_checkpoint('WH2', 'failed', 'gg', 3, status['started_at'])
+    updated.clear()
+    stock.full_stock_update_for_warehouse('WH2')
+    assert updated == ['hh', 'lemon', 'tt']
+    assert stock.get_stock_reindex_status('WH2')['rows_processed'] == 6
+
+    # a run of another process holds the warehouse
+    stock._save_stock_reindex_checkpoint('WH2', 'running', 'tt', 6, status['started_at'])
+    assert stock.start_full_stock_update_for_warehouse('WH2') is False
+    stock._save_stock_reindex_checkpoint('WH2', 'done', 'tt', 6, status['started_at'])
+
+
+def test_solr_rebuild_copies_missing_schema():
+    live = {
+        'fieldTypes': [{'name': 'string', 'class': 'solr.StrField'}, {'name': 'alph_sort', 'class': 'solr.TextField'}],
+        'fields': [{'name': 'object_id', 'type': 'string'}, {'name': 'en_title', 'type': 'alph_sort'}],
+        'dynamicFields': [{'name': 'attr_*', 'type': 'string'}],
+        'copyFields': [{'source': 'en_title', 'dest': '_text_'}],
+    }
+    shadow = {
+        'fieldTypes': [{'name': 'string', 'class': 'solr.StrField'}],
+        'fields': [{'name': 'object_id', 'type': 'text'}],
+        'copyFields': [{'source': 'en_brand', 'dest': '_text_'}],
+    }
+    assert _missing_schema_commands(live, shadow) == {
+        'add-field-type': [{'name': 'alph_sort', 'class': 'solr.TextField'}],
+        'add-field': [{'name': 'en_title', 'type': 'alph_sort'}],
+        'replace-field': [{'name': 'object_id', 'type': 'string'}],
+        'add-dynamic-field': [{'name': 'attr_*', 'type': 'string'}],
+        'delete-copy-field': [{'source': 'en_brand', 'dest': '_text_'}],
+        'add-copy-field': [{'source': 'en_title', 'dest': '_text_'}],
+    }
+    assert _missing_schema_commands(live, live) == {}
+
+
+class _RecordingIndexer:
+    def __init__(self):
+        self.added, self.deleted = [], []
+
+    def add_objects(self, docs):
+        self.added.extend(doc['object_id'] for doc in docs)
+
+    def delete_objects(self, object_ids):
+        self.deleted.extend(object_ids)
+
+
+def test_solr_rebuild_replay_deletes_offers_gone_from_spanner(monkeypatch):
+    # SKU-1 changed and is still in stock, SKU-2 went out of stock, SKU-3 was loaded and then deleted
+    monkeypatch.setattr(solr_rebuild, 'get_offers_changed_since', lambda country_code, since: [('SKU-1', 'WH2'), ('SKU-2', 'WH2')])
+    monkeypatch.setattr(solr_rebuild, 'get_product_and_offer_details_for', lambda keys: [
+        {'sku': 'SKU-1', 'wh_code': 'WH2', 'stock_net': 3}, {'sku': 'SKU-2', 'wh_code': 'WH2', 'stock_net': 0},
+    ])
+    monkeypatch.setattr(solr_rebuild, 'get_solr_doc', lambda row: {'object_id': f"{row['sku']}:{row['wh_code']}"})
+    monkeypatch.setattr(solr_rebuild, 'get_in_stock_offer_keys', lambda keys: {('SKU-1', 'WH2')} & set(keys))
+    indexer = _RecordingIndexer()
+    indexed = {('SKU-2', 'WH2'), ('SKU-3', 'WH2')}
+
+    assert _replay(indexer, 'ae', None, indexed) == 4
+    assert indexer.added == ['SKU-1:WH2']
+    assert indexer.deleted == ['SKU-2:WH2', 'SKU-3:WH2']
+    assert indexed == {('SKU-1', 'WH2')}
+
+
+def test_upsert_batches_fit_the_mutation_limit(monkeypatch):
+    monkeypatch.setattr(spanner_util, 'SPANNER_MAX_MUTATIONS_PER_COMMIT', 125)
+    monkeypatch.setattr(spanner_util, 'SPANNER_MUTATION_HEADROOM', 0.2)
+    monkeypatch.setattr(spanner_util, 'SPANNER_INDEX_MUTATIONS', {'product': 2})
+    rows = [{'sku': f'sku{i}'} for i in range(10)]
+    tables = [(Product, 'product', rows), (ProductLang, 'product_en', rows), (ProductLang, 'product_ar', rows)]
+    batches, mutations_per_row = spanner_util._mutation_batches(tables)
+    assert mutations_per_row == Product.get_column_count() + 2 + 2 * ProductLang.get_column_count()
+    rows_per_batch = 100 // mutations_per_row
+    assert batches[0] == (0, rows_per_batch)
+    assert batches[-1][1] == 10
+    assert all(end - start <= rows_per_batch for start, end in batches)
+
+
+def test_failed_stock_sink_goes_to_outbox_and_is_drained(engine_offer, monkeypatch):
+    monkeypatch.setattr(stock, 'STOCK_OUTBOX_RETRY_SECONDS', 0)
+    # the outbox is drained by the test only, not by a background thread racing it
+    monkeypatch.setattr(stock.stock_outbox_drainer, 'start', lambda: None)
+    write_noon_cache_stock = stock.STOCK_SINKS['noon_cache']
+    calls = []
+
+    def fail_once(stock_update_rows, skus_to_add_to_solr):
+        calls.append(len(stock_update_rows))
+        if len(calls) == 1:
+            raise RuntimeError('noon cache unavailable')
+        write_noon_cache_stock(stock_update_rows, skus_to_add_to_solr)
+
+    monkeypatch.setitem(stock.STOCK_SINKS, 'noon_cache', fail_once)
+    reindex_stock([{"psku_code": "abcde", "warehouse_code": "WH2"}])
+
+    # the other sinks are written regardless
+    assert sql(engine_offer, '''
+        SELECT stock_net FROM offer_stock WHERE sku = :sku AND wh_code = :wh_code
+    ''', sku="Z008431D8F223B31EF128Z-1", wh_code="WH2").dict()["stock_net"] == 26
+    outbox = sql(engine_offer, 'SELECT sinks, stock_keys, attempts FROM stock_sink_outbox').dicts()
+    assert [(row['sinks'], row['stock_keys']) for row in outbox] == [('noon_cache', '[["abcde", "WH2"]]')]
+    assert stock.get_stock_sink_lag()['noon_cache']['pending'] == 1
+
+    assert stock.drain_stock_outbox() == 1
+    assert len(calls) == 2
+    assert sql(engine_offer, 'SELECT COUNT(*) FROM stock_sink_outbox').scalar() == 0
+    assert stock.get_stock_sink_lag()['noon_cache']['pending'] == 0
+
+
+def test_psku_code_cache_warms_up_from_snapshot():
+    psku.psku_code_cache.clear()
+    psku_code_map = psku.get_psku_code_map(['abcde', 'unknown'])
+    assert psku_code_map['abcde']['sku'] == 'Z008431D8F223B31EF128Z-1'
+    assert 'unknown' not in psku_code_map
+
+    # a new process starts with the pskus seen so far
+    psku.psku_code_cache.clear()
+    assert psku.warm_psku_code_cache() >= 1
+    loads = psku.psku_code_cache.stats['loads']
+    assert psku.psku_code_cache.get_many(['abcde']) == {'abcde': psku_code_map['abcde']}
+    assert psku.psku_code_cache.stats['loads'] == loads
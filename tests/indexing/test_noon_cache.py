@@ -0,0 +1,42 @@
+from libindexing.domain.noon_cache import ProductKeySet
+
+
+class _ProductTable:
+    def __init__(self, skus):
+        self.skus = set(skus)
+        self.reads = []
+
+    def read(self, skus=None):
+        self.reads.append(None if skus is None else sorted(skus))
+        return set(self.skus) if skus is None else self.skus & set(skus)
+
+
+def test_product_key_set_skips_reads_for_known_skus():
+    table = _ProductTable({'Z1-1', 'Z2-1', 'N1'})
+    keys = ProductKeySet(read=table.read)
+    keys.rebuild()
+    table.reads.clear()
+    assert keys.existing(['Z1-1', 'Z2-1']) == {'Z1-1', 'Z2-1'}
+    assert table.reads == []
+
+
+def test_product_key_set_confirms_unknown_skus():
+    table = _ProductTable({'Z1-1'})
+    keys = ProductKeySet(read=table.read, absent_ttl=60)
+    keys.rebuild()
+    table.skus.add('Z3-1')
+    table.reads.clear()
+
+    # a product added after the build is found and remembered, a missing one is read only once
+    assert keys.existing(['Z1-1', 'Z3-1', 'N9']) == {'Z1-1', 'Z3-1'}
+    assert keys.existing(['Z3-1', 'N9']) == {'Z3-1'}
+    assert table.reads == [['N9', 'Z3-1']]
+    assert keys.metrics()['absent_hits'] == 1
+
+
+def test_product_key_set_confirms_everything_until_built():
+    table = _ProductTable({'Z1-1'})
+    keys = ProductKeySet(read=table.read, rebuild_interval=3600)
+    keys.next_build_at = float('inf')
+    assert keys.existing(['Z1-1', 'N9']) == {'Z1-1'}
+    assert table.reads == [['N9', 'Z1-1']]
@@ -0,0 +1,66 @@
+import logging
+import time
+
+from libindexing.domain.product_transform import ProductBatchTransform
+
+logger = logging.getLogger(__name__)
+
+
+class _CategoryIndex:
+    def __init__(self):
+        self.calls = 0
+
+    def get_category_ids_for(self, ids):
+        self.calls += 1
+        return sorted(set(ids) | {1})
+
+
+def _zsku_payload(i):
+    return {
+        'attributes': {
+            'family': [{'data': 'food_beverage', 'locale': 'en'}],
+            'brand': [
+                {'data': f'brand_{i % 50}', 'locale': 'en', 'option_name': f'Brand {i % 50}'},
+                {'data': f'brand_{i % 50}', 'locale': 'ar', 'option_name': f'براند {i % 50}'},
+            ],
+            'model_number': [{'locale': None, 'data': f'M{i}'}],
+            'model_name': [{'locale': None, 'data': 'model'}],
+            'product_title': [{'locale': 'en', 'data': f'title {i}'}, {'locale': 'ar', 'data': f'عنوان {i}'}],
+            'title_suffix': [{'locale': 'en', 'data': '1kg'}],
+            'image_url': [{'storage_path': f'v1/{i}.jpg'}],
+        }
+    }
+
+
+def _transform(n):
+    skus = [f'Z{i:020d}Z-1' for i in range(n)]
+    sku_id_categories = [{'sku': sku, 'id_category': 2 + i % 20} for i, sku in enumerate(skus)]
+    category_index = _CategoryIndex()
+    payloads = {sku: _zsku_payload(i) for i, sku in enumerate(skus)}
+    started = time.perf_counter()
+    batch = ProductBatchTransform(sku_id_categories, {}, category_index)
+    for sku, data in payloads.items():
+        batch.add_zsku(sku, data)
+    return batch, category_index, time.perf_counter() - started
+
+
+def test_product_batch_transform_rows():
+    batch, category_index, _ = _transform(40)
+    assert len(batch.product_rows) == len(batch.product_en_rows) == len(batch.product_ar_rows) == 40
+    product_row, en_row, ar_row = batch.product_rows[3], batch.product_en_rows[3], batch.product_ar_rows[3]
+    assert product_row['category_ids'] == '1,5'
+    assert product_row['model_name_number'] == 'model M3'
+    assert product_row['image_keys'] == '["v1/3"]'
+    assert (en_row['title'], en_row['title_suffix'], en_row['brand']) == ('title 3', '1kg', 'Brand 3')
+    assert (ar_row['title'], ar_row['title_suffix']) == ('عنوان 3', None)
+    # category ids are computed once per distinct category combination
+    assert category_index.calls == 20
+
+
+def test_product_batch_transform_scales_linearly():
+    batch, category_index, seconds = _transform(10000)
+    assert len(batch.product_rows) == 10000
+    # the per batch work does not grow with the skus
+    assert category_index.calls == 20
+    # wall clock timings depend on the machine, they are reported rather than asserted
+    logger.info(f"product batch transform of 10000 skus: {seconds:.3f}s")
@@ -0,0 +1,52 @@
+import time
+
+from libindexing.domain.psku import MappingCache
+
+
+class _Source:
+    def __init__(self, values):
+        self.values = values
+        self.loads = []
+
+    def load(self, keys):
+        self.loads.append(list(keys))
+        return {key: self.values[key] for key in keys if key in self.values}
+
+
+def test_mapping_cache_loads_misses_in_bulk_and_caches_unknown_keys():
+    source = _Source({'a': 1, 'b': 2})
+    cache = MappingCache('test', source.load, max_size=10, ttl=60, negative_ttl=60)
+    cache.prefetch(['a', 'b', 'x'])
+    assert cache.get_many(['a', 'x', 'b', 'a']) == {'a': 1, 'b': 2}
+    # the unknown key is a negative entry, not looked up again
+    assert source.loads == [['a', 'b', 'x']]
+    assert cache.metrics()['negative_hits'] == 1
+
+
+def test_mapping_cache_evicts_least_recently_used():
+    source = _Source({key: key.upper() for key in 'abcd'})
+    cache = MappingCache('test', source.load, max_size=2, ttl=60, negative_ttl=60)
+    cache.get_many(['a', 'b'])
+    cache.get_many(['a'])
+    cache.get_many(['c'])
+    assert list(cache.entries) == ['a', 'c']
+    assert cache.metrics()['evictions'] == 1
+
+
+def test_mapping_cache_expires_entries():
+    source = _Source({'a': 1})
+    cache = MappingCache('test', source.load, max_size=10, ttl=60, negative_ttl=0.01)
+    cache.get_many(['a', 'x'])
+    time.sleep(0.02)
+    source.values['x'] = 2
+    assert cache.get_many(['a', 'x']) == {'a': 1, 'x': 2}
+    assert source.loads == [['a', 'x'], ['x']]
+
+
+def test_mapping_cache_put_many_keeps_the_age_of_entries():
+    source = _Source({'a': 2, 'b': 3})
+    cache = MappingCache('test', source.load, max_size=10, ttl=60, negative_ttl=60)
+    # 'b' was confirmed longer than the ttl ago, it is loaded again on the first lookup
+    cache.put_many({'a': 1, 'b': 1}, ages={'a': 10, 'b': 60})
+    assert cache.get_many(['a', 'b']) == {'a': 1, 'b': 3}
+    assert source.loads == [['b']]
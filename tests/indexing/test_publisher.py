@@ -0,0 +1,84 @@
+import json
+import threading
+
+import pytest
+
+from libutil import pubsub
+
+
+class _Future:
+    def __init__(self, error=None):
+        self.error = error
+        self.callbacks = []
+        self.done = False
+
+    def add_done_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def resolve(self):
+        if self.done:
+            return
+        self.done = True
+        for callback in self.callbacks:
+            callback(self)
+
+    def result(self, timeout=None):
+        self.resolve()
+        if self.error:
+            raise self.error
+        return 'message-id'
+
+
+class _Client:
+    def __init__(self, fail_on=()):
+        self.fail_on = fail_on
+        self.published = []
+        self.resumed = []
+
+    def publish(self, topic, data, ordering_key='', **attrs):
+        self.published.append((topic, json.loads(data), ordering_key))
+        return _Future(RuntimeError('unavailable') if len(self.published) in self.fail_on else None)
+
+    def resume_publish(self, topic, ordering_key):
+        self.resumed.append(ordering_key)
+
+
+def test_publisher_does_not_wait_per_message(monkeypatch):
+    client = _Client()
+    monkeypatch.setattr(pubsub, 'get_pub_client', lambda ordering=False: client)
+    with pubsub.get_publisher('projects/p/topics/t') as publisher:
+        for i in range(3):
+            publisher(json.dumps([i]))
+        # nothing is waited for until the publisher is flushed
+        assert len(publisher.futures) == 3
+    assert publisher.futures == []
+    assert client.published == [('projects/p/topics/t', [i], '') for i in range(3)]
+
+
+def test_publisher_flush_raises_and_resumes_failed_ordering_keys(monkeypatch):
+    client = _Client(fail_on=(2,))
+    monkeypatch.setattr(pubsub, 'get_pub_client', lambda ordering=False: client)
+    publisher = pubsub.get_publisher('projects/p/topics/t', ordering=True)
+    for i in range(3):
+        publisher(json.dumps([i]), ordering_key=f'key{i}')
+    with pytest.raises(RuntimeError):
+        publisher.flush()
+    assert client.resumed == ['key1']
+
+
+def test_publishing_blocks_while_too_many_messages_are_in_flight(monkeypatch):
+    client = _Client()
+    monkeypatch.setattr(pubsub, 'get_pub_client', lambda ordering=False: client)
+    monkeypatch.setattr(pubsub, '_in_flight_slots', threading.BoundedSemaphore(1))
+    publisher = pubsub.get_publisher('projects/p/topics/t')
+    first = publisher(json.dumps([0]))
+    second = threading.Thread(target=publisher, args=(json.dumps([1]),))
+    second.start()
+    second.join(timeout=0.2)
+    assert second.is_alive()
+    # the first message is sent, its slot goes to the second one
+    first.resolve()
+    second.join(timeout=5)
+    assert not second.is_alive()
+    assert len(client.published) == 2
+    publisher.flush()